@@ -1,96 +1,86 @@
-import os, sys, json, datetime, logging, base64, threading
+import os, sys, json, datetime, logging, base64, threading, time, concurrent.futures
+from collections import namedtuple, deque
 
-from gs.util.exceptions import NoServiceCredentials
-from gs.util.compat import get_ident
+from gs.util import batches
+from gs.util.exceptions import NoServiceCredentials, GSBatchError
+from gs.credentials import GSCredentials, BearerAuth
+from gs.transport import GSTransport
+from gs.throttle import AdaptiveConcurrency, AdaptiveRetry, RetryBudget, throttle_codes
+from gs.util.compat import get_ident, Queue, Full
 
 import requests, tweak
-from requests.adapters import HTTPAdapter
-from requests.packages.urllib3.util import retry
 
 logger = logging.getLogger(__name__)
 
 class GSClient:
     base_url = "https://www.googleapis.com/storage/v1/"
     presigned_url_base = "https://storage.googleapis.com/"
-    scope = "https://www.googleapis.com/auth/cloud-platform"
-    instance_metadata_url = "http://metadata.google.internal/computeMetadata/v1/"
-    svc_acct_token_url = instance_metadata_url + "instance/service-accounts/default/token"
-    project_id_metadata_url = instance_metadata_url + "project/project-id"
+    scope = GSCredentials.scope
+    instance_metadata_url = GSCredentials.instance_metadata_url
+    svc_acct_token_url = GSCredentials.svc_acct_token_url
+    project_id_metadata_url = GSCredentials.project_id_metadata_url
     suppress_paging_warning = False
-    retry_policy = retry.Retry(connect=5, read=5, status_forcelist=frozenset({500, 502, 503, 504}), backoff_factor=1)
+    shard_queue_size = 10000  # Listed items held per shard (or for all shards, if unordered) by list_parallel()
+    retry_policy = AdaptiveRetry(connect=5, read=5, status_forcelist=frozenset({429, 500, 502, 503, 504}),
+                                 backoff_factor=1)
     timeout = 20
+    max_connections = 32
+    idle_timeout = 60
+    adaptive_concurrency = True
 
-    def __init__(self, config=None, **session_kwargs):
+    def __init__(self, config=None, credentials=None, transport=None, **session_kwargs):
+        """
+        Clients that are given the same *credentials* (GSCredentials) and *transport* (GSTransport) share access
+        tokens and pooled connections. By default each client gets its own transport, which uses at most max_connections
+        connections in total across all threads that use the client, with an adaptive limit (of at most
+        max_connections) on requests in flight and a retry budget.
+        """
         if config is None:
             config = tweak.Config(__name__, save_on_exit=False)
         self.config = config
-        self._service_jwt = None
-        self._oauth2_token = None
+        self.credentials = credentials if credentials is not None else GSCredentials(config)
+        if transport is None:
+            concurrency = AdaptiveConcurrency(max_limit=self.max_connections) if self.adaptive_concurrency else None
+            retry_budget = RetryBudget()
+            transport = GSTransport(max_connections=self.max_connections, concurrency=concurrency,
+                                    retry_budget=retry_budget,
+                                    max_retries=self.retry_policy.bind(concurrency=concurrency, budget=retry_budget))
+        self.transport = transport
         self._sessions = {}
+        self._sessions_lock = threading.Lock()
         self._session_kwargs = session_kwargs
 
     def get_session(self):
         thread_id = get_ident()
+        self.transport.close_idle_connections(idle_timeout=self.idle_timeout)
         if thread_id not in self._sessions:
             session = requests.Session(**self._session_kwargs)
             session.headers.update({"User-Agent": self.__class__.__name__})
-            token = self.get_oauth2_token()
-            if token is not None:
-                session.headers.update({"Authorization": "Bearer " + token})
-            adapter = HTTPAdapter(max_retries=self.retry_policy)
-            session.mount('http://', adapter)
-            session.mount('https://', adapter)
-            self._sessions[thread_id] = session
+            session.auth = BearerAuth(self.credentials)
+            session.mount('http://', self.transport)
+            session.mount('https://', self.transport)
+            with self._sessions_lock:
+                # Sessions hold no connections of their own, so sessions of exited threads are simply dropped
+                live_threads = {t.ident for t in threading.enumerate()}
+                for dead_thread_id in [i for i in self._sessions if i not in live_threads]:
+                    del self._sessions[dead_thread_id]
+                self._sessions[thread_id] = session
         return self._sessions[thread_id]
 
+    def get_pool_stats(self):
+        return self.transport.stats()
+
     def get_oauth2_token(self):
-        # TODO: invalidate and refetch before expiration
-        if self._oauth2_token is None:
-            try:
-                service_jwt = self.get_service_jwt()
-                params = dict(grant_type="urn:ietf:params:oauth:grant-type:jwt-bearer", assertion=service_jwt)
-                res = requests.post("https://www.googleapis.com/oauth2/v4/token", data=params)
-            except NoServiceCredentials:
-                try:
-                    res = requests.get(self.svc_acct_token_url, headers={"Metadata-Flavor": "Google"})
-                except Exception:
-                    logger.warn('API credentials not configured. Sending unsigned requests.')
-                    logger.warn('To set credentials, run "gs configure" or set GOOGLE_APPLICATION_CREDENTIALS.')
-                    return None
-            res.raise_for_status()
-            self._oauth2_token = res.json()["access_token"]
-        return self._oauth2_token
+        return self.credentials.get_token()
 
     def get_service_jwt(self):
-        if self._service_jwt is None:
-            if "service_credentials" not in self.config:
-                if "GOOGLE_APPLICATION_CREDENTIALS" in os.environ:
-                    logger.info("Using GOOGLE_APPLICATION_CREDENTIALS file %s",
-                                os.environ["GOOGLE_APPLICATION_CREDENTIALS"])
-                    with open(os.environ["GOOGLE_APPLICATION_CREDENTIALS"]) as fh:
-                        self.config.service_credentials = json.load(fh)
-                else:
-                    raise NoServiceCredentials()
-
-            payload = {
-                'iss': self.config.service_credentials["client_email"],
-                'sub': self.config.service_credentials["client_email"],
-                'scope': self.scope,
-                'aud': "https://www.googleapis.com/oauth2/v4/token",
-                'iat': datetime.datetime.utcnow(),
-                'exp': datetime.datetime.utcnow() + datetime.timedelta(minutes=60)
-            }
-            additional_headers = {'kid': self.config.service_credentials["private_key_id"]}
-            import jwt
-            self._service_jwt = jwt.encode(payload,
-                                           self.config.service_credentials["private_key"],
-                                           headers=additional_headers,
-                                           algorithm='RS256').decode()
-        return self._service_jwt
-
-    def request(self, method, resource, **kwargs):
+        return self.credentials.get_service_jwt()
+
+    def request(self, method, resource, timeout=None, **kwargs):
         url = self.base_url + resource
-        res = self.get_session().request(method=method, url=url, timeout=self.timeout, **kwargs)
+        res = self.get_session().request(method=method, url=url, timeout=timeout or self.timeout, **kwargs)
+        if not res.ok and kwargs.get("stream") is True:
+            res.content  # Read the error body, which releases the connection of a streamed response
         res.raise_for_status()
         return res if kwargs.get("stream") is True or method == "delete" else res.json()
 
@@ -110,16 +100,21 @@ class GSClient:
         return self.request(method="delete", resource=resource, **kwargs)
 
     def get_project(self):
-        if "GOOGLE_CLOUD_PROJECT" in os.environ:
-            return os.environ["GOOGLE_CLOUD_PROJECT"]
-        self.get_session()  # Ensures any available project-specific credentials are loaded.
-        if "service_credentials" in self.config:
-            return self.config.service_credentials["project_id"]
-        res = requests.get(self.project_id_metadata_url, headers={"Metadata-Flavor": "Google"})
-        res.raise_for_status()
-        return res.content.decode()
+        return self.credentials.get_project()
+
+    @staticmethod
+    def get_list_fields(item_fields):
+        """Return a partial response projection of a listing that keeps only *item_fields* of each item."""
+        return "nextPageToken,prefixes,items({})".format(",".join(item_fields))
 
-    def list(self, resource, include_prefixes=True, **kwargs):
+    def list(self, resource, include_prefixes=True, fields=None, warn_paging=True, **kwargs):
+        """
+        Iterate over all items of a listing, following nextPageToken. If *fields* is given, only those fields of each
+        object resource are requested. Unless *warn_paging* is False, a hint to use ls --max-results is logged (once per
+        client) when the listing has more than one page.
+        """
+        if fields is not None:
+            kwargs["params"] = dict(kwargs.get("params") or {}, fields=self.get_list_fields(fields))
         while True:
             page = self.request(method="get", resource=resource, **kwargs)
             items = [dict(name=i) for i in page.get("prefixes", [])] if include_prefixes else []
@@ -131,7 +126,7 @@ class GSClient:
                     if kwargs["params"]["maxResults"] == 0:
                         return
             if "nextPageToken" in page:
-                if not self.suppress_paging_warning:
+                if warn_paging and not self.suppress_paging_warning:
                     logger.warn("Large number of results returned. Listing may take a while. "
                                 "You can limit the object count using the --max-results option.")
                     self.suppress_paging_warning = True
@@ -139,6 +134,128 @@ class GSClient:
             else:
                 break
 
+    def list_parallel(self, resource, params=None, include_prefixes=True, shard_by="auto", shards=16, ordered=False,
+                      max_workers=None, split_points=None, fields=None):
+        """
+        List objects like list(), but split the keyspace into shards that are listed concurrently and merged into a
+        single stream. Listed prefixes (when a delimiter is used) are yielded as dict(name=prefix).
+
+        With shard_by="prefix", the prefixes found under params["prefix"] with a "/" delimiter become shards. With
+        shard_by="range", the keyspace is cut into key ranges with startOffset/endOffset, either at the given
+        split_points or at evenly spaced alphanumeric characters following the prefix. With shard_by="auto", a single
+        delimited page decides between the two. Delimited listings are always sharded by range.
+
+        If ordered is True, shards are yielded one after another in key order, so objects come out in the same
+        lexicographic order as from list(). Ordered listings must include the name field if *fields* is given.
+        """
+        params = dict(params or {})
+        if fields is not None:
+            params["fields"] = self.get_list_fields(fields)
+        if "maxResults" in params:
+            for item in self.list(resource, params=params, include_prefixes=include_prefixes):
+                yield item
+            return
+        prefix, head = params.get("prefix", ""), []
+        if "delimiter" in params or split_points:
+            shard_by = "range"
+        if shard_by in ("auto", "prefix"):
+            page_params = dict(params, delimiter="/")
+            while True:
+                page = self.request(method="get", resource=resource, params=page_params)
+                head.extend(page.get("items", []))
+                head.extend(dict(prefix=p) for p in page.get("prefixes", []))
+                if shard_by == "auto":
+                    if "nextPageToken" in page and len(page.get("prefixes", [])) < 2:
+                        shard_by, head = "range", []
+                        break
+                    shard_by = "prefix"
+                if "nextPageToken" not in page:
+                    break
+                page_params["pageToken"] = page["nextPageToken"]
+        if shard_by == "prefix":
+            shard_params = [dict(params, prefix=i["prefix"]) for i in head if "prefix" in i]
+            head = [i for i in head if "prefix" not in i]
+        elif shard_by == "range":
+            if split_points is None:
+                alphabet = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+                split_points = [prefix + alphabet[len(alphabet) * i // shards] for i in range(1, shards)]
+            bounds = [None] + sorted(split_points) + [None]
+            shard_params = []
+            for start, end in zip(bounds[:-1], bounds[1:]):
+                shard_params.append(dict(params))
+                if start is not None:
+                    shard_params[-1]["startOffset"] = start
+                if end is not None:
+                    shard_params[-1]["endOffset"] = end
+        else:
+            raise ValueError("Unknown sharding method {}".format(shard_by))
+        if ordered:
+            shard_params.sort(key=lambda p: p.get("prefix", "") + p.get("startOffset", ""))
+            head.sort(key=lambda i: i["name"])
+        logger.debug("Listing %s in %d shards", resource, len(shard_params))
+        for item in self._merge_shards(resource, head, shard_params, include_prefixes=include_prefixes,
+                                       ordered=ordered, max_workers=max_workers):
+            yield item
+
+    @staticmethod
+    def _put_unless_stopped(queue, item, stop):
+        """Put item on the bounded queue, giving up if the consumer stops reading. Returns False if it gave up."""
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def _list_shard(self, resource, params, include_prefixes, queue, stop):
+        if stop.is_set():
+            return
+        try:
+            for item in self.list(resource, params=params, include_prefixes=include_prefixes):
+                if not self._put_unless_stopped(queue, item, stop):
+                    return
+        except Exception as e:
+            if not self._put_unless_stopped(queue, e, stop):
+                return
+        self._put_unless_stopped(queue, StopIteration, stop)
+
+    def _merge_shards(self, resource, head, shard_params, include_prefixes=True, ordered=False, max_workers=None):
+        stop = threading.Event()
+        # Ordered merges read each shard from its own queue, in turn; unordered merges share one queue. Shards listed
+        # ahead of the one being read wait once their queue is full.
+        if ordered:
+            queues = [Queue(maxsize=self.shard_queue_size) for _ in shard_params]
+        else:
+            queues = [Queue(maxsize=self.shard_queue_size)] * len(shard_params)
+        threadpool = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers or 16)
+        try:
+            for params, queue in zip(shard_params, queues):
+                threadpool.submit(self._list_shard, resource, params, include_prefixes, queue, stop)
+            head = iter(head)
+            next_head = next(head, None)
+            for i in range(len(queues)) if ordered else [0]:
+                if ordered:
+                    shard_start = shard_params[i].get("prefix", "") + shard_params[i].get("startOffset", "")
+                    while next_head is not None and next_head["name"] < shard_start:
+                        yield next_head
+                        next_head = next(head, None)
+                pending = 1 if ordered else len(queues)
+                while pending > 0:
+                    item = queues[i].get()
+                    if item is StopIteration:
+                        pending -= 1
+                    elif isinstance(item, Exception):
+                        raise item
+                    else:
+                        yield item
+            while next_head is not None:
+                yield next_head
+                next_head = next(head, None)
+        finally:
+            stop.set()
+            threadpool.shutdown(wait=False)
+
     def get_presigned_url(self, bucket, key, expires_at, method="GET", headers=None, content_type=None, md5_b64=""):
         from cryptography.hazmat.backends import default_backend
         from cryptography.hazmat.primitives import serialization, hashes
@@ -148,10 +265,11 @@ class GSClient:
         for header, value in (headers.items() if headers else {}):
             string_to_sign += "\n" + header + ":" + value
         string_to_sign += "\n/" + bucket + "/" + key
-        private_key_bytes = self.config.service_credentials["private_key"].encode()
+        service_credentials = self.credentials.get_service_credentials()
+        private_key_bytes = service_credentials["private_key"].encode()
         private_key = serialization.load_pem_private_key(private_key_bytes, password=None, backend=default_backend())
         signature = private_key.sign(string_to_sign.encode(), padding.PKCS1v15(), hashes.SHA256())
-        qs = dict(GoogleAccessId=self.config.service_credentials["client_email"],
+        qs = dict(GoogleAccessId=service_credentials["client_email"],
                   Expires=str(int(expires_at)),
                   Signature=base64.b64encode(signature).decode())
         return self.presigned_url_base + bucket + "/" + key + "?" + requests.compat.urlencode(qs)
@@ -159,10 +277,86 @@ class GSClient:
 class GSUploadClient(GSClient):
     base_url = "https://www.googleapis.com/upload/storage/v1/"
 
+BatchSubresponse = namedtuple("BatchSubresponse", "content_id status_code reason headers body")
+
 class GSBatchClient(GSClient):
     base_url = "https://www.googleapis.com/batch/storage/v1/"
+    retry_codes = frozenset({429, 500, 502, 503, 504})
+    max_retries = 3
+    max_batch_size = 100
+
+    @staticmethod
+    def subrequest(method, resource, params=None, json_body=None):
+        """
+        Build a subrequest for post_batch(). *resource* is relative to the JSON API root, for example
+        "b/my-bucket/o/my%2Fkey" or "b/src/o/key/rewriteTo/b/dest/o/key". A JSON body may be given for PATCH, POST
+        (e.g. rewrite) and PUT subrequests.
+        """
+        request = requests.Request(method=method.upper(), url=resource, params=params or {})
+        if json_body is not None:
+            request.headers["Content-Type"] = "application/json; charset=UTF-8"
+            request.data = json.dumps(json_body)
+        return request
+
+    def post_batches(self, requests_, max_workers=None, batch_size=None, **post_batch_kwargs):
+        """
+        Send an iterable of subrequests of any method (DELETE, PATCH, GET, POST) as batch requests of up to
+        *batch_size* subrequests each, from a pool of *max_workers* threads. The iterable is consumed lazily and the
+        number of batches in flight is bounded. Yields (subrequests, subresponses) for each batch in submission order.
+        """
+        batch_size = batch_size or self.max_batch_size
+        max_workers = max_workers or 8
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as threadpool:
+            futures = deque()
+            for batch in batches(requests_, batch_size=batch_size):
+                futures.append((batch, threadpool.submit(self.post_batch, batch, **post_batch_kwargs)))
+                while len(futures) >= max_workers * 2:
+                    batch, future = futures.popleft()
+                    yield batch, future.result()
+            while futures:
+                batch, future = futures.popleft()
+                yield batch, future.result()
+
+    def post_batch(self, requests_, boundary="==gsboundary==", expect_codes=None, raise_for_status=True):
+        """
+        Send up to 100 prepared subrequests (requests.Request objects with a relative URL) as one batch request, and
+        return a list of BatchSubresponse tuples in the order of the subrequests. Subrequests that fail with a
+        retriable status are resent in a new batch; successful subrequests are never resent. If any subrequest
+        ultimately fails and raise_for_status is True, GSBatchError is raised with all subresponses attached.
+        """
+        responses = [None] * len(requests_)
+        pending = list(range(len(requests_)))
+        for attempt in range(self.max_retries + 1):
+            if attempt > 0:
+                time.sleep(self.retry_policy.backoff_factor * (2 ** (attempt - 1)))
+            for subresponse in self._post_batch([requests_[i] for i in pending], boundary=boundary):
+                responses[pending[subresponse.content_id]] = subresponse._replace(
+                    content_id=pending[subresponse.content_id]
+                )
+            pending = [i for i in pending if responses[i] is not None and responses[i].status_code in self.retry_codes]
+            throttled = any(responses[i].status_code in throttle_codes for i in pending)
+            if not pending or not self.transport.should_retry(len(pending), throttled=throttled):
+                break
+            logger.debug("Retrying %d failed subrequests of batch request", len(pending))
+        errors = [(i, r) for i, r in enumerate(responses) if not self.is_success(r, expect_codes=expect_codes)]
+        if errors and raise_for_status:
+            i, r = errors[0]
+            status_line = "{} {}".format(r.status_code, r.reason) if r else "no response"
+            msg = "Error in batch request: {}. Subrequest: {} {} ({} of {} subrequests failed)"
+            raise GSBatchError(msg.format(status_line, requests_[i].method, requests_[i].url, len(errors),
+                                          len(requests_)),
+                               responses=responses)
+        return responses
+
+    @staticmethod
+    def is_success(subresponse, expect_codes=None):
+        if subresponse is None:
+            return False
+        if expect_codes:
+            return subresponse.status_code in expect_codes
+        return subresponse.status_code // 100 == 2
 
-    def post_batch(self, requests_, boundary="==gsboundary==", expect_codes=None):
+    def _post_batch(self, requests_, boundary="==gsboundary=="):
         headers = {"Content-Type": 'multipart/mixed; boundary="{}"'.format(boundary)}
         body = []
         for i, request in enumerate(requests_):
@@ -179,23 +373,72 @@ class GSBatchClient(GSClient):
         logging.getLogger("urllib3.connectionpool").setLevel(logging.ERROR)
         res = self.post("", headers=headers, data="\n".join(body).encode(), stream=True)
         res.raise_for_status()
-        return self.parse_multipart_response(res, requests_, expect_codes=expect_codes)
+        with res:
+            for subresponse in self.parse_multipart_response(res):
+                yield subresponse
 
-    def parse_multipart_response(self, res, requests_, expect_codes=None):
+    @staticmethod
+    def _iter_response_lines(res, chunk_size=64 * 1024):
+        buf = b""
+        for chunk in res.iter_content(chunk_size=chunk_size):
+            buf += chunk
+            lines = buf.split(b"\n")
+            buf = lines.pop()
+            for line in lines:
+                yield line.rstrip(b"\r").decode("utf-8")
+        if buf:
+            yield buf.rstrip(b"\r").decode("utf-8")
+
+    def parse_multipart_response(self, res):
+        """
+        Incrementally parse a multipart/mixed batch response, yielding one BatchSubresponse per part as soon as the
+        part has been read. Only one part is held in memory at a time.
+        """
         assert res.headers["content-type"].startswith("multipart/mixed; boundary=")
-        boundary = res.headers["content-type"][len("multipart/mixed; boundary="):]
-        responses = []
-        for part in res.content.decode().split("--" + boundary)[1:-1]:
-            status_line = None
-            for line in part.splitlines():
-                if line.startswith("Content-ID: <response-"):
-                    content_id = int(line[len("Content-ID: <response-"):].rstrip(">"))
-                if line.startswith("HTTP/1.1 "):
-                    status_line = line
-            status_code = int(status_line.split(" ", 2)[1])
-            success = (status_code in expect_codes) if expect_codes else (status_code // 100 == 2)
-            if not success:
-                msg = "Error in batch request: {}. Subrequest: {} {}"
-                raise Exception(msg.format(status_line, requests_[content_id].method, requests_[content_id].url))
-            responses.append(status_line)
-        return responses
+        boundary = res.headers["content-type"][len("multipart/mixed; boundary="):].strip('"')
+        delimiter, terminator = "--" + boundary, "--" + boundary + "--"
+        part, position = None, 0
+        for line in self._iter_response_lines(res):
+            if line.rstrip() in (delimiter, terminator):
+                if part is not None:
+                    yield self._parse_part(part, position)
+                    position += 1
+                if line.rstrip() == terminator:
+                    break
+                part = []
+            elif part is not None:
+                part.append(line)
+
+    @staticmethod
+    def _parse_part(lines, position):
+        """Parse the lines of the part at *position* of a batch response. Parts without a Content-ID get *position*."""
+        lines = iter(lines)
+        content_id, status_line = position, None
+        for line in lines:
+            if line == "":
+                break
+            if line.lower().startswith("content-id:"):
+                try:
+                    content_id = int(line.split(":", 1)[1].strip().strip("<>").rsplit("-", 1)[-1])
+                except ValueError:
+                    pass
+        for line in lines:
+            if line.startswith("HTTP/"):
+                status_line = line.split(" ", 2)
+                break
+        if status_line is None or len(status_line) < 2 or not status_line[1].isdigit():
+            raise GSBatchError("Malformed part {} of batch response: no HTTP status line".format(position))
+        headers = requests.structures.CaseInsensitiveDict()
+        for line in lines:
+            if line == "":
+                break
+            k, v = line.split(":", 1)
+            headers[k.strip()] = v.strip()
+        body = "\n".join(lines).strip()
+        if body and headers.get("Content-Type", "").startswith("application/json"):
+            body = json.loads(body)
+        return BatchSubresponse(content_id=content_id,
+                                status_code=int(status_line[1]),
+                                reason=status_line[2] if len(status_line) > 2 else "",
+                                headers=headers,
+                                body=body or None)
@@ -0,0 +1,217 @@
+"""
+Asyncio client for Google Cloud Storage, for issuing large numbers of concurrent requests from a single thread.
+
+Requires Python 3.6+ and aiohttp (pip install gs[async]). Usage:
+
+    async with AsyncGSClient() as client:
+        objects = [o async for o in client.list("b/my-bucket/o", params=dict(prefix="foo/"))]
+        metadata = await asyncio.gather(*[client.get("b/my-bucket/o/" + quote(o["name"], safe="")) for o in objects])
+"""
+
+import os, json, asyncio, base64, hashlib, logging
+
+import tweak, requests
+
+from . import GSClient, GSUploadClient
+from .credentials import GSCredentials
+from .util import CRC32C
+
+logger = logging.getLogger(__name__)
+
+class AsyncGSClient:
+    base_url = GSClient.base_url
+    upload_url = GSUploadClient.base_url
+    timeout = GSClient.timeout
+    retry_codes = frozenset({429, 500, 502, 503, 504})
+    max_retries = 5
+    backoff_factor = 1
+    max_concurrency = 100
+    upload_chunk_size = 8 * 1024 * 1024
+
+    def __init__(self, config=None, credentials=None, max_concurrency=None, **session_kwargs):
+        """
+        At most *max_concurrency* requests are in flight at once, over at most as many connections. Extra keyword
+        arguments are passed to aiohttp.ClientSession.
+        """
+        if config is None:
+            config = tweak.Config("gs", save_on_exit=False)
+        self.config = config
+        self.credentials = credentials if credentials is not None else GSCredentials(config)
+        if max_concurrency is not None:
+            self.max_concurrency = max_concurrency
+        self._session, self._semaphore = None, None
+        self._session_kwargs = session_kwargs
+
+    def get_session(self):
+        if self._session is None:
+            import aiohttp
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_concurrency),
+                headers={"User-Agent": self.__class__.__name__},
+                timeout=aiohttp.ClientTimeout(sock_connect=self.timeout, sock_read=self.timeout),
+                **self._session_kwargs
+            )
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def __aenter__(self):
+        self.get_session()
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def get_headers(self, headers=None):
+        headers = dict(headers or {})
+        token = self.credentials.get_cached_token()
+        if token is None and not self.credentials.anonymous:
+            token = await asyncio.get_event_loop().run_in_executor(None, self.credentials.get_token)
+        if token is not None:
+            headers["Authorization"] = "Bearer " + token
+        return headers
+
+    async def request(self, method, resource, base_url=None, headers=None, stream=False, **kwargs):
+        """
+        Send a request and return the aiohttp response with its body already read. With stream=True, the response is
+        returned unread and the caller must release it. Responses with a status in retry_codes are retried with
+        exponential backoff unless the request body is a stream. Raises aiohttp.ClientResponseError for error
+        responses.
+        """
+        session = self.get_session()
+        url = (base_url or self.base_url) + resource
+        retriable = not hasattr(kwargs.get("data"), "__aiter__")
+        for attempt in range(self.max_retries + 1):
+            async with self._semaphore:
+                res = await session.request(method, url, headers=await self.get_headers(headers),
+                                            allow_redirects=False, **kwargs)
+                if res.status in self.retry_codes and retriable and attempt < self.max_retries:
+                    res.release()
+                else:
+                    if res.status >= 400 or not stream:
+                        await res.read()  # Reading the body to the end releases the connection
+                    res.raise_for_status()
+                    return res
+            logger.debug("Retrying %s %s after HTTP %d", method, url, res.status)
+            await asyncio.sleep(self.backoff_factor * (2 ** attempt))
+
+    async def request_json(self, method, resource, **kwargs):
+        res = await self.request(method, resource, **kwargs)
+        body = await res.read()
+        return json.loads(body.decode()) if body else None
+
+    async def get(self, resource, **kwargs):
+        if kwargs.get("stream"):
+            return await self.request("GET", resource, **kwargs)
+        return await self.request_json("GET", resource, **kwargs)
+
+    async def post(self, resource, **kwargs):
+        return await self.request_json("POST", resource, **kwargs)
+
+    async def patch(self, resource, **kwargs):
+        return await self.request_json("PATCH", resource, **kwargs)
+
+    async def put(self, resource, **kwargs):
+        return await self.request_json("PUT", resource, **kwargs)
+
+    async def delete(self, resource, **kwargs):
+        return await self.request_json("DELETE", resource, **kwargs)
+
+    async def list(self, resource, include_prefixes=True, params=None):
+        """Asynchronously iterate over all objects (and prefixes) of a listing, following nextPageToken."""
+        params = dict(params or {})
+        while True:
+            page = await self.get(resource, params=params)
+            items = [dict(name=i) for i in page.get("prefixes", [])] if include_prefixes else []
+            items.extend(page.get("items", []))
+            for item in items:
+                yield item
+                if "maxResults" in params:
+                    params["maxResults"] -= 1
+                    if params["maxResults"] == 0:
+                        return
+            if "nextPageToken" not in page:
+                break
+            params["pageToken"] = page["nextPageToken"]
+
+    @staticmethod
+    def _object_resource(bucket, key):
+        return "b/{}/o/{}".format(requests.compat.quote(bucket, safe=""), requests.compat.quote(key, safe=""))
+
+    async def stream_media(self, bucket, key, chunk_size=1024 * 1024, generation=None):
+        """
+        Asynchronously iterate over the contents of an object in chunks. The CRC32C of the data is checked against
+        the object once the last chunk has been read.
+        """
+        params = dict(alt="media")
+        if generation is not None:
+            params["generation"] = str(generation)
+        res = await self.get(self._object_resource(bucket, key), params=params, stream=True)
+        async with res:
+            checksums = requests.utils.parse_dict_header(res.headers["X-Goog-Hash"])
+            hasher = CRC32C()
+            async for chunk in res.content.iter_chunked(chunk_size):
+                hasher.update(chunk)
+                yield chunk
+        if hasher.digest() != base64.b64decode(checksums["crc32c"]):
+            raise Exception("Download checksum mismatch in {}".format(key))
+
+    async def download(self, bucket, key, dest_filename, chunk_size=1024 * 1024, tmp_suffix=".gsdownload"):
+        """Download an object to a file, replacing the file only after the checksum has been verified."""
+        staging_filename = dest_filename + tmp_suffix
+        try:
+            with open(staging_filename, "wb") as fh:
+                async for chunk in self.stream_media(bucket, key, chunk_size=chunk_size):
+                    fh.write(chunk)
+        except BaseException:
+            if os.path.exists(staging_filename):
+                os.remove(staging_filename)
+            raise
+        os.rename(staging_filename, dest_filename)
+
+    async def upload(self, path, bucket, key, content_type=None, chunk_size=None, metadata=None):
+        """
+        Upload a file with a resumable upload session, sending it in chunks of *chunk_size* bytes (a multiple of
+        256K), and return the new object resource. The object is deleted if its MD5 does not match the file.
+        """
+        chunk_size = chunk_size or self.upload_chunk_size
+        assert chunk_size % (256 * 1024) == 0
+        upload_resource = "b/{}/o".format(requests.compat.quote(bucket, safe=""))
+        object_metadata = dict(name=key, contentType=content_type, metadata=metadata)
+        res = await self.request("POST", upload_resource, base_url=self.upload_url,
+                                 params=dict(uploadType="resumable"),
+                                 json={k: v for k, v in object_metadata.items() if v is not None})
+        upload_id = res.headers["X-GUploader-UploadID"]
+        file_size, pos, hasher = os.path.getsize(path), 0, hashlib.md5()
+        with open(path, "rb") as fh:
+            while True:
+                fh.seek(pos)
+                chunk = fh.read(chunk_size)
+                if chunk:
+                    content_range = "bytes {}-{}/{}".format(pos, pos + len(chunk) - 1, file_size)
+                else:
+                    content_range = "bytes */{}".format(file_size)
+                res = await self.request("PUT", upload_resource, base_url=self.upload_url,
+                                         params=dict(uploadType="resumable", upload_id=upload_id),
+                                         headers={"Content-Range": content_range}, data=chunk)
+                if res.status != 308:
+                    hasher.update(chunk)
+                    break
+                # The server reports how much of the upload it has persisted, which may be less than was sent
+                new_pos = int(res.headers["Range"].split("-")[1]) + 1 if "Range" in res.headers else 0
+                if new_pos == pos + len(chunk):
+                    hasher.update(chunk)
+                else:
+                    hasher = hashlib.md5()
+                    fh.seek(0)
+                    hasher.update(fh.read(new_pos))
+                pos = new_pos
+        resource = json.loads((await res.read()).decode())
+        if hasher.digest() != base64.b64decode(resource["md5Hash"]):
+            await self.delete(self._object_resource(bucket, key))
+            raise Exception("Upload checksum mismatch in {}".format(key))
+        return resource
@@ -0,0 +1,85 @@
+"""
+Persistent cache of local file checksums.
+
+Checksums are stored in a SQLite file under the gs config directory, keyed by the (device, inode) of a file and
+validated against its size and mtime (in nanoseconds), so a file is only re-read after it has been modified or replaced.
+"""
+
+import os, base64, hashlib, sqlite3, threading, logging
+
+from .util import CRC32C
+from .compression import is_gzip_encoded, uncompressed_crc32c
+from .util.compat import makedirs
+
+logger = logging.getLogger(__name__)
+
+def stat_key(st):
+    mtime_ns = getattr(st, "st_mtime_ns", None)
+    if mtime_ns is None:
+        mtime_ns = int(st.st_mtime * 1e9)
+    return st.st_dev, st.st_ino, st.st_size, mtime_ns
+
+class ChecksumCache:
+    def __init__(self, path):
+        self.path = path
+        makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            self._db.execute("CREATE TABLE IF NOT EXISTS checksums (dev INTEGER, ino INTEGER, size INTEGER, "
+                             "mtime_ns INTEGER, crc32c TEXT, md5 TEXT, PRIMARY KEY (dev, ino))")
+
+    @classmethod
+    def open(cls, client):
+        return cls(os.path.join(client.config.user_config_dir, "checksums.db"))
+
+    def get_checksums(self, filename, chunk_size=1024 * 1024, cached_only=False):
+        """
+        Return a dict with the base64-encoded CRC32C and MD5 of a file, in the format used by the crc32c and md5Hash
+        fields of object resources. The file is only read if it changed since it was last hashed; if it did and
+        *cached_only* is True, None is returned instead.
+        """
+        dev, ino, size, mtime_ns = stat_key(os.stat(filename))
+        with self._lock:
+            row = self._db.execute("SELECT size, mtime_ns, crc32c, md5 FROM checksums WHERE dev = ? AND ino = ?",
+                                   (dev, ino)).fetchone()
+        if row is not None and row[:2] == (size, mtime_ns):
+            return dict(crc32c=row[2], md5=row[3])
+        if cached_only:
+            return None
+        logger.debug("Computing checksums of %s", filename)
+        crc32c, md5 = CRC32C(), hashlib.md5()
+        with open(filename, "rb") as fh:
+            while True:
+                chunk = fh.read(chunk_size)
+                if len(chunk) == 0:
+                    break
+                crc32c.update(chunk)
+                md5.update(chunk)
+        checksums = dict(crc32c=base64.b64encode(crc32c.digest()).decode(),
+                         md5=base64.b64encode(md5.digest()).decode())
+        if stat_key(os.stat(filename)) == (dev, ino, size, mtime_ns):
+            with self._lock, self._db:
+                self._db.execute("INSERT OR REPLACE INTO checksums VALUES (?, ?, ?, ?, ?, ?)",
+                                 (dev, ino, size, mtime_ns, checksums["crc32c"], checksums["md5"]))
+        return checksums
+
+    def matches(self, filename, remote_object, cached_only=False):
+        """
+        Return True if the contents of a local file match a remote object resource, comparing CRC32C (present for all
+        objects), or MD5 if the resource has no CRC32C. For gzip-encoded objects, the checksum of the uncompressed data
+        is used if it was recorded when the object was uploaded. If *cached_only* is True, files whose checksums are
+        not cached are not read, and do not match.
+        """
+        checksums = self.get_checksums(filename, cached_only=cached_only)
+        if checksums is None:
+            return False
+        if uncompressed_crc32c(remote_object):
+            return checksums["crc32c"] == uncompressed_crc32c(remote_object)
+        if remote_object.get("md5Hash") and not is_gzip_encoded(remote_object):
+            return checksums["md5"] == remote_object["md5Hash"]
+        return False
+
+    def close(self):
+        with self._lock:
+            self._db.close()
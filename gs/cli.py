@@ -1,26 +1,75 @@
 #!/usr/bin/env python
 
-import os, sys, json, textwrap, logging, fnmatch, mimetypes, datetime, time, base64, hashlib, concurrent.futures
+import os, sys, json, textwrap, logging, fnmatch, mimetypes, time, base64, hashlib, threading, zlib
+import uuid, itertools, collections, concurrent.futures
 from argparse import Namespace
 
 import click, tweak, requests
-from dateutil.parser import parse as dateutil_parse
 
 from . import GSClient, GSUploadClient, GSBatchClient, logger
-from .util import Timestamp, CRC32C, get_file_size, format_http_errors, batches
+from .manifest import Manifest
+from .diff import walk_sorted, diff
+from .index import ObjectRecord, ObjectIndex
+from .checksum_cache import ChecksumCache
+from .upload_state import UploadStateStore
+from .throttle import TokenBucket
+from .scheduler import TransferScheduler, transfer_orders
+from .instrumentation import RequestStats, TraceWriter, PrometheusTextfileExporter
+from .compression import (GzipSelector, gzip_file_chunks, is_gzip_encoded, uncompressed_size, uncompressed_size_key,
+                          uncompressed_crc32c_key)
+from .util import (Timestamp, ByteSize, CRC32C, get_file_size, format_http_errors, batches, submit_bounded,
+                   InlineExecutor)
 from .util.compat import makedirs, cpu_count
-from .util.printing import page_output, tabulate, GREEN, BLUE, BOLD, format_number, get_progressbar
+from .util.exceptions import GSTransferError
+from .util.reader import MappedFileReader
+from .util.printing import (page_output, tabulate, GREEN, BLUE, BOLD, format_number, get_progressbar,
+                            TransferProgress, format_table_rows, format_jsonl, stream_output)
 from .version import __version__
 
+# Requests in flight are limited adaptively (see GSTransport), so thread pools only need to be large enough not to
+# be the bottleneck
+default_max_workers = max(GSClient.max_connections, cpu_count())
+
+# Shared by all uploads and downloads (see metered())
+bandwidth_limit = None
+
 @click.group()
 @click.version_option(version=__version__)
-def cli():
+@click.option("--max-request-rate", type=float, help="Send at most this many API requests per second.")
+@click.option("--max-bandwidth", type=ByteSize, metavar="BYTES",
+              help="Limit the combined rate of all uploads and downloads to this many bytes per second (e.g. 100M).")
+@click.option("--stats", is_flag=True, help="Print request counts, throughput, latency and errors on exit.")
+@click.option("--trace", type=click.Path(dir_okay=False), help="Write a JSON Lines trace of all requests to this file.")
+@click.option("--prometheus-textfile", type=click.Path(dir_okay=False),
+              help="Export request metrics to this Prometheus textfile (updated every 15 seconds and on exit).")
+@click.pass_context
+def cli(ctx, max_request_rate=None, max_bandwidth=None, stats=False, trace=None, prometheus_textfile=None):
     """
     gs is a minimalistic CLI for Google Cloud Storage.
 
     Run "gs COMMAND --help" for command-specific usage and options.
     """
+    global bandwidth_limit
     logging.basicConfig(level=logging.INFO)
+    bandwidth_limit = TokenBucket(max_bandwidth) if max_bandwidth else None
+    if max_request_rate:
+        client.transport.rate_limit = TokenBucket(max_request_rate)
+    if stats or prometheus_textfile:
+        request_stats = RequestStats()
+        if stats:
+            ctx.call_on_close(lambda: sys.stderr.write(request_stats.format_report() + "\n"))
+        if prometheus_textfile:
+            ctx.call_on_close(PrometheusTextfileExporter(prometheus_textfile, request_stats).close)
+        add_request_hook(ctx, request_stats)
+    if trace:
+        trace_writer = TraceWriter(trace)
+        ctx.call_on_close(trace_writer.close)
+        add_request_hook(ctx, trace_writer)
+
+def add_request_hook(ctx, hook):
+    """Call *hook* with the record of each request sent until the command completes (see gs.instrumentation)."""
+    client.transport.hooks.append(hook)
+    ctx.call_on_close(lambda: client.transport.hooks.remove(hook))
 
 @click.command()
 def configure():
@@ -71,13 +120,23 @@ def parse_bucket_and_prefix(path, require_gs_uri=True):
 @click.option('--max-results', type=int, help="Limit the listing to this many results from the top.")
 @click.option("--width", type=int, default=42, help="Limit table columns to this width.")
 @click.option("--json", is_flag=True, help="Print output as JSON instead of tabular format.")
+@click.option("--jsonl", is_flag=True, help="Print one JSON object per line as the listing is received.")
+@click.option("--parallel-list", is_flag=True, help="List key ranges of the bucket concurrently.")
 @format_http_errors
-def ls(path, max_results=None, width=None, json=False):
-    """List buckets or objects in a bucket/prefix."""
+def ls(path, max_results=None, width=None, json=False, jsonl=False, parallel_list=False):
+    """
+    List buckets or objects in a bucket/prefix.
+
+    Object listings are printed as they are received, with table column widths fixed from the first page of results.
+    """
     if path is None:
-        res = client.get("b", params=dict(project=client.get_project()))
         columns = ["name", "timeCreated", "updated", "location", "storageClass"]
-        page_output(tabulate(res.get("items", []), args=Namespace(columns=columns, max_col_width=width, json=json)))
+        res = client.get("b", params=dict(project=client.get_project(), fields="items({})".format(",".join(columns))))
+        args = Namespace(columns=columns, max_col_width=width, json=json)
+        if jsonl:
+            stream_output(format_jsonl(res.get("items", []), args=args))
+        else:
+            page_output(tabulate(res.get("items", []), args=args))
     else:
         bucket, prefix = parse_bucket_and_prefix(path, require_gs_uri=False)
         params = dict(delimiter="/")
@@ -87,11 +146,95 @@ def ls(path, max_results=None, width=None, json=False):
         if max_results:
             params["maxResults"] = max_results
         columns = ["name", "size", "timeCreated", "updated", "contentType", "storageClass"]
-        items = client.list("b/{}/o".format(bucket), params=params)
-        page_output(tabulate(items, args=Namespace(columns=columns, max_col_width=width, json=json)))
+        if parallel_list:
+            items = client.list_parallel("b/{}/o".format(bucket), params=params, ordered=True, fields=columns)
+        else:
+            items = client.list("b/{}/o".format(bucket), params=params, fields=columns)
+        args = Namespace(columns=columns, max_col_width=width, json=json)
+        if json:
+            page_output(tabulate(items, args=args))
+        else:
+            stream_output(format_jsonl(items, args=args) if jsonl else format_table_rows(items, args=args))
 
 cli.add_command(ls)
 
+def list_prefix_usage(bucket, prefix):
+    """Return the number and total size of the objects directly under a prefix, and the prefixes nested in it."""
+    params, count, size, prefixes = dict(delimiter="/"), 0, 0, []
+    if prefix:
+        params["prefix"] = prefix
+    # Only object sizes are requested, so prefixes are the items without one. du has no --max-results option to suggest.
+    for item in client.list("b/{}/o".format(bucket), params=params, fields=["size"], warn_paging=False):
+        if "size" in item:
+            count += 1
+            size += int(item["size"])
+        else:
+            prefixes.append(item["name"])
+    return count, size, prefixes
+
+def get_prefix_usage(bucket, prefix, depth=None, max_workers=default_max_workers):
+    """
+    Walk the "/"-delimited prefixes under *prefix* (which should be empty or end with "/"), listing them concurrently,
+    and return a dict mapping *prefix* and each prefix up to *depth* levels below it (any number if None) to a list of
+    the number and total size of the objects under it.
+    """
+    usage = {prefix: [0, 0]}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as threadpool:
+        pending = {threadpool.submit(list_prefix_usage, bucket, prefix): prefix}
+        while pending:
+            done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                listed_prefix = pending.pop(future)
+                count, size, subprefixes = future.result()
+                for subprefix in subprefixes:
+                    pending[threadpool.submit(list_prefix_usage, bucket, subprefix)] = subprefix
+                parts = listed_prefix[len(prefix):].split("/")[:-1]
+                for level in range(min(len(parts), len(parts) if depth is None else depth) + 1):
+                    totals = usage.setdefault(prefix + "".join(p + "/" for p in parts[:level]), [0, 0])
+                    totals[0] += count
+                    totals[1] += size
+    return usage
+
+@click.command()
+@click.argument('path')
+@click.option("--depth", type=int, help="Report prefixes (directories) at most this many levels below PATH.")
+@click.option("--summarize", "-s", is_flag=True, help="Report only the total for PATH (same as --depth 0).")
+@click.option("--bytes", "show_bytes", is_flag=True, help="Print sizes in bytes instead of human-readable units.")
+@click.option("--json", is_flag=True, help="Print output as JSON instead of tabular format.")
+@click.option("--max-workers", type=int, default=default_max_workers,
+              help="List this many prefixes concurrently (default: {}).".format(default_max_workers))
+@format_http_errors
+def du(path, depth=None, summarize=False, show_bytes=False, json=False, max_workers=None):
+    """
+    Show the number and total size of objects under a bucket/prefix and its prefixes (directories).
+
+    Each prefix is listed separately (requesting only object sizes), so that the tree is walked concurrently.
+    """
+    bucket, prefix = parse_bucket_and_prefix(path, require_gs_uri=False)
+    if prefix and not prefix.endswith("/"):
+        prefix += "/"
+    usage = get_prefix_usage(bucket, prefix, depth=0 if summarize else depth, max_workers=max_workers)
+    rows = [dict(prefix="gs://{}/{}".format(bucket, p), objects=count,
+                 size=size if json or show_bytes else format_number(size))
+            for p, (count, size) in sorted(usage.items())]
+    page_output(tabulate(rows, args=Namespace(columns=["prefix", "objects", "size"], max_col_width=1024, json=json)))
+
+cli.add_command(du)
+
+def metered(on_progress=None):
+    """
+    Return a progress callback for data transfers that first charges the bytes transferred to the bandwidth limit
+    (--max-bandwidth), waiting if it is exceeded, and then passes them on to *on_progress*.
+    """
+    if bandwidth_limit is None:
+        return on_progress or (lambda n: None)
+
+    def on_chunk(n):
+        bandwidth_limit.acquire(n)
+        if on_progress is not None:
+            on_progress(n)
+    return on_chunk
+
 def read_file_chunks(filename, hasher, chunk_size=1024 * 1024, progressbar=None, start_pos=0):
     if filename == "-":
         filename = "/dev/stdin"
@@ -102,7 +245,9 @@ def read_file_chunks(filename, hasher, chunk_size=1024 * 1024, progressbar=None,
                 if len(chunk) == 0:
                     break
                 hasher.update(chunk)
+        on_chunk = metered()
         chunk = fh.read(chunk_size)
+        on_chunk(len(chunk))
         yield chunk
         hasher.update(chunk)
         chunk = fh.read(chunk_size)
@@ -114,64 +259,293 @@ def read_file_chunks(filename, hasher, chunk_size=1024 * 1024, progressbar=None,
                 bar.update(chunk_size + start_pos)
                 while True:
                     bar.update(chunk_size)
+                    on_chunk(len(chunk))
                     yield chunk
                     hasher.update(chunk)
                     chunk = fh.read(chunk_size)
                     if len(chunk) == 0:
                         break
 
-def download_one_file(bucket, key, dest_filename, chunk_size=1024 * 1024, tmp_suffix=".gsdownload"):
+sliced_download_threshold = 64 * 1024 * 1024
+download_meta_fields = "size,generation,crc32c,contentEncoding"
+
+def download_slice(bucket, key, generation, staging_filename, start, end, chunk_size=1024 * 1024, on_progress=None):
+    hasher, on_progress = CRC32C(), metered(on_progress)
+    res = client.get("b/{}/o/{}".format(requests.compat.quote(bucket, safe=""), requests.compat.quote(key, safe="")),
+                     params=dict(alt="media", generation=generation),
+                     headers=dict(Range="bytes={}-{}".format(start, end)),
+                     stream=True)
+    with res, open(staging_filename, "r+b") as fh:
+        assert res.status_code == requests.codes.partial_content
+        fh.seek(start)
+        while True:
+            chunk = res.raw.read(chunk_size)
+            if len(chunk) == 0:
+                break
+            fh.write(chunk)
+            hasher.update(chunk)
+            on_progress(len(chunk))
+        if fh.tell() != end + 1:
+            raise Exception("Short read in slice {}-{} of gs://{}/{}".format(start, end, bucket, key))
+    return hasher
+
+def download_one_file_sliced(bucket, key, dest_filename, object_meta, slices, staging_filename,
+                             chunk_size=1024 * 1024):
+    size = int(object_meta["size"])
+    slice_size = -(-size // slices)
+    ranges = [(start, min(start + slice_size, size) - 1) for start in range(0, size, slice_size)]
+    logger.info("Copying gs://%s/%s to %s (%s, %d slices)", bucket, key, dest_filename, format_number(size),
+                len(ranges))
+    with open(staging_filename, "wb") as fh:
+        fh.truncate(size)
+    lock = threading.Lock()
+    try:
+        with get_progressbar(length=size, file=sys.stderr) as bar:
+            def on_progress(n):
+                with lock:
+                    bar.update(n)
+            with concurrent.futures.ThreadPoolExecutor(max_workers=len(ranges)) as threadpool:
+                futures = [threadpool.submit(download_slice, bucket, key, object_meta["generation"], staging_filename,
+                                             start, end, chunk_size=chunk_size, on_progress=on_progress)
+                           for start, end in ranges]
+                hasher = CRC32C()
+                for (start, end), future in zip(ranges, futures):
+                    hasher.combine(future.result(), end - start + 1)
+        if hasher.digest() != base64.b64decode(object_meta["crc32c"]):
+            raise Exception("Download checksum mismatch in {}".format(key))
+    except BaseException:
+        os.remove(staging_filename)
+        raise
+    os.rename(staging_filename, dest_filename)
+    os.utime(dest_filename, (time.time(), int(object_meta["generation"]) // 1000000))
+
+download_checkpoint_interval = 64 * 1024 * 1024
+
+def load_download_checkpoint(checkpoint_filename):
+    try:
+        with open(checkpoint_filename) as fh:
+            return json.load(fh)
+    except Exception:
+        return None
+
+def save_download_checkpoint(checkpoint_filename, generation, offset, hasher):
+    tmp_filename = checkpoint_filename + ".tmp"
+    with open(tmp_filename, "w") as fh:
+        json.dump(dict(generation=generation, offset=offset, crc32c=hasher.value()), fh)
+    os.rename(tmp_filename, checkpoint_filename)
+
+def resume_partial_download(staging_filename, checkpoint_filename, object_meta, chunk_size=1024 * 1024):
+    """
+    Return the position to resume a partial download from and a CRC32C of the data before it. Data covered by the
+    checkpoint sidecar is not read again; without a checkpoint, the whole staging file is hashed.
+    """
+    staged_size = get_file_size(staging_filename)
+    checkpoint = load_download_checkpoint(checkpoint_filename)
+    if checkpoint is None:
+        checkpoint = dict(generation=object_meta["generation"], offset=0, crc32c=0)
+    if checkpoint["generation"] != object_meta["generation"] or not 0 <= checkpoint["offset"] <= staged_size:
+        logger.info("Discarding partial download %s of a different object generation", staging_filename)
+        return 0, CRC32C()
+    hasher = CRC32C(initial=checkpoint["crc32c"])
+    if checkpoint["offset"] < staged_size:
+        logger.info("Checking %s of partial download %s", format_number(staged_size - checkpoint["offset"]),
+                    staging_filename)
+        with open(staging_filename, "rb") as fh:
+            fh.seek(checkpoint["offset"])
+            for chunk in iter(lambda: fh.read(chunk_size), b""):
+                hasher.update(chunk)
+    return staged_size, hasher
+
+def download_one_file(bucket, key, dest_filename, chunk_size=1024 * 1024, tmp_suffix=".gsdownload", slices=1):
     api_args = dict(bucket=bucket, key=key, dest_filename=dest_filename)
     staging_filename = "/dev/stdout" if dest_filename == "-" else dest_filename + tmp_suffix
-    hasher, checksums, req_headers, progressbar, resume_pos = None, None, {}, None, 0
+    checkpoint_filename = None if dest_filename == "-" else staging_filename + ".checkpoint"
+    hasher, checksums, params, resume_pos, generation = CRC32C(), None, dict(alt="media"), 0, None
     escaped_args = {k: requests.compat.quote(v, safe="") for k, v in api_args.items()}
-    if os.path.exists(staging_filename) and get_file_size(staging_filename) > chunk_size:
-        logger.info("Checking partial download of %s", dest_filename)
-        res = client.get("b/{bucket}/o/{key}".format(**escaped_args))
-        checksums = {"md5": res.get("md5Hash"), "crc32c": res["crc32c"]}
-        size = int(res["size"])
-        progressbar = get_progressbar(length=size, fill_char=">", file=sys.stderr)
-        hasher = hashlib.md5() if checksums.get("md5") else CRC32C()
-        for chunk in read_file_chunks(staging_filename, hasher, progressbar=progressbar):
-            resume_pos += len(chunk)
-        req_headers.update(Range="bytes={}-{}".format(resume_pos, resume_pos + size))
-        logger.info("Resuming download from %s", format_number(resume_pos))
-    with open(staging_filename, "ab" if checksums else "wb") as fh:
-        res = client.get("b/{bucket}/o/{key}".format(**escaped_args),
-                         params=dict(alt="media"),
-                         headers=req_headers,
-                         stream=True)
-        if checksums is None:
-            checksums = requests.utils.parse_dict_header(res.headers["X-Goog-Hash"])
-            size = int(res.headers["Content-Length"])
-            hasher = hashlib.md5() if checksums.get("md5") else CRC32C()
-        logger.info("Copying gs://{bucket}/{key} to {dest_filename} ({size})".format(size=format_number(size),
-                                                                                     **api_args))
-        chunk = res.raw.read(chunk_size)
-        fh.write(chunk)
-        hasher.update(chunk)
-        chunk = res.raw.read(chunk_size)
-        if len(chunk) > 0:
-            if progressbar is None:
-                progressbar = get_progressbar(length=size, file=sys.stderr)
-            else:
-                progressbar.fill_char = "#"
-            with progressbar as bar:
-                bar.update(len(chunk))
-                while True:
-                    bar.update(len(chunk))
-                    fh.write(chunk)
-                    hasher.update(chunk)
-                    chunk = res.raw.read(chunk_size)
-                    if len(chunk) == 0:
-                        break
-    assert hasher.digest() == base64.b64decode(checksums.get("md5") or checksums["crc32c"])
-    if staging_filename.endswith(tmp_suffix):
+    if slices > 1 and dest_filename != "-" and not os.path.exists(staging_filename):
+        res = client.get("b/{bucket}/o/{key}".format(**escaped_args), params=dict(fields=download_meta_fields))
+        if int(res["size"]) >= sliced_download_threshold and not is_gzip_encoded(res):
+            return download_one_file_sliced(bucket, key, dest_filename, object_meta=res, slices=slices,
+                                            staging_filename=staging_filename, chunk_size=chunk_size)
+    if checkpoint_filename and os.path.exists(staging_filename) and get_file_size(staging_filename) > chunk_size:
+        res = client.get("b/{bucket}/o/{key}".format(**escaped_args), params=dict(fields=download_meta_fields))
+        checksums, size, generation = dict(crc32c=res["crc32c"]), int(res["size"]), res["generation"]
+        if not is_gzip_encoded(res):
+            resume_pos, hasher = resume_partial_download(staging_filename, checkpoint_filename, res,
+                                                         chunk_size=chunk_size)
+        params.update(generation=generation)
+        if resume_pos > 0:
+            logger.info("Resuming download from %s", format_number(resume_pos))
+    with open(staging_filename, "ab" if resume_pos else "wb") as fh:
+        pos, checkpoint_pos = resume_pos, resume_pos
+        if checksums is None or resume_pos < size:
+            # Ask for the stored bytes of gzip-encoded objects, so that they can be checked against the object's
+            # checksums, and decompress them here
+            req_headers = {"Accept-Encoding": "gzip"}
+            if resume_pos:
+                req_headers["Range"] = "bytes={}-".format(resume_pos)
+            res = client.get("b/{bucket}/o/{key}".format(**escaped_args), params=params, headers=req_headers,
+                             stream=True)
+            if checksums is None:
+                checksums = requests.utils.parse_dict_header(res.headers["X-Goog-Hash"])
+                size, generation = int(res.headers["Content-Length"]), res.headers["X-Goog-Generation"]
+            decoder = None
+            if res.headers.get("Content-Encoding", "").lower() == "gzip":
+                decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            checkpointing = checkpoint_filename is not None and decoder is None
+            logger.info("Copying gs://{bucket}/{key} to {dest_filename} ({size})".format(size=format_number(size),
+                                                                                         **api_args))
+            with get_progressbar(length=size, file=sys.stderr, hidden=size <= chunk_size) as bar:
+                bar.update(resume_pos)
+                on_chunk = metered(bar.update)
+                try:
+                    while True:
+                        chunk = res.raw.read(chunk_size)
+                        if len(chunk) == 0:
+                            break
+                        fh.write(decoder.decompress(chunk) if decoder else chunk)
+                        hasher.update(chunk)
+                        pos += len(chunk)
+                        on_chunk(len(chunk))
+                        if checkpointing and pos - checkpoint_pos >= download_checkpoint_interval:
+                            fh.flush()
+                            save_download_checkpoint(checkpoint_filename, generation, pos, hasher)
+                            checkpoint_pos = pos
+                    if decoder is not None:
+                        fh.write(decoder.flush())
+                except BaseException:
+                    res.close()
+                    if checkpointing and pos > checkpoint_pos:
+                        fh.flush()
+                        save_download_checkpoint(checkpoint_filename, generation, pos, hasher)
+                    raise
+    if checkpoint_filename:
+        if os.path.exists(checkpoint_filename):
+            os.remove(checkpoint_filename)
+        if hasher.digest() != base64.b64decode(checksums["crc32c"]):
+            os.remove(staging_filename)
+            raise Exception("Download checksum mismatch in {}".format(key))
         os.rename(staging_filename, dest_filename)
-        os.utime(dest_filename, (time.time(), int(res.headers["X-Goog-Generation"]) // 1000000))
+        os.utime(dest_filename, (time.time(), int(generation) // 1000000))
+    else:
+        assert hasher.digest() == base64.b64decode(checksums["crc32c"])
+
+parallel_upload_threshold = 64 * 1024 * 1024
+upload_block_size = 16 * 1024 * 1024
+max_compose_sources = 32
+
+def upload_part(path, dest_bucket, part_key, start, length, chunk_size=1024 * 1024, on_progress=None):
+    hasher = CRC32C()
+    with MappedFileReader(path, hasher, start=start, length=length, block_size=max(chunk_size, upload_block_size),
+                          on_progress=metered(on_progress)) as reader:
+        res = upload_client.post("b/{bucket}/o".format(bucket=requests.compat.quote(dest_bucket)),
+                                 params=dict(uploadType="media", name=part_key),
+                                 headers={"Content-Type": "application/octet-stream"},
+                                 data=reader)
+    if hasher.digest() != base64.b64decode(res["crc32c"]):
+        raise Exception("Upload checksum mismatch in {}".format(part_key))
+    return res, hasher
+
+def compose_objects(bucket, sources, dest_key, destination=None):
+    api_method = "b/{}/o/{}/compose".format(requests.compat.quote(bucket), requests.compat.quote(dest_key, safe=""))
+    return client.post(api_method,
+                       json=dict(sourceObjects=[dict(name=i["name"], generation=i["generation"]) for i in sources],
+                                 destination=destination or {}))
+
+def delete_objects(bucket, keys):
+    if len(keys) == 1:
+        return client.delete("b/{}/o/{}".format(requests.compat.quote(bucket), requests.compat.quote(keys[0], safe="")))
+    for batch in batches(keys, batch_size=100):
+        batch_client.post_batch([
+            requests.Request(method="DELETE",
+                             url="b/{bucket}/o/{key}".format(bucket=requests.compat.quote(bucket),
+                                                             key=requests.compat.quote(key, safe="")))
+            for key in batch
+        ])
+
+def upload_one_file_composite(path, dest_bucket, dest_key, file_size, parts, destination, chunk_size=1024 * 1024):
+    part_size = -(-file_size // parts)
+    ranges = [(start, min(part_size, file_size - start)) for start in range(0, file_size, part_size)]
+    tmp_prefix = "{}.gscompose-{}".format(dest_key, uuid.uuid4().hex)
+    tmp_keys, lock = [], threading.Lock()
+    logger.info("Uploading %s as %d parts (%s)", path, len(ranges), format_number(file_size))
+    try:
+        with get_progressbar(length=file_size, file=sys.stderr) as bar:
+            def on_progress(n):
+                with lock:
+                    bar.update(n)
+            with concurrent.futures.ThreadPoolExecutor(max_workers=len(ranges)) as threadpool:
+                futures = []
+                for i, (start, length) in enumerate(ranges):
+                    tmp_keys.append("{}-{}".format(tmp_prefix, i))
+                    futures.append(threadpool.submit(upload_part, path, dest_bucket, tmp_keys[-1], start, length,
+                                                     chunk_size=chunk_size, on_progress=on_progress))
+                hasher, components = CRC32C(), []
+                for (start, length), future in zip(ranges, futures):
+                    part, part_hasher = future.result()
+                    hasher.combine(part_hasher, length)
+                    components.append(part)
+                level = 0
+                while len(components) > max_compose_sources:
+                    futures = []
+                    for i, batch in enumerate(batches(components, batch_size=max_compose_sources)):
+                        tmp_keys.append("{}-c{}-{}".format(tmp_prefix, level, i))
+                        futures.append(threadpool.submit(compose_objects, dest_bucket, batch, tmp_keys[-1]))
+                    components = [future.result() for future in futures]
+                    level += 1
+        res = compose_objects(dest_bucket, components, dest_key, destination=destination)
+        if hasher.digest() != base64.b64decode(res["crc32c"]):
+            client.delete("b/{bucket}/o/{key}".format(bucket=requests.compat.quote(dest_bucket),
+                                                      key=requests.compat.quote(dest_key, safe="")))
+            raise Exception("Upload checksum mismatch in {}".format(dest_key))
+    finally:
+        try:
+            delete_objects(dest_bucket, tmp_keys)
+        except Exception as e:
+            logger.warn("Error deleting temporary upload parts %s*: %s", tmp_prefix, e)
+    return res
+
+_upload_state, _upload_state_lock = None, threading.Lock()
+
+def get_upload_state():
+    global _upload_state
+    with _upload_state_lock:
+        if _upload_state is None:
+            _upload_state = UploadStateStore.open(client)
+        return _upload_state
+
+def upload_one_file_gzip(path, dest_bucket, dest_key, content_type=None, metadata=None, chunk_size=1024 * 1024,
+                         **patch_fields):
+    hasher, uncompressed_hasher, bytes_read = hashlib.md5(), CRC32C(), [0]
+    file_size = get_file_size(path)
+    with get_progressbar(length=file_size, hidden=file_size <= chunk_size) as bar:
+        def on_progress(n):
+            bytes_read[0] += n
+            bar.update(n)
+        res = upload_client.post("b/{bucket}/o".format(bucket=requests.compat.quote(dest_bucket)),
+                                 params=dict(uploadType="media", name=dest_key, contentEncoding="gzip"),
+                                 headers={"Content-Type": content_type} if content_type else {},
+                                 data=gzip_file_chunks(path, hasher, uncompressed_hasher, chunk_size=chunk_size,
+                                                       on_progress=metered(on_progress)))
+    object_url = "b/{bucket}/o/{key}".format(bucket=requests.compat.quote(dest_bucket),
+                                             key=requests.compat.quote(dest_key, safe=""))
+    if hasher.digest() != base64.b64decode(res["md5Hash"]):
+        client.delete(object_url)
+        raise Exception("Upload checksum mismatch in {}".format(dest_key))
+    logger.debug("Compressed %s from %s to %s", path, format_number(bytes_read[0]), format_number(int(res["size"])))
+    metadata = dict(metadata or {})
+    metadata[uncompressed_size_key] = str(bytes_read[0])
+    metadata[uncompressed_crc32c_key] = base64.b64encode(uncompressed_hasher.digest()).decode()
+    patch_fields = {k: v for k, v in patch_fields.items() if v is not None}
+    return client.patch(object_url, json=dict(patch_fields, metadata=metadata))
 
 def upload_one_file(path, dest_bucket, dest_key, chunk_size=1024 * 1024, content_type=None, content_encoding=None,
-                    content_disposition=None, content_language=None, cache_control=None, metadata=None):
+                    content_disposition=None, content_language=None, cache_control=None, metadata=None, parts=1,
+                    gzip=False):
+    """
+    If *gzip* is True, the file is compressed in transit and stored with Content-Encoding: gzip, unless it is already
+    compressed.
+    """
     logger.info("Copying {path} to gs://{bucket}/{key}".format(path=path, bucket=dest_bucket, key=dest_key))
     headers, upload_id, resume_pos = {}, None, 0
     if content_type is None and content_encoding is None:
@@ -180,73 +554,106 @@ def upload_one_file(path, dest_bucket, dest_key, chunk_size=1024 * 1024, content
         headers["Content-Type"] = content_type
     hasher = hashlib.md5()
     file_size = get_file_size(path)
+    if gzip and content_encoding is None and os.path.isfile(path):
+        return upload_one_file_gzip(path, dest_bucket, dest_key, content_type=content_type, metadata=metadata,
+                                    chunk_size=chunk_size, contentDisposition=content_disposition,
+                                    contentLanguage=content_language, cacheControl=cache_control)
+    if parts > 1 and file_size >= parallel_upload_threshold:
+        destination = dict(contentType=content_type, contentEncoding=content_encoding,
+                           contentDisposition=content_disposition, contentLanguage=content_language,
+                           cacheControl=cache_control, metadata=dict(metadata) if metadata else None)
+        return upload_one_file_composite(path, dest_bucket, dest_key, file_size=file_size, parts=parts,
+                                         destination={k: v for k, v in destination.items() if v is not None},
+                                         chunk_size=chunk_size)
     if file_size > chunk_size:
-        cache_key_data = path + str(file_size) + dest_bucket + dest_key
-        cache_key = base64.b64encode(hashlib.md5(cache_key_data.encode()).digest()).decode()
-        client.config.setdefault("uploads", {})
-        if cache_key in client.config.uploads:
-            upload_id = client.config.uploads[cache_key]["u"]
+        upload_state = get_upload_state()
+        state_key = upload_state.make_key(path, dest_bucket, dest_key)
+        upload_id = upload_state.get(state_key)
+        if upload_id is not None:
             try:
                 res = upload_client.put("b/{bucket}/o".format(bucket=requests.compat.quote(dest_bucket)),
                                         headers={"Content-Length": "0", "Content-Range": "bytes */" + str(file_size)},
                                         params=dict(uploadType="resumable", upload_id=upload_id),
                                         stream=True)
+                res.close()
                 assert res.status_code == 308
                 start, end = requests.utils.parse_dict_header(res.headers["Range"])["bytes"].split("-")
                 assert start == "0"
                 resume_pos = int(end) + 1
                 headers["Content-Range"] = "bytes {}-{}/{}".format(resume_pos, file_size - 1, file_size)
                 logger.info("Resuming upload from %s", format_number(resume_pos))
-            except (requests.exceptions.HTTPError, AssertionError):
+            except (requests.exceptions.HTTPError, AssertionError, KeyError):
                 upload_id = None
         if upload_id is None:
             res = upload_client.post("b/{bucket}/o".format(bucket=requests.compat.quote(dest_bucket)),
                                      params=dict(uploadType="resumable"),
                                      json=dict(name=dest_key),
                                      stream=True)
+            res.close()
             upload_id = res.headers["X-GUploader-UploadID"]
-            # TODO: admit more than one entry into the upload id cache
-            # if len(client.config.uploads) > cache_size:
-            #     sorted_uids = sorted(client.config.uploads, key=lambda i: client.config.uploads[i]["t"])
-            #     client.config.uploads = {k: client.config.uploads[k] for k in sorted_uids[:cache_size]}
-            client.config.uploads = {}
-            client.config.uploads[cache_key] = dict(u=upload_id, t=int(time.time()))
             try:
-                client.config.save()
+                upload_state.put(state_key, upload_id)
             except Exception as e:
-                logger.warn("Error saving upload state to local config: %s. Upload is not resumable.", e)
+                logger.warn("Error saving upload state to %s: %s. Upload is not resumable.", upload_state.path, e)
         params = dict(uploadType="resumable", upload_id=upload_id)
     else:
         params = dict(uploadType="media", name=dest_key)
-    res = upload_client.post("b/{bucket}/o".format(bucket=requests.compat.quote(dest_bucket)),
-                             params=params,
-                             headers=headers,
-                             data=read_file_chunks(path, hasher, chunk_size=chunk_size, start_pos=resume_pos))
+    if os.path.isfile(path):
+        with get_progressbar(length=file_size, hidden=file_size <= chunk_size) as bar:
+            bar.update(resume_pos)
+            with MappedFileReader(path, hasher, start=resume_pos, hash_from=0, block_size=upload_block_size,
+                                  on_progress=metered(bar.update)) as reader:
+                res = upload_client.post("b/{bucket}/o".format(bucket=requests.compat.quote(dest_bucket)),
+                                         params=params, headers=headers, data=reader)
+    else:
+        res = upload_client.post("b/{bucket}/o".format(bucket=requests.compat.quote(dest_bucket)),
+                                 params=params,
+                                 headers=headers,
+                                 data=read_file_chunks(path, hasher, chunk_size=chunk_size, start_pos=resume_pos))
+    if "upload_id" in params:
+        upload_state.remove(state_key)
     if hasher.digest() != base64.b64decode(res["md5Hash"]):
         client.delete("b/{bucket}/o/{key}".format(bucket=requests.compat.quote(dest_bucket),
                                                   key=requests.compat.quote(dest_key, safe="")))
         raise Exception("Upload checksum mismatch in {}".format(dest_key))
     if metadata or content_disposition or content_encoding or content_language or cache_control:
-        client.patch("b/{bucket}/o/{key}".format(bucket=requests.compat.quote(dest_bucket),
-                                                 key=requests.compat.quote(dest_key, safe="")),
-                     json=dict(metadata=dict(metadata), contentDisposition=content_disposition,
-                               contentEncoding=content_encoding, contentLanguage=content_language,
-                               cacheControl=cache_control))
-
-def copy_one_remote(**api_args):
-    api_method_template = "b/{source_bucket}/o/{source_key}/copyTo/b/{dest_bucket}/o/{dest_key}"
+        res = client.patch("b/{bucket}/o/{key}".format(bucket=requests.compat.quote(dest_bucket),
+                                                       key=requests.compat.quote(dest_key, safe="")),
+                           json=dict(metadata=dict(metadata), contentDisposition=content_disposition,
+                                     contentEncoding=content_encoding, contentLanguage=content_language,
+                                     cacheControl=cache_control))
+    return res
+
+rewrite_timeout = 120
+
+def copy_one_remote(max_bytes_per_call=None, **api_args):
+    """
+    Copy an object with the rewrite API, which copies large objects (or objects moving between locations or storage
+    classes) over a series of calls, each continuing from the rewriteToken returned by the previous one. Returns the
+    new object resource.
+    """
+    api_method_template = "b/{source_bucket}/o/{source_key}/rewriteTo/b/{dest_bucket}/o/{dest_key}"
     logger.info("Copying gs://{source_bucket}/{source_key} to gs://{dest_bucket}/{dest_key}".format(**api_args))
     escaped_args = {k: requests.compat.quote(v, safe="") for k, v in api_args.items()}
-    return client.post(api_method_template.format(**escaped_args))
+    params = dict(maxBytesRewrittenPerCall=str(max_bytes_per_call)) if max_bytes_per_call else {}
+    while True:
+        res = client.post(api_method_template.format(**escaped_args), params=params, timeout=rewrite_timeout)
+        if res["done"]:
+            return res["resource"]
+        logger.debug("Copied %s of %s of gs://%s/%s", format_number(int(res["totalBytesRewritten"])),
+                     format_number(int(res["objectSize"])), api_args["source_bucket"], api_args["source_key"])
+        params["rewriteToken"] = res["rewriteToken"]
 
 def expand_trailing_glob(bucket, prefix):
+    """Yield (bucket, ObjectRecord) for each object matching a prefix that may end with *."""
     if prefix.endswith("*"):
         list_params = dict(delimiter="/", prefix=prefix.rstrip("*"))
-        for item in client.list("b/{}/o".format(bucket), params=list_params, include_prefixes=False):
+        for item in client.list("b/{}/o".format(bucket), params=list_params, include_prefixes=False,
+                                fields=["name", "size"]):
             assert ".." not in item["name"].split("/")
-            yield bucket, item
+            yield bucket, ObjectRecord.from_resource(item)
     else:
-        yield bucket, dict(name=prefix)
+        yield bucket, ObjectRecord(prefix)
 
 @click.command()
 @click.argument('paths', nargs=-1, required=True)
@@ -257,8 +664,26 @@ def expand_trailing_glob(bucket, prefix):
 @click.option('--cache-control', help="Set the Cache-Control header to this value.")
 @click.option('--metadata', multiple=True, metavar="KEY=VALUE", type=lambda x: x.split("=", 1),
               help="Set metadata on destination object(s) (can be specified multiple times).")
+@click.option("--download-slices", type=int, default=1,
+              help="Download objects of 64M or more as this many parallel byte-range slices (default: 1, disabled).")
+@click.option("--upload-parts", type=int, default=1,
+              help="Upload files of 64M or more as this many parallel parts composed into one object (default: 1, "
+                   "disabled).")
+@click.option("--gzip", "gzip_patterns", multiple=True, metavar="PATTERN",
+              help="Compress files matching this extension or glob pattern (e.g. csv, '*.json') with gzip when "
+                   "uploading, and store them with Content-Encoding: gzip. Can be repeated or comma-separated.")
+@click.option("--max-workers", type=int, default=default_max_workers,
+              help="Copy up to this many files or objects at once (default: {}).".format(default_max_workers))
+@click.option("--rewrite-bytes-per-call", type=int,
+              help="When copying between buckets, copy at most this many bytes (a multiple of 1048576) per rewrite "
+                   "API call.")
+@click.option("--transfer-order", type=click.Choice(transfer_orders), default="fifo",
+              help="Start transfers in this order: as listed (fifo, the default), largest-first (to finish sooner "
+                   "when a few files are much larger than the rest) or smallest-first (to complete the most files "
+                   "soonest).")
 @format_http_errors
-def cp(paths, **upload_metadata_kwargs):
+def cp(paths, download_slices=1, upload_parts=1, gzip_patterns=(), max_workers=None, rewrite_bytes_per_call=None,
+       transfer_order="fifo", **upload_metadata_kwargs):
     """
     Copy files to, from, or between buckets. Examples:
 
@@ -275,53 +700,202 @@ def cp(paths, **upload_metadata_kwargs):
       gs cp gs://my-bucket/my-file.json - | jq .
 
     Wildcard globs (*) are supported only at the end of gs:// paths.
+
+    Objects stored with Content-Encoding: gzip are decompressed when downloaded.
     """
+    try:
+        copy_paths(paths, max_workers=max_workers, download_slices=download_slices, upload_parts=upload_parts,
+                   gzip_patterns=gzip_patterns, rewrite_bytes_per_call=rewrite_bytes_per_call,
+                   transfer_order=transfer_order, **upload_metadata_kwargs)
+    except GSTransferError as e:
+        exit(str(e))
+
+cli.add_command(cp)
+
+def transfer_size(transfer, result):
+    if isinstance(result, dict) and "size" in result:
+        return int(result["size"])
+    if transfer.get("dest_filename", "-") != "-":
+        return max(get_file_size(transfer["dest_filename"]), 0)
+    return 0
+
+# Number of pending transfers that size-ordered scheduling chooses from
+transfer_lookahead = 10000
+
+# Returned by a transfer function that found nothing to transfer
+transfer_skipped = object()
+
+def run_transfers(fn, transfers, max_workers, on_success=None, verb="Copied", order="fifo", size_hint=None):
+    """
+    Call fn(**transfer) for each dict in the iterable *transfers*, from a pool of *max_workers* threads, and call
+    on_success(transfer, result) on the main thread as each one succeeds. A failed transfer does not stop the others:
+    failures are logged as they occur and raised together as GSTransferError at the end. A single transfer (or any
+    number of transfers with max_workers=1) runs on the calling thread, with its own progress bar. The error of a
+    single transfer is raised directly. Transfers for which fn returns transfer_skipped are not counted as transferred,
+    and on_success is not called for them.
+
+    Transfers are started in *order* (see TransferScheduler), by the sizes given by size_hint(transfer), among the
+    next transfer_lookahead transfers.
+    """
+    transfers = iter(transfers)
+    first_two = list(itertools.islice(transfers, 2))
+    if len(first_two) == 1:
+        result = fn(**first_two[0])
+        if on_success is not None and result is not transfer_skipped:
+            on_success(first_two[0], result)
+        return
+    progress, errors = TransferProgress(verb=verb), []
+    try:
+        if max_workers > 1:
+            executor = TransferScheduler(max_workers=max_workers, order=order)
+        else:
+            executor, order = InlineExecutor(), "fifo"
+        with executor as threadpool:
+            def submit(transfer):
+                if order == "fifo":
+                    return threadpool.submit(fn, **transfer)
+                return threadpool.schedule(fn, kwargs=transfer, size=size_hint(transfer) if size_hint else 0)
+            window = max_workers * 4 if order == "fifo" else max(max_workers * 4, transfer_lookahead)
+            for transfer, future in submit_bounded(submit, itertools.chain(first_two, transfers), window):
+                if future.exception() is not None:
+                    logger.error("%s failed: %s", describe_transfer(transfer), future.exception())
+                    errors.append((transfer, future.exception()))
+                    progress.update(failed=True)
+                    continue
+                if future.result() is transfer_skipped:
+                    continue
+                if on_success is not None:
+                    on_success(transfer, future.result())
+                progress.update(transfer_size(transfer, future.result()))
+    finally:
+        progress.close()
+    logger.info(progress.format())
+    if errors:
+        raise GSTransferError("{} of {} transfers failed".format(len(errors), len(errors) + progress.count), errors)
+
+def describe_transfer(transfer):
+    if "delete_keys" in transfer:
+        return "Deletion of {} objects from gs://{}".format(len(transfer["delete_keys"]), transfer["bucket"])
+    if "source_key" in transfer:
+        return "Copy of gs://{source_bucket}/{source_key} to gs://{dest_bucket}/{dest_key}".format(**transfer)
+    if "dest_filename" in transfer:
+        return "Download of gs://{bucket}/{key} to {dest_filename}".format(**transfer)
+    return "Upload of {path} to gs://{dest_bucket}/{dest_key}".format(**transfer)
+
+def copy_paths(paths, max_workers, download_slices=1, upload_parts=1, gzip_patterns=(), rewrite_bytes_per_call=None,
+               on_success=None, verb="Copied", transfer_order="fifo", **upload_metadata_kwargs):
     assert len(paths) >= 2
+    gzip_selector = GzipSelector(gzip_patterns)
+    listed_objects = collections.defaultdict(ObjectIndex)  # Listed source objects that have not been scheduled yet
     paths = [os.path.expanduser(p) for p in paths]
-    if all(p.startswith("gs://") for p in paths):
+    if "-" in paths:
+        max_workers = 1  # Standard input and output can only be used by one transfer at a time
+
+    def remote_copies():
         dest_bucket, dest_prefix = parse_bucket_and_prefix(paths[-1])
         for path in paths[:-1]:
             for source_bucket, item in expand_trailing_glob(*parse_bucket_and_prefix(path)):
-                source_key, dest_key = item["name"], dest_prefix
+                source_key, dest_key = item.name, dest_prefix
+                if transfer_order != "fifo":
+                    listed_objects[source_bucket].add(item)
                 # TODO: check if dest_prefix is a prefix on the remote
                 if dest_prefix.endswith("/") or path.endswith("*") or len(paths) > 2:
                     dest_key = os.path.join(dest_prefix, os.path.basename(source_key))
-                copy_one_remote(source_bucket=source_bucket, source_key=source_key,
-                                dest_bucket=dest_bucket, dest_key=dest_key)
-    elif all(p.startswith("gs://") for p in paths[:-1]) and not paths[-1].startswith("gs://"):
+                yield dict(source_bucket=source_bucket, source_key=source_key, dest_bucket=dest_bucket,
+                           dest_key=dest_key, max_bytes_per_call=rewrite_bytes_per_call)
+
+    def downloads():
         for path in paths[:-1]:
             for source_bucket, item in expand_trailing_glob(*parse_bucket_and_prefix(path)):
+                if transfer_order != "fifo":
+                    listed_objects[source_bucket].add(item)
                 dest_filename = paths[-1]
                 if os.path.isdir(dest_filename) or len(paths) > 2:
-                    dest_filename = os.path.join(dest_filename, os.path.basename(item["name"]))
-                download_one_file(bucket=source_bucket, key=item["name"], dest_filename=dest_filename)
-    elif paths[-1].startswith("gs://") and not any(p.startswith("gs://") for p in paths[0:-1]):
+                    dest_filename = os.path.join(dest_filename, os.path.basename(item.name))
+                yield dict(bucket=source_bucket, key=item.name, dest_filename=dest_filename, slices=download_slices)
+
+    def uploads():
+        dest_bucket, dest_prefix = parse_bucket_and_prefix(paths[-1])
         for path in paths[:-1]:
             if path.endswith(".gsdownload"):
                 logger.info("Skipping partial download file %s", path)
                 continue
-            dest_bucket, dest_prefix = parse_bucket_and_prefix(paths[-1])
             dest_key = dest_prefix
             # TODO: check if dest_prefix is a prefix on the remote
             if dest_prefix == "" or dest_prefix.endswith("/") or len(paths) > 2:
                 dest_key = os.path.join(dest_prefix, os.path.basename(path))
-            upload_one_file(path, dest_bucket, dest_key, **upload_metadata_kwargs)
+            yield dict(upload_metadata_kwargs, path=path, dest_bucket=dest_bucket, dest_key=dest_key,
+                       parts=upload_parts, gzip=gzip_selector.matches(path))
+
+    def size_hint(transfer):
+        if "path" in transfer:
+            return max(get_file_size(transfer["path"]), 0)
+        record = listed_objects[transfer.get("source_bucket", transfer.get("bucket"))].pop(
+            transfer.get("source_key", transfer.get("key")))
+        return (record.size or 0) if record is not None else 0
+
+    if all(p.startswith("gs://") for p in paths):
+        fn, transfers = copy_one_remote, remote_copies()
+    elif all(p.startswith("gs://") for p in paths[:-1]) and not paths[-1].startswith("gs://"):
+        fn, transfers = download_one_file, downloads()
+    elif paths[-1].startswith("gs://") and not any(p.startswith("gs://") for p in paths[0:-1]):
+        fn, transfers = upload_one_file, uploads()
     else:
         raise click.BadParameter("paths")
+    run_transfers(fn, transfers, max_workers=max_workers, on_success=on_success, verb=verb, order=transfer_order,
+                  size_hint=size_hint)
 
-cli.add_command(cp)
+class SourceDeleter(object):
+    """Deletes the sources of completed moves: local files immediately, and objects in batches."""
+    def __init__(self, batch_size=100):
+        self.batch_size, self.pending, self.num_deleted = batch_size, {}, 0
+
+    def __call__(self, transfer, result):
+        if "path" in transfer:
+            if transfer["path"] != "-":
+                os.remove(transfer["path"])
+                self.num_deleted += 1
+            return
+        bucket = transfer.get("source_bucket", transfer.get("bucket"))
+        self.pending.setdefault(bucket, []).append(transfer.get("source_key", transfer.get("key")))
+        if len(self.pending[bucket]) >= self.batch_size:
+            self.flush(bucket)
+
+    def flush(self, bucket=None):
+        for bucket in [bucket] if bucket else list(self.pending):
+            keys = self.pending.pop(bucket, [])
+            if keys:
+                logger.info("Deleting %d moved objects from gs://%s", len(keys), bucket)
+                delete_objects(bucket, keys)
+                self.num_deleted += len(keys)
 
 @click.command()
 @click.argument('paths', nargs=-1, required=True)
+@click.option("--max-workers", type=int, default=default_max_workers,
+              help="Move up to this many files or objects at once (default: {}).".format(default_max_workers))
+@click.option("--transfer-order", type=click.Choice(transfer_orders), default="fifo",
+              help="Start transfers in this order: as listed (fifo, the default), largest-first (to finish sooner "
+                   "when a few files are much larger than the rest) or smallest-first (to complete the most files "
+                   "soonest).")
 @format_http_errors
-def mv(paths):
-    """Move files to, from, or between buckets."""
-    cp.main(paths, standalone_mode=False)
-    rm.main(paths[:-1], standalone_mode=False)
+def mv(paths, max_workers=None, transfer_order="fifo"):
+    """
+    Move files to, from, or between buckets. Each source is deleted once it has been copied; sources in buckets are
+    deleted in batches.
+    """
+    deleter = SourceDeleter()
+    try:
+        copy_paths(paths, max_workers=max_workers, on_success=deleter, verb="Moved", transfer_order=transfer_order)
+    except GSTransferError as e:
+        exit(str(e))
+    finally:
+        deleter.flush()
+    print("Done. {} objects moved.".format(deleter.num_deleted))
 
 cli.add_command(mv)
 
-def batch_delete_prefix(bucket, prefix, max_workers, dryrun=False, recurse_into_dirs=True, require_separator="/"):
+def list_prefix(bucket, prefix, recurse_into_dirs=True, require_separator="/", parallel=False, max_workers=None,
+                fields=("name",)):
     list_params = dict()
     if prefix and require_separator and not prefix.endswith(require_separator):
         prefix += require_separator
@@ -330,32 +904,48 @@ def batch_delete_prefix(bucket, prefix, max_workers, dryrun=False, recurse_into_
         prefix = prefix.rstrip("*")
     if prefix:
         list_params["prefix"] = prefix
-    items = client.list("b/{}/o".format(bucket), params=list_params, include_prefixes=False)
-    futures, total = [], 0
-    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as threadpool:
-        for batch in batches(items, batch_size=100):
-            action = "Would delete" if dryrun else "Deleting"
-            logger.info("%s batch of %d objects in gs://%s/%s", action, len(batch), bucket, prefix)
-            futures.append(threadpool.submit(batch_client.post_batch, [
-                requests.Request(method="DELETE",
-                                 url="b/{bucket}/o/{key}".format(bucket=requests.compat.quote(bucket),
-                                                                 key=requests.compat.quote(obj_desc["name"], safe="")),
-                                 params=dict(ifGenerationMatch="0") if dryrun else dict())
-                for obj_desc in batch
-            ], expect_codes=[requests.codes.precondition_failed] if dryrun else None))
-        for future in futures:
-            total += len(future.result())
+    if parallel:
+        return prefix, client.list_parallel("b/{}/o".format(bucket), params=list_params, include_prefixes=False,
+                                            max_workers=max_workers, fields=fields)
+    return prefix, client.list("b/{}/o".format(bucket), params=list_params, include_prefixes=False, fields=fields)
+
+def batch_delete_objects(bucket, names, max_workers, dryrun=False, description=None, missing_ok=False):
+    """
+    Delete the objects named by the iterable *names* with batch requests. Returns the number of objects deleted. With
+    missing_ok=True, objects that do not exist are counted as deleted instead of failing the batch.
+    """
+    subrequests = (batch_client.subrequest("DELETE",
+                                           "b/{bucket}/o/{key}".format(bucket=requests.compat.quote(bucket),
+                                                                       key=requests.compat.quote(name, safe="")),
+                                           params=dict(ifGenerationMatch="0") if dryrun else None)
+                   for name in names)
+    expect_codes = [requests.codes.precondition_failed] if dryrun else None
+    if missing_ok:
+        expect_codes = (expect_codes or [requests.codes.ok, requests.codes.no_content]) + [requests.codes.not_found]
+    total = 0
+    for batch, responses in batch_client.post_batches(subrequests, max_workers=max_workers, expect_codes=expect_codes):
+        logger.info("%s batch of %d objects in gs://%s/%s", "Would delete" if dryrun else "Deleted", len(batch), bucket,
+                    description or "")
+        total += len(responses)
     return total
 
+def batch_delete_prefix(bucket, prefix, max_workers, dryrun=False, recurse_into_dirs=True, require_separator="/",
+                        parallel_list=False):
+    prefix, items = list_prefix(bucket, prefix, recurse_into_dirs=recurse_into_dirs,
+                                require_separator=require_separator, parallel=parallel_list, max_workers=max_workers)
+    return batch_delete_objects(bucket, (i["name"] for i in items), max_workers=max_workers, dryrun=dryrun,
+                                description=prefix)
+
 @click.command()
 @click.argument('paths', nargs=-1, required=True)
 @click.option("--recursive", is_flag=True,
               help="If a given path is a directory (prefix), delete all objects sharing that prefix.")
-@click.option("--max-workers", type=int, default=cpu_count(),
-              help="Limit batch delete concurrency to this many threads (default: number of CPU cores detected)")
+@click.option("--max-workers", type=int, default=default_max_workers,
+              help="Limit batch delete concurrency to this many threads (default: {})".format(default_max_workers))
 @click.option("--dryrun", is_flag=True, help="List the operations that would run without actually running them.")
+@click.option("--parallel-list", is_flag=True, help="List prefixes or key ranges concurrently for batch deletes.")
 @format_http_errors
-def rm(paths, recursive=False, max_workers=None, dryrun=False):
+def rm(paths, recursive=False, max_workers=None, dryrun=False, parallel_list=False):
     """
     Delete objects (files) from buckets.
 
@@ -377,10 +967,12 @@ def rm(paths, recursive=False, max_workers=None, dryrun=False):
                 num_deleted += 1
             elif e.response is not None and e.response.status_code == requests.codes.not_found:
                 if recursive:
-                    num_deleted += batch_delete_prefix(bucket, prefix, max_workers=max_workers, dryrun=dryrun)
+                    num_deleted += batch_delete_prefix(bucket, prefix, max_workers=max_workers, dryrun=dryrun,
+                                                       parallel_list=parallel_list)
                 elif prefix.endswith("*"):
                     num_deleted += batch_delete_prefix(bucket, prefix, max_workers=max_workers, dryrun=dryrun,
-                                                       recurse_into_dirs=False, require_separator=None)
+                                                       recurse_into_dirs=False, require_separator=None,
+                                                       parallel_list=parallel_list)
                 else:
                     msg = '{}. To recursively delete directories (prefixes), use "gs rm --recursive PATH".'
                     raise Exception(msg.format(e.response.json()["error"]["message"]))
@@ -389,62 +981,246 @@ def rm(paths, recursive=False, max_workers=None, dryrun=False):
     print("Done. {} objects {}deleted.".format(num_deleted, "would be " if dryrun else ""))
 cli.add_command(rm)
 
+@click.command()
+@click.argument('paths', nargs=-1, required=True)
+@click.option("--recursive", is_flag=True,
+              help="If a given path is a directory (prefix), update all objects sharing that prefix.")
+@click.option('--content-type', help="Set the content type to this value.")
+@click.option('--content-encoding', help="Set the Content-Encoding header to this value.")
+@click.option('--content-language', help="Set the Content-Language header to this value.")
+@click.option('--content-disposition', help="Set the Content-Disposition header to this value.")
+@click.option('--cache-control', help="Set the Cache-Control header to this value.")
+@click.option('--metadata', multiple=True, metavar="KEY=VALUE", type=lambda x: x.split("=", 1),
+              help="Set metadata on the object(s) (can be specified multiple times).")
+@click.option("--max-workers", type=int, default=default_max_workers,
+              help="Limit batch request concurrency to this many threads (default: {})".format(default_max_workers))
+@format_http_errors
+def setmeta(paths, recursive=False, max_workers=None, content_type=None, content_encoding=None, content_language=None,
+            content_disposition=None, cache_control=None, metadata=None):
+    """
+    Update metadata of objects in place, 100 objects per batch request. Examples:
+
+      gs setmeta gs://my-bucket/my-prefix/ --recursive --cache-control "public, max-age=3600"
+
+      gs setmeta gs://my-bucket/my-prefix/*.json --content-type application/json
+
+    Paths containing wildcards (*) are matched against object names using shell-style globbing.
+    """
+    if not all(p.startswith("gs://") for p in paths):
+        raise click.BadParameter("All paths must start with gs://")
+    patch = dict(contentType=content_type, contentEncoding=content_encoding, contentLanguage=content_language,
+                 contentDisposition=content_disposition, cacheControl=cache_control,
+                 metadata=dict(metadata) if metadata else None)
+    patch = {k: v for k, v in patch.items() if v is not None}
+    if not patch:
+        raise click.UsageError("No metadata changes were specified")
+    num_updated, num_failed = 0, 0
+    for path in paths:
+        bucket, prefix = parse_bucket_and_prefix(path)
+        if recursive:
+            prefix, items = list_prefix(bucket, prefix)
+        elif "*" in prefix:
+            glob = prefix
+            prefix, items = list_prefix(bucket, prefix.split("*", 1)[0], recurse_into_dirs="/" in glob.split("*", 1)[1],
+                                        require_separator=None)
+            items = (i for i in items if fnmatch.fnmatchcase(i["name"], glob))
+        else:
+            items = [dict(name=prefix)]
+        subrequests = (batch_client.subrequest("PATCH",
+                                               "b/{}/o/{}".format(requests.compat.quote(bucket),
+                                                                  requests.compat.quote(i["name"], safe="")),
+                                               json_body=patch)
+                       for i in items)
+        for batch, responses in batch_client.post_batches(subrequests, max_workers=max_workers,
+                                                          raise_for_status=False):
+            for subrequest, subresponse in zip(batch, responses):
+                if batch_client.is_success(subresponse):
+                    num_updated += 1
+                    continue
+                num_failed += 1
+                name = requests.compat.unquote(subrequest.url.split("/o/", 1)[1])
+                status = "{} {}".format(subresponse.status_code, subresponse.reason) if subresponse else "no response"
+                logger.error("Failed to update gs://%s/%s: %s", bucket, name, status)
+            logger.info("Updated batch of %d objects in gs://%s/%s", len(batch), bucket, prefix)
+    print("Done. {} objects updated.".format(num_updated))
+    if num_failed:
+        exit("{} of {} objects could not be updated".format(num_failed, num_failed + num_updated))
+
+cli.add_command(setmeta)
+
+def open_manifest(bucket, prefix, max_age, notifications=None, parallel_list=False, max_workers=None):
+    manifest = Manifest.open(client, bucket, prefix)
+    if manifest.listed_at is None or manifest.listed_at < time.time() - max_age:
+        manifest.refresh(client, notifications=notifications, parallel=parallel_list, max_workers=max_workers)
+    elif notifications:
+        manifest.apply_notifications(notifications)
+    logger.info("Using manifest of %d objects in gs://%s/%s", len(manifest), bucket, prefix)
+    return manifest
+
+sync_object_fields = ["name", "size", "updated", "generation", "crc32c", "md5Hash", "contentEncoding", "metadata"]
+
+def list_sync_source(bucket, prefix, manifest=None, parallel_list=False, max_workers=None):
+    if manifest is not None:
+        return iter(manifest)
+    list_params = dict(prefix=prefix) if prefix else dict()
+    if parallel_list:
+        return client.list_parallel("b/{}/o".format(bucket), params=list_params, max_workers=max_workers,
+                                    fields=sync_object_fields, ordered=True)
+    return client.list("b/{}/o".format(bucket), params=list_params, fields=sync_object_fields)
+
+def checksums_match(checksum_cache, local_path, local_size, remote_object, cached_only=False):
+    if local_size != uncompressed_size(remote_object):
+        return False
+    return checksum_cache.matches(local_path, remote_object, cached_only=cached_only)
+
+def skip_partial_downloads(local_files, log=False):
+    for local_file in local_files:
+        if local_file.name.endswith(".gsdownload") or local_file.name.endswith(".gsdownload.checkpoint"):
+            if log:
+                logger.info("Skipping partial download file %s", local_file.path)
+            continue
+        yield local_file
+
 @click.command()
 @click.argument('paths', nargs=2, required=True)
-@click.option("--max-workers", type=int, default=cpu_count(),
-              help="Limit upload/download concurrency to this many threads (default: number of CPU cores detected)")
+@click.option("--max-workers", type=int, default=default_max_workers,
+              help="Limit upload/download concurrency to this many threads (default: {})".format(default_max_workers))
+@click.option("--download-slices", type=int, default=1,
+              help="Download objects of 64M or more as this many parallel byte-range slices (default: 1, disabled).")
+@click.option("--upload-parts", type=int, default=1,
+              help="Upload files of 64M or more as this many parallel parts composed into one object (default: 1, "
+                   "disabled).")
+@click.option("--parallel-list", is_flag=True, help="List prefixes or key ranges of the bucket concurrently.")
+@click.option("--manifest", is_flag=True,
+              help="Keep a local manifest of the remote listing and use it instead of listing the bucket each time.")
+@click.option("--manifest-max-age", type=int, default=86400,
+              help="Re-list the bucket if the manifest is older than this many seconds (default: 1 day).")
+@click.option("--notifications", metavar="PATH",
+              help="Apply bucket change notifications (Pub/Sub messages, one JSON object per line) from this file to "
+                   "the manifest.")
+@click.option("--checksum", is_flag=True,
+              help="Compare file contents by checksum instead of size and modification time. Local checksums are "
+                   "cached and only recomputed for files that changed.")
+@click.option("--gzip", "gzip_patterns", multiple=True, metavar="PATTERN",
+              help="Compress files matching this extension or glob pattern (e.g. csv, '*.json') with gzip when "
+                   "uploading, and store them with Content-Encoding: gzip. Can be repeated or comma-separated.")
+@click.option("--transfer-order", type=click.Choice(transfer_orders), default="fifo",
+              help="Start transfers in this order: as listed (fifo, the default), largest-first (to finish sooner "
+                   "when a few files are much larger than the rest) or smallest-first (to complete the most files "
+                   "soonest).")
+@click.option("--delete", is_flag=True,
+              help="Delete objects (or files) that are not in the source directory (or bucket/prefix) from the "
+                   "destination.")
 @format_http_errors
-def sync(paths, max_workers=None):
-    """Sync a directory of files with bucket/prefix."""
+def sync(paths, max_workers=None, download_slices=1, upload_parts=1, parallel_list=False, manifest=False,
+         manifest_max_age=None, notifications=None, checksum=False, gzip_patterns=(), transfer_order="fifo",
+         delete=False):
+    """
+    Sync a directory of files with bucket/prefix.
+
+    Files and objects are compared by size and modification time (or by checksum, with --checksum) as the directory
+    tree and the bucket listing are read side by side in name order, so that memory use does not grow with the
+    number of files.
+    """
     src, dest = [os.path.expanduser(p) for p in paths]
-    futures = []
-    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as threadpool:
-        if src.startswith("gs://") and not dest.startswith("gs://"):
-            bucket, prefix = parse_bucket_and_prefix(src)
-            prefix = prefix.rstrip("*")
-            list_params = dict(prefix=prefix) if prefix else dict()
-            items = client.list("b/{}/o".format(bucket), params=list_params)
-            for remote_object in items:
-                assert ".." not in remote_object["name"].split("/")
-                try:
-                    local_path = os.path.join(dest, remote_object["name"])
-                    local_size = get_file_size(local_path)
-                    local_mtime = datetime.datetime.utcfromtimestamp(os.path.getmtime(local_path))
-                    remote_mtime = dateutil_parse(remote_object["updated"]).replace(tzinfo=None, microsecond=0)
-                    if local_size == int(remote_object["size"]) and remote_mtime <= local_mtime:
-                        logger.debug("sync:%s:%s: size/mtime match, skipping", src, local_path)
-                        continue
-                except OSError:
-                    pass
-                makedirs(os.path.dirname(local_path), exist_ok=True)
-                futures.append(threadpool.submit(download_one_file, bucket, remote_object["name"], local_path))
-        elif dest.startswith("gs://") and not src.startswith("gs://"):
-            bucket, prefix = parse_bucket_and_prefix(dest)
-            list_params = dict(prefix=prefix) if prefix else dict()
-            remote_objects = {i["name"]: i for i in client.list("b/{}/o".format(bucket), params=list_params)}
-            for root, dirs, files in os.walk(src):
-                for filename in files:
-                    if filename.endswith(".gsdownload"):
-                        logger.info("Skipping partial download file %s", filename)
-                        continue
-                    local_path = os.path.join(root, filename)
-                    local_size = get_file_size(local_path)
-                    local_mtime = datetime.datetime.utcfromtimestamp(os.path.getmtime(local_path))
-                    remote_path = os.path.join(prefix, os.path.relpath(root, src).lstrip("./"), filename)
-                    try:
-                        remote_object = remote_objects[remote_path]
-                        remote_mtime = dateutil_parse(remote_object["updated"]).replace(tzinfo=None, microsecond=0)
-                        if local_size == int(remote_object["size"]) and remote_mtime >= local_mtime:
-                            logger.debug("sync:%s:%s: size/mtime match, skipping", local_path, dest)
-                            continue
-                    except KeyError:
-                        pass
-                    futures.append(threadpool.submit(upload_one_file, local_path, bucket, remote_path))
-        else:
-            raise click.BadParameter("Expected a local directory and a gs:// URL or vice versa")
+    gzip_selector = GzipSelector(gzip_patterns)
+    list_args = dict(parallel_list=parallel_list, max_workers=max_workers)
+    checksum_cache = ChecksumCache.open(client) if checksum else None
+    if src.startswith("gs://") and not dest.startswith("gs://"):
+        upload, local_dir, url = False, dest, src
+    elif dest.startswith("gs://") and not src.startswith("gs://"):
+        upload, local_dir, url = True, src, dest
+    else:
+        raise click.BadParameter("Expected a local directory and a gs:// URL or vice versa")
+    bucket, prefix = parse_bucket_and_prefix(url)
+    if upload:
+        # Files are uploaded to prefix/relative/path; downloads keep the full object name under the directory
+        name_prefix = prefix + "/" if prefix and not prefix.endswith("/") else prefix
+        local_files = walk_sorted(local_dir, prefix=name_prefix)
+    else:
+        prefix = name_prefix = prefix.rstrip("*")
+        local_files = walk_sorted(local_dir, subset=name_prefix)
+    if manifest:
+        list_args.update(manifest=open_manifest(bucket, prefix, manifest_max_age, notifications, **list_args))
+    remote_objects = (ObjectRecord.from_resource(i) for i in list_sync_source(bucket, name_prefix, **list_args)
+                      if i["name"].startswith(name_prefix))
 
-        for future in futures:
-            future.result()
+    def is_current(local_file, remote_object):
+        # Gzip-encoded objects uploaded by other tools have no record of their uncompressed size or checksum, so they
+        # can only be compared by modification time
+        remote_size = uncompressed_size(remote_object)
+        if checksum_cache is not None and remote_size is not None:
+            # Files that are not in the checksum cache are hashed by the transfer workers (see sync_one)
+            return checksums_match(checksum_cache, local_file.path, local_file.size, remote_object, cached_only=True)
+        if remote_size is not None and local_file.size != remote_size:
+            return False
+        remote_mtime_ns = remote_object.mtime_ns // 10 ** 9 * 10 ** 9
+        return remote_mtime_ns >= local_file.mtime_ns if upload else remote_mtime_ns <= local_file.mtime_ns
+
+    def sync_one(size=0, delete_keys=None, verify=None, **transfer):
+        if delete_keys is not None:
+            # Objects listed by a stale manifest may already be gone
+            return batch_delete_objects(bucket, delete_keys, max_workers=1, description=name_prefix, missing_ok=True)
+        if verify is not None and checksum_cache.matches(transfer["path"] if upload else transfer["dest_filename"],
+                                                         verify):
+            logger.debug("sync:%s:%s: up to date, skipping", src, verify.name)
+            return transfer_skipped
+        return upload_one_file(**transfer) if upload else download_one_file(**transfer)
+
+    def record(transfer, result):
+        if "delete_keys" in transfer:
+            for name in transfer["delete_keys"]:
+                list_args["manifest"].remove(name)
+        elif upload:
+            list_args["manifest"].update(result)
+
+    def transfers():
+        pending_deletes = []
+        for action, local_file, remote_object in diff(skip_partial_downloads(local_files, upload), remote_objects,
+                                                      upload=upload, is_current=is_current):
+            if remote_object is not None and remote_object.name.endswith("/"):
+                continue  # A placeholder object for a directory
+            if action == "skip":
+                logger.debug("sync:%s:%s: up to date, skipping", src, local_file.name)
+            elif action == "delete" and not delete:
+                continue
+            elif action == "delete" and upload:
+                pending_deletes.append(remote_object.name)
+                if len(pending_deletes) >= batch_client.max_batch_size:
+                    yield dict(bucket=bucket, delete_keys=pending_deletes)
+                    pending_deletes = []
+            elif action == "delete":
+                logger.info("Deleting %s", local_file.path)
+                os.remove(local_file.path)
+            else:
+                if upload:
+                    transfer = dict(size=local_file.size)
+                else:
+                    # The stored size is the best estimate available for gzip-encoded objects of unknown size
+                    remote_size = uncompressed_size(remote_object)
+                    transfer = dict(size=(remote_object.size or 0) if remote_size is None else remote_size)
+                if checksum_cache is not None and local_file is not None and remote_object is not None:
+                    # The local checksum is not cached (or differs): compare on a worker before transferring
+                    if local_file.size == uncompressed_size(remote_object):
+                        transfer.update(verify=remote_object)
+                if upload:
+                    transfer.update(path=local_file.path, dest_bucket=bucket, dest_key=local_file.name,
+                                    parts=upload_parts, gzip=gzip_selector.matches(local_file.path))
+                else:
+                    assert ".." not in remote_object.name.split("/")
+                    local_path = os.path.join(local_dir, remote_object.name)
+                    makedirs(os.path.dirname(local_path), exist_ok=True)
+                    transfer.update(bucket=bucket, key=remote_object.name, dest_filename=local_path,
+                                    slices=download_slices)
+                yield transfer
+        if pending_deletes:
+            yield dict(bucket=bucket, delete_keys=pending_deletes)
+
+    try:
+        run_transfers(sync_one, transfers(), max_workers=max_workers, on_success=record if manifest else None,
+                      verb="Synced", order=transfer_order, size_hint=lambda transfer: transfer.get("size", 0))
+    except GSTransferError as e:
+        exit(str(e))
 
 cli.add_command(sync)
 
@@ -514,5 +1290,5 @@ def api(method, gs_url, args):
 cli.add_command(api)
 
 client = GSClient()
-upload_client = GSUploadClient(config=client.config)
-batch_client = GSBatchClient(config=client.config)
+upload_client = GSUploadClient(config=client.config, credentials=client.credentials, transport=client.transport)
+batch_client = GSBatchClient(config=client.config, credentials=client.credentials, transport=client.transport)
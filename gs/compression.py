@@ -0,0 +1,82 @@
+"""
+Gzip transfer compression.
+
+Files selected for compression are gzipped as they are uploaded and stored with Content-Encoding: gzip. The checksums
+of stored objects cover the compressed bytes, so the size and CRC32C of the uncompressed data are also recorded in the
+object's custom metadata, where sync uses them to compare objects with local files (gzip-encoded objects uploaded by
+other tools lack this metadata, and are compared by modification time only). Downloads of gzip-encoded objects ask for
+the stored bytes (instead of relying on decompressive transcoding, which is incompatible with checksum validation and
+range requests), verify them, and decompress them locally.
+"""
+
+import os, fnmatch, zlib
+
+uncompressed_size_key = "gs-uncompressed-size"
+uncompressed_crc32c_key = "gs-uncompressed-crc32c"
+
+class GzipSelector:
+    """
+    Selects files by extension (csv, .csv) or by glob pattern matched against the file name or path (*.vcf, logs/*).
+    Each pattern may be a comma-separated list.
+    """
+    def __init__(self, patterns):
+        self.patterns = []
+        for pattern in patterns or ():
+            for p in pattern.split(","):
+                p = p.strip()
+                if p and not any(c in p for c in "*?[/"):
+                    p = "*." + p.lstrip(".")
+                if p:
+                    self.patterns.append(p)
+
+    def __bool__(self):
+        return bool(self.patterns)
+
+    __nonzero__ = __bool__
+
+    def matches(self, path):
+        return any(fnmatch.fnmatch(path, p) or fnmatch.fnmatch(os.path.basename(path), p) for p in self.patterns)
+
+def gzip_file_chunks(filename, hasher, uncompressed_hasher, chunk_size=1024 * 1024, level=6, on_progress=None):
+    """
+    Yield the gzip-compressed contents of a file. The compressed bytes are passed to *hasher*, and the uncompressed
+    bytes to *uncompressed_hasher*.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    with open(filename, "rb") as fh:
+        while True:
+            chunk = fh.read(chunk_size)
+            if len(chunk) == 0:
+                break
+            uncompressed_hasher.update(chunk)
+            if on_progress is not None:
+                on_progress(len(chunk))
+            data = compressor.compress(chunk)
+            if data:
+                hasher.update(data)
+                yield data
+    data = compressor.flush()
+    hasher.update(data)
+    yield data
+
+def is_gzip_encoded(obj):
+    return (obj.get("contentEncoding") or "").lower() == "gzip"
+
+def uncompressed_size(obj):
+    """
+    Return the size of an object resource's data as it is stored locally, or None if it is not known: gzip-encoded
+    objects uploaded by other tools (such as gsutil cp -z) do not record the size of their uncompressed data.
+    """
+    metadata = obj.get("metadata") or {}
+    if uncompressed_size_key in metadata:
+        return int(metadata[uncompressed_size_key])
+    if is_gzip_encoded(obj) or obj.get("size") is None:
+        return None
+    return int(obj["size"])
+
+def uncompressed_crc32c(obj):
+    """Return the CRC32C of an object resource's data as it is stored locally, or None if it is not known."""
+    metadata = obj.get("metadata") or {}
+    if uncompressed_crc32c_key in metadata:
+        return metadata[uncompressed_crc32c_key]
+    return None if is_gzip_encoded(obj) else obj.get("crc32c")
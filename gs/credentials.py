@@ -0,0 +1,224 @@
+"""
+OAuth2 credential management shared by all clients and threads of a process.
+
+Access tokens are fetched once (under a lock), refreshed shortly before they expire, and cached on disk together with
+the project ID so that short-lived gs processes can skip the token and metadata server round trips. A token that the
+API rejects (for example, one that was revoked before it expired) is dropped from both caches, and the request is sent
+again once with a new token.
+"""
+
+import os, json, time, datetime, tempfile, threading, logging
+
+import requests
+
+from .util.compat import str
+from .util.exceptions import NoServiceCredentials
+
+logger = logging.getLogger(__name__)
+
+class GSCredentials:
+    scope = "https://www.googleapis.com/auth/cloud-platform"
+    token_url = "https://www.googleapis.com/oauth2/v4/token"
+    instance_metadata_url = "http://metadata.google.internal/computeMetadata/v1/"
+    svc_acct_token_url = instance_metadata_url + "instance/service-accounts/default/token"
+    project_id_metadata_url = instance_metadata_url + "project/project-id"
+    refresh_margin = 300
+    project_cache_ttl = 86400
+
+    def __init__(self, config, cache_file=None, anonymous=False):
+        """
+        If *anonymous* is True, no credentials are loaded and requests are sent unsigned.
+        """
+        self.config = config
+        if cache_file is None:
+            cache_file = os.path.join(config.user_config_dir, "credentials_cache.json")
+        self.cache_file = cache_file
+        self._lock = threading.RLock()
+        self._token, self._token_expires_at = None, 0
+        self.anonymous = anonymous
+
+    def get_service_credentials(self):
+        if "service_credentials" not in self.config:
+            if "GOOGLE_APPLICATION_CREDENTIALS" in os.environ:
+                logger.info("Using GOOGLE_APPLICATION_CREDENTIALS file %s",
+                            os.environ["GOOGLE_APPLICATION_CREDENTIALS"])
+                with open(os.environ["GOOGLE_APPLICATION_CREDENTIALS"]) as fh:
+                    self.config.service_credentials = json.load(fh)
+            else:
+                raise NoServiceCredentials()
+        return self.config.service_credentials
+
+    def get_service_jwt(self):
+        service_credentials = self.get_service_credentials()
+        payload = {
+            'iss': service_credentials["client_email"],
+            'sub': service_credentials["client_email"],
+            'scope': self.scope,
+            'aud': self.token_url,
+            'iat': datetime.datetime.utcnow(),
+            'exp': datetime.datetime.utcnow() + datetime.timedelta(minutes=60)
+        }
+        additional_headers = {'kid': service_credentials["private_key_id"]}
+        import jwt
+        return jwt.encode(payload, service_credentials["private_key"], headers=additional_headers,
+                          algorithm='RS256').decode()
+
+    def _get_identity(self):
+        try:
+            service_credentials = self.get_service_credentials()
+            return "{client_email}/{private_key_id}".format(**service_credentials)
+        except NoServiceCredentials:
+            return "metadata"
+
+    def _load_cache(self):
+        try:
+            with open(self.cache_file) as fh:
+                return json.load(fh)
+        except Exception:
+            return {}
+
+    def _cache_get(self, key):
+        entry = self._load_cache().get(key)
+        if entry and entry["expires_at"] > time.time() + self.refresh_margin:
+            return entry
+        return None
+
+    def _cache_put(self, key, **entry):
+        cache = {k: v for k, v in self._load_cache().items() if v["expires_at"] > time.time()}
+        cache[key] = entry
+        self._save_cache(cache)
+
+    def _cache_remove(self, key, **match):
+        """Remove the entry for *key* from the disk cache if its fields have the values given in *match*."""
+        cache = self._load_cache()
+        if key in cache and all(cache[key].get(k) == v for k, v in match.items()):
+            del cache[key]
+            self._save_cache(cache)
+
+    def _save_cache(self, cache):
+        try:
+            cache_dir = os.path.dirname(self.cache_file)
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            fd, tmp_path = tempfile.mkstemp(dir=cache_dir)  # Created with mode 0600
+            with os.fdopen(fd, "w") as fh:
+                json.dump(cache, fh)
+            os.rename(tmp_path, self.cache_file)
+        except Exception as e:
+            logger.debug("Error saving credentials cache %s: %s", self.cache_file, e)
+
+    def _fetch_token(self):
+        try:
+            params = dict(grant_type="urn:ietf:params:oauth:grant-type:jwt-bearer", assertion=self.get_service_jwt())
+            res = requests.post(self.token_url, data=params)
+        except NoServiceCredentials:
+            try:
+                res = requests.get(self.svc_acct_token_url, headers={"Metadata-Flavor": "Google"})
+            except Exception:
+                return None, 0
+        res.raise_for_status()
+        token = res.json()
+        return token["access_token"], time.time() + int(token.get("expires_in", 3600))
+
+    def get_cached_token(self):
+        """
+        Return the in-memory token if it is valid and not due for refresh, without blocking. Otherwise return None;
+        call get_token() to load or fetch a token.
+        """
+        if self._token is not None and self._token_expires_at > time.time() + self.refresh_margin:
+            return self._token
+        return None
+
+    def get_token(self):
+        """
+        Return a valid OAuth2 access token, or None if no credentials are available. The token is taken from memory
+        or the disk cache, and fetched again when it is within refresh_margin seconds of expiring.
+        """
+        token = self.get_cached_token()
+        if token is not None:
+            return token
+        with self._lock:
+            if self._token is not None and self._token_expires_at > time.time() + self.refresh_margin:
+                return self._token
+            if self.anonymous:
+                return None
+            identity = self._get_identity()
+            cached = self._cache_get("token:" + identity)
+            if cached:
+                self._token, self._token_expires_at = cached["access_token"], cached["expires_at"]
+                return self._token
+            token, expires_at = self._fetch_token()
+            if token is None:
+                logger.warn('API credentials not configured. Sending unsigned requests.')
+                logger.warn('To set credentials, run "gs configure" or set GOOGLE_APPLICATION_CREDENTIALS.')
+                self.anonymous = True
+                return None
+            logger.debug("Fetched access token for %s, expires in %ds", identity, expires_at - time.time())
+            self._token, self._token_expires_at = token, expires_at
+            self._cache_put("token:" + identity, access_token=token, expires_at=expires_at)
+            return self._token
+
+    def invalidate(self, token=None):
+        """
+        Forget the current access token, in memory and in the disk cache, so that the next call to get_token() fetches
+        a new one. If *token* is given, nothing is done unless it is the current token (another thread may already
+        have replaced it).
+        """
+        with self._lock:
+            if token is not None and token != self._token:
+                return
+            if self._token is not None:
+                self._cache_remove("token:" + self._get_identity(), access_token=self._token)
+            self._token, self._token_expires_at = None, 0
+
+    def get_project(self):
+        if "GOOGLE_CLOUD_PROJECT" in os.environ:
+            return os.environ["GOOGLE_CLOUD_PROJECT"]
+        try:
+            return self.get_service_credentials()["project_id"]
+        except NoServiceCredentials:
+            pass
+        with self._lock:
+            cached = self._cache_get("project:metadata")
+            if cached:
+                return cached["project_id"]
+            res = requests.get(self.project_id_metadata_url, headers={"Metadata-Flavor": "Google"})
+            res.raise_for_status()
+            project_id = res.content.decode()
+            self._cache_put("project:metadata", project_id=project_id, expires_at=time.time() + self.project_cache_ttl)
+            return project_id
+
+class BearerAuth(requests.auth.AuthBase):
+    """
+    Sets the Authorization header of each request from a GSCredentials instance, so that sessions always send the
+    current token. If the API responds with 401 Unauthorized, the token is invalidated and the request is sent once
+    more with a new token (unless its body is a stream, which cannot be sent again).
+    """
+    def __init__(self, credentials):
+        self.credentials = credentials
+
+    def __call__(self, request):
+        token = self.credentials.get_token()
+        if token is not None:
+            request.headers["Authorization"] = "Bearer " + token
+            request.register_hook("response", self.retry_unauthorized)
+        return request
+
+    def retry_unauthorized(self, res, **kwargs):
+        if res.status_code != 401 or not isinstance(res.request.body, (bytes, str, type(None))):
+            return res
+        token = res.request.headers["Authorization"][len("Bearer "):]
+        self.credentials.invalidate(token)
+        new_token = self.credentials.get_token()
+        if new_token is None or new_token == token:
+            return res
+        logger.debug("Access token was rejected, retrying with a new token")
+        res.content
+        res.close()
+        request = res.request.copy()
+        request.headers["Authorization"] = "Bearer " + new_token
+        # Response hooks are not dispatched for the retry, so it is not retried again
+        retry_res = res.connection.send(request, **kwargs)
+        retry_res.history.append(res)
+        retry_res.request = request
+        return retry_res
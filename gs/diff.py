@@ -0,0 +1,103 @@
+"""
+Streaming diff of a local directory tree and a bucket listing.
+
+The JSON API lists objects in lexicographic order of their names. walk_sorted() walks a directory tree in the same
+order of the object names that its files map to, so that the two sides can be compared as a merge join, holding only
+one entry of each side (and the directory entries of the directories being walked) in memory at a time, however large
+the trees are.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os, stat
+from collections import namedtuple
+
+LocalFile = namedtuple("LocalFile", "name path size mtime_ns")
+
+class SortOrderError(Exception):
+    pass
+
+def _scandir(path):
+    if hasattr(os, "scandir"):
+        for entry in os.scandir(path):
+            yield entry.name, entry.path, entry.is_dir() and not entry.is_symlink(), entry.stat
+    else:
+        for name in os.listdir(path):
+            entry_path = os.path.join(path, name)
+            yield name, entry_path, os.path.isdir(entry_path) and not os.path.islink(entry_path), \
+                lambda entry_path=entry_path: os.stat(entry_path)
+
+def walk_sorted(top, prefix="", subset=""):
+    """
+    Yield a LocalFile for each file under the directory *top*, named *prefix* followed by its path relative to *top*
+    (with "/" separators), in lexicographic order of names. Only names starting with *subset* are yielded, and
+    directories that cannot contain such names are not read. Symbolic links to directories are not followed.
+    """
+    try:
+        entries = list(_scandir(top))
+    except OSError:
+        return
+    # A directory sorts as its name followed by "/", which is where the names of the files under it fall
+    entries.sort(key=lambda e: e[0] + "/" if e[2] else e[0])
+    for name, path, is_dir, get_stat in entries:
+        name = prefix + name
+        if is_dir:
+            name += "/"
+            if name.startswith(subset) or subset.startswith(name):
+                for local_file in walk_sorted(path, prefix=name, subset=subset):
+                    yield local_file
+        elif name.startswith(subset):
+            try:
+                st = get_stat()
+            except OSError:
+                continue  # Removed while walking, or a broken symbolic link
+            if stat.S_ISREG(st.st_mode):
+                mtime_ns = st.st_mtime_ns if hasattr(st, "st_mtime_ns") else int(st.st_mtime * 10 ** 9)
+                yield LocalFile(name=name, path=path, size=st.st_size, mtime_ns=mtime_ns)
+
+def merge_join(local_files, remote_objects):
+    """
+    Pair up LocalFiles and object resources (dicts with a name) of the same name from two iterables sorted by name.
+    Yields (name, local_file, remote_object), with None for the side that the name is missing from. Raises
+    SortOrderError if either input is out of order, since a name would then be reported missing.
+    """
+    def checked(items, get_name, side):
+        last = None
+        for item in items:
+            name = get_name(item)
+            if last is not None and name <= last:
+                raise SortOrderError("{} names out of order: {} after {}".format(side, name, last))
+            last = name
+            yield name, item
+
+    local = checked(local_files, lambda f: f.name, "Local file")
+    remote = checked(remote_objects, lambda o: o["name"], "Object")
+    local_name, local_file = next(local, (None, None))
+    remote_name, remote_object = next(remote, (None, None))
+    while local_name is not None or remote_name is not None:
+        if remote_name is None or (local_name is not None and local_name < remote_name):
+            yield local_name, local_file, None
+            local_name, local_file = next(local, (None, None))
+        elif local_name is None or remote_name < local_name:
+            yield remote_name, None, remote_object
+            remote_name, remote_object = next(remote, (None, None))
+        else:
+            yield local_name, local_file, remote_object
+            local_name, local_file = next(local, (None, None))
+            remote_name, remote_object = next(remote, (None, None))
+
+def diff(local_files, remote_objects, upload, is_current):
+    """
+    Yield (action, local_file, remote_object) for each name in either of the sorted inputs of merge_join(), where
+    action is "copy" if the name is missing from the destination (the remote side if *upload* is True, the local side
+    otherwise) or is_current(local_file, remote_object) is False, "skip" if it is current, and "delete" if the name is
+    missing from the source.
+    """
+    for name, local_file, remote_object in merge_join(local_files, remote_objects):
+        source, dest = (local_file, remote_object) if upload else (remote_object, local_file)
+        if source is None:
+            yield "delete", local_file, remote_object
+        elif dest is not None and is_current(local_file, remote_object):
+            yield "skip", local_file, remote_object
+        else:
+            yield "copy", local_file, remote_object
@@ -0,0 +1,126 @@
+"""
+Compact in-memory object index.
+
+Listings of millions of objects are parsed into ObjectRecords: slotted objects holding only the fields that sync and
+transfer scheduling use, with sizes and generations as integers and the updated time as integer nanoseconds since the
+epoch, parsed once by parse_rfc3339() instead of by dateutil on every comparison. A record takes a fraction of the
+memory of the resource dict it replaces. ObjectIndex holds the records of a listing for lookup by name.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import calendar
+
+def _days_from_civil(year, month, day):
+    """Return the number of days from 1970-01-01 to a date of the proleptic Gregorian calendar."""
+    year -= month <= 2
+    era = year // 400
+    year_of_era = year - era * 400
+    day_of_year = (153 * (month + (-3 if month > 2 else 9)) + 2) // 5 + day - 1
+    return era * 146097 + year_of_era * 365 + year_of_era // 4 - year_of_era // 100 + day_of_year - 719468
+
+def parse_rfc3339(timestamp):
+    """
+    Return an RFC 3339 timestamp (e.g. 2020-01-02T03:04:05.678Z, as found in object resources) as nanoseconds since
+    the epoch. Other formats are left to dateutil, and timestamps without a time zone are taken to be in UTC.
+    """
+    t = timestamp
+    try:
+        if t[4] == "-" and t[7] == "-" and t[10] in "Tt " and t[13] == ":" and t[16] == ":":
+            month, day = int(t[5:7]), int(t[8:10])
+            if 1 <= month <= 12 and 1 <= day <= 31:
+                hours = _days_from_civil(int(t[0:4]), month, day) * 24 + int(t[11:13])
+                seconds = (hours * 60 + int(t[14:16])) * 60 + int(t[17:19])
+                pos, nanoseconds = 19, 0
+                if t[19:20] == ".":
+                    pos = 20
+                    while pos < len(t) and t[pos].isdigit():
+                        pos += 1
+                    digits = t[20:pos][:9]
+                    nanoseconds = int(digits or 0) * 10 ** (9 - len(digits))
+                zone = t[pos:]
+                if zone in ("Z", "z"):
+                    return seconds * 10 ** 9 + nanoseconds
+                if len(zone) == 6 and zone[0] in "+-" and zone[3] == ":":
+                    offset = (int(zone[1:3]) * 60 + int(zone[4:6])) * 60
+                    return (seconds - offset if zone[0] == "+" else seconds + offset) * 10 ** 9 + nanoseconds
+    except (ValueError, IndexError):
+        pass
+    from dateutil.parser import parse as dateutil_parse
+    dt = dateutil_parse(timestamp)
+    return calendar.timegm(dt.utctimetuple()) * 10 ** 9 + dt.microsecond * 1000
+
+class ObjectRecord(object):
+    """
+    The fields of an object resource that sync and transfer scheduling use. A record can also be read like the
+    resource (record["size"], record.get("md5Hash")), so that it can be passed to functions that take one.
+    """
+    __slots__ = ("name", "size", "mtime_ns", "generation", "crc32c", "md5_hash", "content_encoding", "metadata")
+    resource_fields = dict(name="name", size="size", generation="generation", crc32c="crc32c", md5Hash="md5_hash",
+                           contentEncoding="content_encoding", metadata="metadata")
+
+    def __init__(self, name, size=None, mtime_ns=None, generation=None, crc32c=None, md5_hash=None,
+                 content_encoding=None, metadata=None):
+        self.name, self.size, self.mtime_ns, self.generation = name, size, mtime_ns, generation
+        self.crc32c, self.md5_hash, self.content_encoding, self.metadata = crc32c, md5_hash, content_encoding, metadata
+
+    @classmethod
+    def from_resource(cls, resource):
+        """Make a record from an object resource (or the partial resource of a listing with fields)."""
+        get = resource.get
+        return cls(resource["name"],
+                   size=int(resource["size"]) if "size" in resource else None,
+                   mtime_ns=parse_rfc3339(resource["updated"]) if "updated" in resource else None,
+                   generation=int(resource["generation"]) if "generation" in resource else None,
+                   crc32c=get("crc32c"), md5_hash=get("md5Hash"), content_encoding=get("contentEncoding"),
+                   metadata=get("metadata") or None)
+
+    def __getitem__(self, key):
+        value = getattr(self, self.resource_fields[key]) if key in self.resource_fields else None
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __repr__(self):
+        return "ObjectRecord({})".format(", ".join("{}={!r}".format(k, getattr(self, k)) for k in self.__slots__
+                                                   if getattr(self, k) is not None))
+
+class ObjectIndex(object):
+    """ObjectRecords by name. Resources added to the index are converted to records; iteration is in name order."""
+    def __init__(self, objects=()):
+        self._records = {}
+        self.update(objects)
+
+    def add(self, obj):
+        record = obj if isinstance(obj, ObjectRecord) else ObjectRecord.from_resource(obj)
+        self._records[record.name] = record
+        return record
+
+    def update(self, objects):
+        for obj in objects:
+            self.add(obj)
+
+    def get(self, name, default=None):
+        return self._records.get(name, default)
+
+    def pop(self, name, default=None):
+        return self._records.pop(name, default)
+
+    def __contains__(self, name):
+        return name in self._records
+
+    def __len__(self):
+        return len(self._records)
+
+    def __iter__(self):
+        for name in sorted(self._records):
+            yield self._records[name]
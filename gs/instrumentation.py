@@ -0,0 +1,186 @@
+"""
+Per-request instrumentation.
+
+GSTransport calls each of its hooks with a RequestRecord once the response headers of a request have been received
+(for streamed responses) or its body has been read (otherwise), or once it has failed. Hooks are called on the thread
+that sent the request and must be thread-safe. This module provides hooks that aggregate request statistics
+(RequestStats), write a JSON Lines trace (TraceWriter), and periodically export the statistics as a Prometheus
+textfile (PrometheusTextfileExporter, for the node_exporter textfile collector).
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os, json, time, random, threading, logging
+from collections import namedtuple
+
+from .util.compat import urlparse, parse_qs
+
+logger = logging.getLogger(__name__)
+
+RequestRecord = namedtuple("RequestRecord",
+                           "started_at method endpoint url status latency bytes_sent bytes_received retries error")
+
+def classify_endpoint(method, url):
+    """Return the class of API call (list, metadata, download, upload, batch, ...) that a request URL belongs to."""
+    url = urlparse(url)
+    path = url.path
+    if "/batch/" in path:
+        return "batch"
+    if "/upload/" in path:
+        return "upload"
+    for action in "rewriteTo", "copyTo", "compose":
+        if "/" + action in path:
+            return action.replace("To", "")
+    if path.endswith("/o"):
+        return "list" if method.upper() == "GET" else "insert"
+    if "/o/" in path:
+        if method.upper() == "GET":
+            return "download" if "media" in parse_qs(url.query).get("alt", []) else "metadata"
+        return dict(PATCH="patch", PUT="update", DELETE="delete").get(method.upper(), "other")
+    return "bucket" if "/b" in path else "other"
+
+class RequestStats(object):
+    """
+    Aggregates request records per endpoint: counts of requests, errors (failed requests and HTTP statuses of 400 and
+    above), retries and bytes, and latency percentiles estimated from a uniform sample of up to *sample_size*
+    latencies.
+    """
+    sample_size = 10000
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.endpoints = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, record):
+        with self._lock:
+            if record.endpoint not in self.endpoints:
+                self.endpoints[record.endpoint] = dict(requests=0, errors=0, retries=0, bytes_sent=0,
+                                                       bytes_received=0, latency_sum=0.0, latencies=[], statuses={})
+            stats = self.endpoints[record.endpoint]
+            stats["requests"] += 1
+            stats["errors"] += 1 if record.error is not None or record.status >= 400 else 0
+            stats["retries"] += record.retries
+            stats["bytes_sent"] += record.bytes_sent
+            stats["bytes_received"] += record.bytes_received
+            stats["latency_sum"] += record.latency
+            status = record.status or "error"
+            stats["statuses"][status] = stats["statuses"].get(status, 0) + 1
+            if len(stats["latencies"]) < self.sample_size:
+                stats["latencies"].append(record.latency)
+            else:
+                i = random.randrange(stats["requests"])
+                if i < self.sample_size:
+                    stats["latencies"][i] = record.latency
+
+    @staticmethod
+    def percentile(sorted_values, p):
+        if not sorted_values:
+            return 0.0
+        return sorted_values[min(len(sorted_values) - 1, int(p * len(sorted_values)))]
+
+    def summary(self):
+        """Return a dict of totals, and of per-endpoint statistics with p50 and p99 latencies in seconds."""
+        with self._lock:
+            endpoints = {}
+            for endpoint, stats in self.endpoints.items():
+                latencies = sorted(stats["latencies"])
+                endpoints[endpoint] = {k: v for k, v in stats.items() if k != "latencies"}
+                endpoints[endpoint].update(statuses=dict(stats["statuses"]), p50=self.percentile(latencies, 0.5),
+                                           p99=self.percentile(latencies, 0.99))
+        elapsed = time.time() - self.started_at
+        totals = {k: sum(e[k] for e in endpoints.values())
+                  for k in ("requests", "errors", "retries", "bytes_sent", "bytes_received")}
+        return dict(totals, elapsed=elapsed, endpoints=endpoints)
+
+    def format_report(self):
+        from .util.printing import format_number, format_table
+        summary = self.summary()
+        elapsed = max(summary["elapsed"], 1e-3)
+        lines = ["{requests} requests in {elapsed:.1f}s ({rate:.1f}/s), {errors} errors, {retries} retries".format(
+            rate=summary["requests"] / elapsed, **summary)]
+        lines.append("Sent {} ({}/s), received {} ({}/s)".format(
+            format_number(summary["bytes_sent"]), format_number(int(summary["bytes_sent"] / elapsed)),
+            format_number(summary["bytes_received"]), format_number(int(summary["bytes_received"] / elapsed))))
+        table = [[endpoint, s["requests"], s["errors"], s["retries"], "{:.0f}ms".format(s["p50"] * 1000),
+                  "{:.0f}ms".format(s["p99"] * 1000), format_number(s["bytes_sent"]),
+                  format_number(s["bytes_received"])]
+                 for endpoint, s in sorted(summary["endpoints"].items())]
+        if table:
+            lines.append(format_table(table, column_names=["endpoint", "requests", "errors", "retries", "p50", "p99",
+                                                           "sent", "received"]))
+        return "\n".join(lines)
+
+class TraceWriter(object):
+    """Writes each request record to *filename* as one line of JSON."""
+    def __init__(self, filename):
+        self.filename = filename
+        self._fh = open(filename, "w")
+        self._lock = threading.Lock()
+
+    def __call__(self, record):
+        line = json.dumps(dict(record._asdict(), error=None if record.error is None else repr(record.error)))
+        with self._lock:
+            if not self._fh.closed:
+                self._fh.write(line + "\n")
+
+    def close(self):
+        with self._lock:
+            self._fh.close()
+
+class PrometheusTextfileExporter(object):
+    """
+    Writes the statistics of a RequestStats hook to *filename* in the Prometheus text exposition format every
+    *interval* seconds, and when closed. The file is replaced atomically, so that collectors never read a partial file.
+    """
+    def __init__(self, filename, stats, interval=15):
+        self.filename, self.stats, self.interval = filename, stats, interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.write()
+            except Exception as e:
+                logger.warn("Unable to write metrics to %s: %s", self.filename, e)
+
+    def format(self):
+        summary = self.stats.summary()
+        metrics = [
+            ("gs_requests_total", "counter", "API requests sent, by endpoint and HTTP status.", []),
+            ("gs_request_retries_total", "counter", "API requests retried.", []),
+            ("gs_sent_bytes_total", "counter", "Bytes sent in request bodies.", []),
+            ("gs_received_bytes_total", "counter", "Bytes received in response bodies.", []),
+            ("gs_request_duration_seconds", "summary", "API request latency.", []),
+        ]
+        for endpoint, s in sorted(summary["endpoints"].items()):
+            for status, count in sorted(s["statuses"].items(), key=str):
+                metrics[0][3].append(('endpoint="{}",status="{}"'.format(endpoint, status), count))
+            metrics[1][3].append(('endpoint="{}"'.format(endpoint), s["retries"]))
+            metrics[2][3].append(('endpoint="{}"'.format(endpoint), s["bytes_sent"]))
+            metrics[3][3].append(('endpoint="{}"'.format(endpoint), s["bytes_received"]))
+            for quantile in "0.5", "0.99":
+                metrics[4][3].append(('endpoint="{}",quantile="{}"'.format(endpoint, quantile),
+                                      s["p50" if quantile == "0.5" else "p99"]))
+        lines = []
+        for name, metric_type, help_text, samples in metrics:
+            lines.extend(["# HELP {} {}".format(name, help_text), "# TYPE {} {}".format(name, metric_type)])
+            lines.extend("{}{{{}}} {}".format(name, labels, value) for labels, value in samples)
+            if metric_type == "summary":
+                for endpoint, s in sorted(summary["endpoints"].items()):
+                    lines.append('{}_sum{{endpoint="{}"}} {}'.format(name, endpoint, s["latency_sum"]))
+                    lines.append('{}_count{{endpoint="{}"}} {}'.format(name, endpoint, s["requests"]))
+        return "\n".join(lines) + "\n"
+
+    def write(self):
+        tmp_filename = self.filename + ".tmp"
+        with open(tmp_filename, "w") as fh:
+            fh.write(self.format())
+        os.rename(tmp_filename, self.filename)
+
+    def close(self):
+        self._stop.set()
+        self.write()
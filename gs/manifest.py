@@ -0,0 +1,173 @@
+"""
+Persistent local manifests of remote object listings.
+
+A manifest records the name, size, updated time, generation and CRC32C of every object under a bucket/prefix in a
+SQLite file under the gs config directory. It is populated by a full listing, then kept current without re-listing by
+recording the objects that gs itself writes and by replaying Cloud Storage Pub/Sub notifications (JSON_API_V1 payload
+format) that an external subscriber appends to a local file, one message per line.
+"""
+
+import os, json, time, base64, hashlib, sqlite3, threading, logging
+
+from .util.compat import makedirs
+from .compression import uncompressed_size, uncompressed_crc32c
+
+logger = logging.getLogger(__name__)
+
+object_fields = ["name", "size", "updated", "generation", "crc32c", "contentEncoding", "metadata"]
+upsert_events = {"OBJECT_FINALIZE", "OBJECT_METADATA_UPDATE"}
+delete_events = {"OBJECT_DELETE", "OBJECT_ARCHIVE"}
+
+class Manifest:
+    def __init__(self, bucket, prefix, path):
+        self.bucket, self.prefix, self.path = bucket, prefix, path
+        makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            self._db.execute("CREATE TABLE IF NOT EXISTS objects "
+                             "(name TEXT PRIMARY KEY, size INTEGER, updated TEXT, generation INTEGER, crc32c TEXT)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+
+    @classmethod
+    def open(cls, client, bucket, prefix):
+        digest = hashlib.md5(prefix.encode()).hexdigest()
+        return cls(bucket, prefix, os.path.join(client.config.user_config_dir, "manifests", bucket, digest + ".db"))
+
+    def _get_meta(self, key, default=None):
+        row = self._db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def _set_meta(self, key, value):
+        self._db.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, json.dumps(value)))
+
+    @property
+    def listed_at(self):
+        with self._lock:
+            return self._get_meta("listed_at")
+
+    def refresh(self, client, notifications=None, parallel=False, max_workers=None):
+        """
+        Replace the manifest contents with a fresh listing. If a notifications file is given, notifications appended
+        to it after the listing started are replayed afterwards.
+        """
+        logger.info("Listing gs://%s/%s into manifest %s", self.bucket, self.prefix, self.path)
+        params = dict(prefix=self.prefix) if self.prefix else dict()
+        if parallel:
+            items = client.list_parallel("b/{}/o".format(self.bucket), params=params, include_prefixes=False,
+                                         max_workers=max_workers, fields=object_fields)
+        else:
+            items = client.list("b/{}/o".format(self.bucket), params=params, include_prefixes=False,
+                                fields=object_fields)
+        started_at = time.time()
+        notifications_state = self._get_notifications_state(notifications) if notifications else None
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM objects")
+            self._db.executemany("INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?, ?)",
+                                 (self._row(i) for i in items))
+            self._set_meta("listed_at", started_at)
+            if notifications_state:
+                self._set_meta("notifications", notifications_state)
+        if notifications:
+            self.apply_notifications(notifications)
+
+    @staticmethod
+    def _get_notifications_state(filename):
+        try:
+            st = os.stat(filename)
+            return dict(inode=st.st_ino, offset=st.st_size)
+        except OSError:
+            return dict(inode=None, offset=0)
+
+    @staticmethod
+    def _row(obj):
+        # Objects uploaded with gzip transfer compression are recorded with the size and checksum of their
+        # uncompressed data, which is what they are compared with
+        return (obj["name"], uncompressed_size(obj), obj["updated"], int(obj["generation"]), uncompressed_crc32c(obj))
+
+    def apply_notifications(self, filename):
+        """
+        Replay object change notifications appended to *filename* since the last call. Each line is a Pub/Sub message
+        (as returned by a pull subscription, optionally wrapped in a "message" key) whose data is the object resource.
+        Returns the number of notifications applied.
+        """
+        applied = 0
+        with self._lock, self._db:
+            state = self._get_meta("notifications", dict(inode=None, offset=0))
+            try:
+                fh = open(filename, "rb")
+            except (IOError, OSError) as e:
+                logger.warn("Unable to read notifications from %s: %s", filename, e)
+                return applied
+            with fh:
+                st = os.fstat(fh.fileno())
+                if st.st_ino != state["inode"] or st.st_size < state["offset"]:
+                    state = dict(inode=st.st_ino, offset=0)
+                fh.seek(state["offset"])
+                for line in fh:
+                    if not line.endswith(b"\n"):
+                        break
+                    state["offset"] += len(line)
+                    if line.strip() and self._apply_notification(json.loads(line.decode("utf-8"))):
+                        applied += 1
+            self._set_meta("notifications", state)
+        logger.debug("Applied %d notifications from %s to manifest %s", applied, filename, self.path)
+        return applied
+
+    def _apply_notification(self, message):
+        message = message.get("message", message)
+        attributes = message.get("attributes", {})
+        if attributes.get("bucketId") != self.bucket or not attributes.get("objectId", "").startswith(self.prefix):
+            return False
+        name, generation = attributes["objectId"], int(attributes["objectGeneration"])
+        row = self._db.execute("SELECT generation FROM objects WHERE name = ?", (name,)).fetchone()
+        if attributes.get("eventType") in upsert_events:
+            if row is None or row[0] <= generation:
+                obj = json.loads(base64.b64decode(message["data"]).decode("utf-8"))
+                self._db.execute("INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?, ?)", self._row(obj))
+                return True
+        elif attributes.get("eventType") in delete_events:
+            if row is not None and row[0] == generation:
+                self._db.execute("DELETE FROM objects WHERE name = ?", (name,))
+                return True
+        return False
+
+    def update(self, obj):
+        """Record an object resource written by this process."""
+        with self._lock, self._db:
+            self._db.execute("INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?, ?)", self._row(obj))
+
+    def remove(self, name):
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM objects WHERE name = ?", (name,))
+
+    def get(self, name):
+        with self._lock:
+            row = self._db.execute("SELECT * FROM objects WHERE name = ?", (name,)).fetchone()
+        return self._resource(row) if row else None
+
+    @staticmethod
+    def _resource(row):
+        resource = dict(name=row[0], updated=row[2], generation=str(row[3]), crc32c=row[4])
+        if row[1] is not None:
+            resource.update(size=str(row[1]))
+        return resource
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM objects").fetchone()[0]
+
+    def __iter__(self):
+        cursor = self._db.cursor()
+        cursor.execute("SELECT * FROM objects ORDER BY name")
+        while True:
+            with self._lock:
+                rows = cursor.fetchmany(1000)
+            if not rows:
+                break
+            for row in rows:
+                yield self._resource(row)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
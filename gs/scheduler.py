@@ -0,0 +1,78 @@
+"""
+Transfer scheduling.
+
+TransferScheduler is a concurrent.futures executor that runs pending transfers in order of priority and then by an
+ordering policy on their sizes, instead of in the order they were submitted. Largest-first starts the longest transfers
+early, so that a few large files at the end of a run do not leave most workers idle (minimizing the makespan);
+smallest-first completes the most objects soonest. Transfers of equal priority and size run in submission order.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import heapq, itertools, threading
+from concurrent.futures import Executor, Future
+
+transfer_orders = ("fifo", "largest-first", "smallest-first")
+
+class TransferScheduler(Executor):
+    """
+    Runs jobs on up to *max_workers* threads. Pending jobs with a higher priority run first; among jobs of the same
+    priority, *order* (one of transfer_orders) decides by job size. Worker threads are started as jobs are scheduled.
+    """
+    def __init__(self, max_workers, order="fifo"):
+        if order not in transfer_orders:
+            raise ValueError("Unknown transfer order {} (expected one of {})".format(order, ", ".join(transfer_orders)))
+        self.max_workers, self.order = max_workers, order
+        self._queue, self._workers, self._idle, self._shutdown = [], [], 0, False
+        self._sequence = itertools.count()
+        self._cond = threading.Condition()
+
+    def submit(self, fn, *args, **kwargs):
+        """Schedule fn(*args, **kwargs) with the default priority and an unknown size, like Executor.submit()."""
+        return self.schedule(fn, args, kwargs)
+
+    def schedule(self, fn, args=(), kwargs=None, size=0, priority=0):
+        """Schedule fn(*args, **kwargs), transferring *size* bytes, with *priority*. Returns a Future."""
+        future = Future()
+        size_key = dict(fifo=0, **{"largest-first": -size, "smallest-first": size})[self.order]
+        with self._cond:
+            if self._shutdown:
+                raise RuntimeError("cannot schedule new jobs after shutdown")
+            heapq.heappush(self._queue, (-priority, size_key, next(self._sequence), future, fn, args, kwargs or {}))
+            if self._idle == 0 and len(self._workers) < self.max_workers:
+                worker = threading.Thread(target=self._work)
+                worker.daemon = True
+                worker.start()
+                self._workers.append(worker)
+            else:
+                self._cond.notify()
+        return future
+
+    def _work(self):
+        while True:
+            with self._cond:
+                self._idle += 1
+                while not self._queue and not self._shutdown:
+                    self._cond.wait()
+                self._idle -= 1
+                if not self._queue:
+                    return
+                future, fn, args, kwargs = heapq.heappop(self._queue)[3:]
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = fn(*args, **kwargs)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        with self._cond:
+            self._shutdown = True
+            while cancel_futures and self._queue:
+                heapq.heappop(self._queue)[3].cancel()
+            self._cond.notify_all()
+        if wait:
+            for worker in self._workers:
+                worker.join()
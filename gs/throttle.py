@@ -0,0 +1,153 @@
+"""
+Client-side flow control for API requests.
+
+AdaptiveConcurrency limits the number of requests in flight with an AIMD (additive increase, multiplicative decrease)
+policy: the limit grows by about one per round of successful requests while latency stays near its baseline, and is
+halved when the service throttles (HTTP 429 or 503) or a request fails to connect. TokenBucket limits the rate of
+requests, and RetryBudget caps retries at a fraction of recent requests, so that a throttled bucket does not turn into
+a retry storm. All three are thread-safe and are shared by the clients that share a GSTransport.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import time, threading, logging
+
+from requests.packages.urllib3.exceptions import MaxRetryError, ResponseError
+from requests.packages.urllib3.util import retry
+
+logger = logging.getLogger(__name__)
+
+throttle_codes = frozenset({429, 503})
+
+class AdaptiveConcurrency(object):
+    """
+    An AIMD limit on concurrent requests, between *min_limit* and *max_limit*. Requests whose latency is more than
+    *latency_tolerance* times the lowest recent latency hold the limit steady instead of growing it. The limit is cut
+    at most once per smoothed latency, since requests already in flight when it was cut carry no new information.
+    """
+    def __init__(self, initial=8, min_limit=1, max_limit=64, backoff_ratio=0.5, latency_tolerance=2.0):
+        self.min_limit, self.max_limit = min_limit, max_limit
+        self.backoff_ratio, self.latency_tolerance = backoff_ratio, latency_tolerance
+        self.limit = float(max(min_limit, min(initial, max_limit)))
+        self.in_flight, self.throttled = 0, 0
+        self.min_latency, self.latency = None, None
+        self._backed_off_at = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        """Wait for a free slot, and return the time at which the request started."""
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                self._cond.wait()
+            self.in_flight += 1
+        return time.time()
+
+    def release(self, started_at, throttled=False, measure_latency=True):
+        """
+        Release a slot and adjust the limit. Set *measure_latency* to False for requests whose latency depends on
+        their size (e.g. uploads), so that they do not skew the baseline.
+        """
+        latency = time.time() - started_at
+        with self._cond:
+            self.in_flight -= 1
+            if throttled:
+                self._back_off()
+            else:
+                healthy = True
+                if measure_latency:
+                    if self.min_latency is None:
+                        self.min_latency = self.latency = latency
+                    # The baseline drifts towards recent latencies, so that it recovers from a change of network path
+                    self.min_latency = min(latency, self.min_latency + (latency - self.min_latency) * 0.001)
+                    self.latency += (latency - self.latency) * 0.1
+                    healthy = latency <= self.min_latency * self.latency_tolerance
+                if healthy:
+                    self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self._cond.notify_all()
+
+    def back_off(self):
+        """Record a throttling response that was retried before reaching release()."""
+        with self._cond:
+            self._back_off()
+
+    def _back_off(self):
+        now = time.time()
+        if now - self._backed_off_at < (self.latency or 1):
+            return
+        self._backed_off_at = now
+        self.throttled += 1
+        self.limit = max(self.min_limit, self.limit * self.backoff_ratio)
+        logger.debug("Throttled, reducing concurrency limit to %d", self.limit)
+
+class TokenBucket(object):
+    """
+    Limits a rate to *rate* units per second, with bursts of up to *burst* units (by default, one second's worth).
+    acquire() may take more than *burst* units at once; the caller then waits for the deficit to be refilled.
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(rate, 1))
+        self.tokens, self.updated = self.burst, time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self, n=1):
+        with self._lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= n
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+class RetryBudget(object):
+    """
+    Allows retries of up to *ratio* of the requests sent, plus *min_per_second* retries per second. Unused allowance
+    accumulates up to *max_balance* retries.
+    """
+    def __init__(self, ratio=0.2, min_per_second=5, max_balance=100):
+        self.ratio, self.min_per_second, self.max_balance = ratio, min_per_second, max_balance
+        self.balance, self.updated = float(max_balance), time.time()
+        self.exhausted = 0
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self.balance = min(self.max_balance, self.balance + self.ratio)
+
+    def withdraw(self, n=1):
+        """Return True if *n* retries may be sent."""
+        with self._lock:
+            now = time.time()
+            self.balance = min(self.max_balance, self.balance + (now - self.updated) * self.min_per_second)
+            self.updated = now
+            if self.balance < n:
+                self.exhausted += 1
+                return False
+            self.balance -= n
+            return True
+
+class AdaptiveRetry(retry.Retry):
+    """
+    A urllib3 retry policy that reports throttling responses to an AdaptiveConcurrency limit and charges each retry
+    to a RetryBudget, giving up once the budget is exhausted.
+    """
+    concurrency, budget = None, None
+
+    def bind(self, concurrency=None, budget=None):
+        bound = self.new()
+        bound.concurrency, bound.budget = concurrency, budget
+        return bound
+
+    def new(self, **kw):
+        new_retry = super(AdaptiveRetry, self).new(**kw)
+        new_retry.concurrency, new_retry.budget = self.concurrency, self.budget
+        return new_retry
+
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        if self.concurrency is not None and response is not None and response.status in throttle_codes:
+            self.concurrency.back_off()
+        if self.budget is not None and not self.budget.withdraw():
+            raise MaxRetryError(_pool, url, error or ResponseError("retry budget exhausted"))
+        return super(AdaptiveRetry, self).increment(method=method, url=url, response=response, error=error,
+                                                    _pool=_pool, _stacktrace=_stacktrace)
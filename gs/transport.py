@@ -0,0 +1,179 @@
+"""
+Shared HTTP transport with a bounded, instrumented connection pool and flow control.
+"""
+
+import time, threading, logging
+
+from requests.adapters import HTTPAdapter
+from requests.compat import urlparse
+from requests.packages.urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from .throttle import throttle_codes
+from .instrumentation import RequestRecord, classify_endpoint
+
+logger = logging.getLogger(__name__)
+
+def limited_pool_class(pool_class, connections):
+    """
+    Return a subclass of a urllib3 connection pool class whose connections are counted against the semaphore
+    *connections* from the time they are checked out of the pool until they are returned to it (for streamed
+    responses, once the body has been read or the response closed).
+    """
+    class LimitedConnectionPool(pool_class):
+        def _get_conn(self, timeout=None):
+            connections.acquire()
+            try:
+                return super(LimitedConnectionPool, self)._get_conn(timeout=timeout)
+            except BaseException:
+                connections.release()
+                raise
+
+        def _put_conn(self, conn):
+            try:
+                super(LimitedConnectionPool, self)._put_conn(conn)
+            finally:
+                connections.release()
+    return LimitedConnectionPool
+
+class GSTransport(HTTPAdapter):
+    """
+    An HTTPAdapter meant to be mounted on every session of one or more clients, so that keep-alive connections are
+    pooled and reused across threads. At most *max_connections* connections in total, across all hosts, are in use at
+    once: a request waits for a free connection, which it holds until its response has been read (or closed). If
+    *block* is False, connections beyond max_connections per host that are opened while the limit is not reached are
+    discarded after use instead of being kept alive. Pools of hosts that have not been used for a while are closed by
+    close_idle_connections().
+
+    Each request first waits for the *rate_limit* (a TokenBucket) and for a slot of *concurrency* (an
+    AdaptiveConcurrency limit, held until the response headers arrive), and deposits to *retry_budget* (a RetryBudget),
+    if given. The same objects should be bound to the retry policy given as max_retries (see AdaptiveRetry). Once a
+    request completes, each callable in *hooks* is called with its RequestRecord (see gs.instrumentation); the bodies
+    of responses that are not streamed are read before the hooks are called, so that their size is known.
+    """
+    sweep_interval = 10
+    large_body_size = 1024 * 1024
+
+    def __init__(self, max_connections=32, block=True, concurrency=None, rate_limit=None, retry_budget=None,
+                 hooks=None, **kwargs):
+        self.max_connections = max_connections
+        self._connections = threading.Semaphore(max_connections)
+        self.hooks = list(hooks or [])
+        self.concurrency, self.rate_limit, self.retry_budget = concurrency, rate_limit, retry_budget
+        self._lock = threading.Lock()
+        self._last_used = {}
+        self._last_sweep = time.time()
+        super(GSTransport, self).__init__(pool_maxsize=max_connections, pool_block=block, **kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super(GSTransport, self).init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = dict(
+            http=limited_pool_class(HTTPConnectionPool, self._connections),
+            https=limited_pool_class(HTTPSConnectionPool, self._connections)
+        )
+
+    def send(self, request, **kwargs):
+        if self.rate_limit is not None:
+            self.rate_limit.acquire()
+        if self.retry_budget is not None:
+            self.retry_budget.deposit()
+        slot_acquired_at = self.concurrency.acquire() if self.concurrency is not None else None
+        started_at, res, error = time.time(), None, None
+        try:
+            res = super(GSTransport, self).send(request, **kwargs)
+            if self.hooks and not kwargs.get("stream"):
+                res.content
+            return res
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            latency = time.time() - started_at
+            if request.body is None or hasattr(request.body, "__len__"):
+                body_size = len(request.body or b"")
+            else:
+                body_size = int(request.headers.get("Content-Length", 0))
+            if slot_acquired_at is not None:
+                # The latency of requests with large bodies reflects their size rather than the load on the service
+                measure_latency = body_size < self.large_body_size and hasattr(request.body or b"", "__len__")
+                self.concurrency.release(slot_acquired_at, throttled=res is None or res.status_code in throttle_codes,
+                                         measure_latency=measure_latency)
+            if self.hooks:
+                self._call_hooks(request, res, error, started_at, latency, body_size)
+            url = urlparse(request.url)
+            port = url.port or (443 if url.scheme == "https" else 80)
+            self._last_used[(url.scheme, url.hostname, port)] = time.time()
+
+    def _call_hooks(self, request, res, error, started_at, latency, bytes_sent):
+        bytes_received, retries = 0, 0
+        if res is not None:
+            if res.raw is not None and getattr(res.raw, "retries", None) is not None:
+                retries = len(res.raw.retries.history)
+            if res._content_consumed and res.raw is not None and hasattr(res.raw, "tell"):
+                bytes_received = res.raw.tell()
+            else:
+                bytes_received = int(res.headers.get("Content-Length", 0))
+        record = RequestRecord(started_at=started_at, method=request.method,
+                               endpoint=classify_endpoint(request.method, request.url), url=request.url,
+                               status=res.status_code if res is not None else None, latency=latency,
+                               bytes_sent=bytes_sent, bytes_received=bytes_received, retries=retries, error=error)
+        for hook in self.hooks:
+            try:
+                hook(record)
+            except Exception as e:
+                logger.debug("Error in request hook %s: %s", hook, e)
+
+    def _get_pools(self):
+        pools = []
+        for key in list(self.poolmanager.pools.keys()):
+            try:
+                pools.append((key, self.poolmanager.pools[key]))
+            except KeyError:
+                pass
+        return pools
+
+    @staticmethod
+    def _count_idle(pool):
+        return sum(1 for conn in list(pool.pool.queue) if conn is not None) if pool.pool is not None else 0
+
+    def close_idle_connections(self, idle_timeout=60):
+        """
+        Close the connection pools of hosts that have had no requests for *idle_timeout* seconds. Runs at most once
+        every sweep_interval seconds, so it is cheap to call before every request. Returns the number of idle
+        connections closed.
+        """
+        now, closed = time.time(), 0
+        with self._lock:
+            if now - self._last_sweep < min(idle_timeout, self.sweep_interval):
+                return closed
+            self._last_sweep = now
+            for key, pool in self._get_pools():
+                if now - self._last_used.get((pool.scheme, pool.host, pool.port), 0) > idle_timeout:
+                    closed += self._count_idle(pool)
+                    try:
+                        del self.poolmanager.pools[key]
+                    except KeyError:
+                        pass
+        if closed:
+            logger.debug("Closed %d idle connections", closed)
+        return closed
+
+    def should_retry(self, n=1, throttled=False):
+        """Report the outcome of subrequests retried outside of urllib3, and return True if *n* retries are allowed."""
+        if throttled and self.concurrency is not None:
+            self.concurrency.back_off()
+        return self.retry_budget is None or self.retry_budget.withdraw(n)
+
+    def stats(self):
+        """
+        Return a dict of connection pool statistics keyed by host URL: connections opened, requests sent, currently
+        idle (kept-alive) connections and the pool size limit.
+        """
+        stats = {}
+        for key, pool in self._get_pools():
+            stats["{}://{}:{}".format(pool.scheme, pool.host, pool.port)] = dict(
+                connections_opened=pool.num_connections,
+                requests=pool.num_requests,
+                idle_connections=self._count_idle(pool),
+                max_connections=self.max_connections
+            )
+        return stats
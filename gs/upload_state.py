@@ -0,0 +1,79 @@
+"""
+Persistent store of resumable upload sessions.
+
+Each entry maps a local file (by path, size and mtime) and its destination to the ID of a resumable upload session, so
+that an interrupted upload can be resumed by a later gs process. Entries are kept in a SQLite file under the gs config
+directory, which can be shared by concurrent threads and processes. The least recently used entries are evicted beyond
+max_entries, and entries older than the lifetime of an upload session are discarded.
+"""
+
+import os, time, base64, hashlib, sqlite3, threading, logging
+
+from .util.compat import makedirs
+
+logger = logging.getLogger(__name__)
+
+class UploadStateStore:
+    max_entries = 10000
+    ttl = 7 * 24 * 60 * 60  # Resumable upload sessions expire after one week
+    lock_timeout = 30
+
+    def __init__(self, path, max_entries=None, ttl=None):
+        self.path = path
+        if max_entries is not None:
+            self.max_entries = max_entries
+        if ttl is not None:
+            self.ttl = ttl
+        makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=self.lock_timeout, check_same_thread=False)
+        with self._db:
+            self._db.execute("CREATE TABLE IF NOT EXISTS uploads "
+                             "(key TEXT PRIMARY KEY, upload_id TEXT, created REAL, accessed REAL)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS uploads_accessed ON uploads (accessed)")
+
+    @classmethod
+    def open(cls, client):
+        return cls(os.path.join(client.config.user_config_dir, "uploads.db"))
+
+    @staticmethod
+    def make_key(path, dest_bucket, dest_key):
+        st = os.stat(path)
+        key_data = "\0".join([os.path.abspath(path), str(st.st_size), str(st.st_mtime), dest_bucket, dest_key])
+        return base64.b64encode(hashlib.md5(key_data.encode()).digest()).decode()
+
+    def get(self, key):
+        """Return the upload ID recorded for *key*, or None if there is none or it has expired."""
+        now = time.time()
+        with self._lock, self._db:
+            row = self._db.execute("SELECT upload_id, created FROM uploads WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if row[1] < now - self.ttl:
+                self._db.execute("DELETE FROM uploads WHERE key = ?", (key,))
+                return None
+            self._db.execute("UPDATE uploads SET accessed = ? WHERE key = ?", (now, key))
+            return row[0]
+
+    def put(self, key, upload_id):
+        now = time.time()
+        with self._lock, self._db:
+            self._db.execute("INSERT OR REPLACE INTO uploads VALUES (?, ?, ?, ?)", (key, upload_id, now, now))
+            self._evict(now)
+
+    def remove(self, key):
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM uploads WHERE key = ?", (key,))
+
+    def _evict(self, now):
+        self._db.execute("DELETE FROM uploads WHERE created < ?", (now - self.ttl,))
+        self._db.execute("DELETE FROM uploads WHERE key NOT IN "
+                         "(SELECT key FROM uploads ORDER BY accessed DESC LIMIT ?)", (self.max_entries,))
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM uploads").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
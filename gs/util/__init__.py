@@ -1,4 +1,4 @@
-import os, sys, struct, warnings, functools
+import os, sys, struct, warnings, functools, collections, concurrent.futures
 from datetime import datetime
 
 from dateutil.parser import parse as dateutil_parse
@@ -6,6 +6,7 @@ from dateutil.relativedelta import relativedelta
 import requests.exceptions
 
 from .compat import USING_PYTHON2
+from .exceptions import GSBatchError
 
 class Timestamp(datetime):
     """
@@ -28,17 +29,80 @@ class Timestamp(datetime):
         except (ValueError, OverflowError, AssertionError):
             raise ValueError('Could not parse "{}" as a timestamp or time delta'.format(t))
 
+class ByteSize(int):
+    """
+    A number of bytes, with an optional binary unit suffix (K, M, G, T, as printed by format_number), e.g. 512K, 1.5G.
+    """
+    def __new__(cls, n):
+        units = dict(K=1024, M=1024 ** 2, G=1024 ** 3, T=1024 ** 4)
+        try:
+            s = str(n).strip().upper().rstrip("B")
+            return int.__new__(cls, float(s[:-1]) * units[s[-1]] if s[-1:] in units else float(s))
+        except (ValueError, OverflowError):
+            raise ValueError('Could not parse "{}" as a number of bytes'.format(n))
+
 class CRC32C:
-    def __init__(self, data=None):
+    def __init__(self, data=None, initial=0):
+        """
+        To continue a checksum computed earlier (for example, one saved in a checkpoint), pass its value() as
+        *initial*.
+        """
         import crc32c
         self._crc32c = crc32c
-        self._csum = crc32c.crc32(data if data is not None else b"")
+        self._csum = crc32c.crc32(data if data is not None else b"", initial)
 
     def update(self, data):
         self._csum = self._crc32c.crc32(data, self._csum)
 
+    def combine(self, other, length):
+        """
+        Extend this checksum with the checksum of a block of *length* bytes that immediately follows the data hashed
+        so far, as if that block had been passed to update().
+        """
+        self._csum = crc32c_combine(self._csum, other._csum, length)
+
+    def value(self):
+        return self._csum
+
     def digest(self):
-        return long_to_bytes(self._csum)
+        return struct.pack(b">I", self._csum)
+
+def _gf2_matrix_times(mat, vec):
+    s, i = 0, 0
+    while vec:
+        if vec & 1:
+            s ^= mat[i]
+        vec >>= 1
+        i += 1
+    return s
+
+def _gf2_matrix_square(mat):
+    return [_gf2_matrix_times(mat, mat[n]) for n in range(32)]
+
+def crc32c_combine(crc1, crc2, len2):
+    """
+    Given the CRC32C checksums of two adjacent blocks and the length of the second block, return the checksum of their
+    concatenation. This is the zlib crc32_combine() algorithm over the (reflected) Castagnoli polynomial.
+    """
+    if len2 <= 0:
+        return crc1
+    odd = [0x82F63B78] + [1 << n for n in range(31)]
+    even = _gf2_matrix_square(odd)
+    odd = _gf2_matrix_square(even)
+    while True:
+        even = _gf2_matrix_square(odd)
+        if len2 & 1:
+            crc1 = _gf2_matrix_times(even, crc1)
+        len2 >>= 1
+        if len2 == 0:
+            break
+        odd = _gf2_matrix_square(even)
+        if len2 & 1:
+            crc1 = _gf2_matrix_times(odd, crc1)
+        len2 >>= 1
+        if len2 == 0:
+            break
+    return crc1 ^ crc2
 
 def long_to_bytes(n):
     s = b''
@@ -75,8 +139,42 @@ def format_http_errors(fn):
             except Exception:
                 msg = "{}: {}".format(type(e).__name__, e)
             exit(msg)
+        except GSBatchError as e:
+            exit(str(e))
     return error_formatter
 
+class InlineExecutor(object):
+    """An executor that runs each submitted call on the calling thread, for use in place of a pool of one thread."""
+    def submit(self, fn, *args, **kwargs):
+        future = concurrent.futures.Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+def submit_bounded(submit, iterable, max_in_flight):
+    """
+    Call submit(kwargs), which returns a future, for each dict of keyword arguments in *iterable*, consuming the
+    iterable lazily so that at most *max_in_flight* futures are pending at once. Yields (kwargs, future) as each future
+    completes.
+    """
+    pending = {}
+    for kwargs in iterable:
+        pending[submit(kwargs)] = kwargs
+        if len(pending) >= max_in_flight:
+            done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                yield pending.pop(future), future
+    for future in concurrent.futures.as_completed(list(pending)):
+        yield pending.pop(future), future
+
 def batches(iterable, batch_size=None):
     batch = []
     for i in iterable:
@@ -7,6 +7,8 @@ USING_PYTHON2 = True if sys.version_info < (3, 0) else False
 if USING_PYTHON2:
     from multiprocessing import cpu_count
     from thread import get_ident
+    from Queue import Queue, Empty, Full
+    from urlparse import urlparse, parse_qs
     from StringIO import StringIO
     from repr import Repr
     str = unicode # noqa
@@ -44,6 +46,8 @@ if USING_PYTHON2:
         return True if threading.current_thread().name == "MainThread" else False
 else:
     from threading import get_ident
+    from queue import Queue, Empty, Full
+    from urllib.parse import urlparse, parse_qs
     from io import StringIO
     from reprlib import Repr
     str = str
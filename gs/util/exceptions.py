@@ -8,3 +8,21 @@ class GetFieldError(GSException):
 
 class NoServiceCredentials(GSException):
     pass
+
+class GSBatchError(GSException):
+    """
+    Raised when one or more subrequests of a batch request fail. The parsed subresponses for all subrequests, including
+    the successful ones, are available in the *responses* attribute.
+    """
+    def __init__(self, message, responses=None):
+        super(GSBatchError, self).__init__(message)
+        self.responses = responses or []
+
+class GSTransferError(GSException):
+    """
+    Raised when one or more transfers of a multi-object copy or move fail. The other transfers are still carried out.
+    The *errors* attribute is a list of (transfer arguments, exception) tuples.
+    """
+    def __init__(self, message, errors=None):
+        super(GSTransferError, self).__init__(message)
+        self.errors = errors or []
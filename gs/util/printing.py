@@ -1,7 +1,7 @@
 # coding: utf-8
 from __future__ import absolute_import, division, print_function, unicode_literals
 
-import os, sys, json, shutil, subprocess, re, errno, threading
+import os, sys, json, shutil, subprocess, re, errno, threading, time, itertools
 from datetime import datetime, timedelta
 import click
 from .exceptions import GetFieldError, GSException
@@ -275,8 +275,137 @@ def tabulate(collection, args, cell_transforms=None):
         format_args = dict(auto_col_width=True) if args.max_col_width == 0 else dict(max_col_width=args.max_col_width)
         return format_table(table, column_names=getattr(args, "display_column_names", args.columns), **format_args)
 
-def get_progressbar(**kwargs):
+def format_table_rows(collection, args, cell_transforms=None, sample_size=1000):
+    """
+    Like tabulate(), but yield the lines of the table one by one as items are read from *collection*. Column widths are
+    fixed from the first *sample_size* rows (at most args.max_col_width), and longer cells in later rows are truncated,
+    so that only the sample is held in memory.
+    """
+    cell_transforms = dict(cell_transforms or {}, tags=format_tags)
+    collection = iter(collection)
+
+    def format_row(item):
+        return [str(format_cell(get_cell(item, f, cell_transforms.get(f)))) for f in args.columns]
+
+    column_names = [str(c) for c in trim_names(args.columns, *getattr(args, "trim_col_names", []))]
+    column_names = getattr(args, "display_column_names", column_names)
+    sample = [format_row(item) for item in itertools.islice(collection, sample_size)]
+    col_widths = [max([len(c)] + [len(strip_ansi_codes(row[i])) for row in sample]) for i, c in enumerate(column_names)]
+    if args.max_col_width:
+        col_widths = [min(w, args.max_col_width) for w in col_widths]
+    elif sys.stdout.isatty():
+        tty_cols = max(get_terminal_size()[0], 80)
+        while sum(col_widths) + len(col_widths) + 1 > tty_cols and max(col_widths) > 1:
+            col_widths[col_widths.index(max(col_widths))] -= 1
+
+    def format_line(row, color=""):
+        cells = [ansi_truncate(cell, w) for cell, w in zip(row, col_widths)]
+        padded = [color + c + (ENDC() if color else "") + " " * (w - len(strip_ansi_codes(c)))
+                  for c, w in zip(cells, col_widths)]
+        return border("│") + border("│").join(padded) + border("│")
+
+    yield border("┌") + border("┬").join(border("─") * w for w in col_widths) + border("┐")
+    yield format_line(column_names, color=BOLD() + WHITE())
+    yield border("├") + border("┼").join(border("─") * w for w in col_widths) + border("┤")
+    for row in sample:
+        yield format_line(row)
+    del sample[:]
+    for item in collection:
+        yield format_line(format_row(item))
+    yield border("└") + border("┴").join(border("─") * w for w in col_widths) + border("┘")
+
+def format_jsonl(collection, args, cell_transforms=None):
+    """Yield each item of *collection* as one line of JSON with the fields in args.columns."""
+    cell_transforms = dict(cell_transforms or {}, tags=format_tags)
+    for i in collection:
+        yield json.dumps({f: get_cell(i, f, cell_transforms.get(f)) for f in args.columns}, default=lambda x: str(x))
+
+def stream_output(lines, pager=None, file=None):
+    """
+    Write lines to *file* (stdout by default) as they are produced. On a terminal, lines are held back until they
+    overflow the screen, and are then piped through the pager (which stops the output if the pager exits).
+    """
+    if file is None:
+        file = sys.stdout
+    lines = iter(lines)
+    if file == sys.stdout and file.isatty():
+        tty_cols, tty_rows = get_terminal_size()
+        head = []
+        for line in lines:
+            head.append(line)
+            if len(head) >= tty_rows or len(strip_ansi_codes(line)) > tty_cols:
+                break
+        else:
+            lines = iter(head)
+            head = None
+        if head is not None:
+            pager_process = subprocess.Popen(pager or os.environ.get("PAGER", "less -RS"), shell=True,
+                                             stdin=subprocess.PIPE, stdout=file)
+            try:
+                for line in itertools.chain(head, lines):
+                    pager_process.stdin.write((line + "\n").encode("utf-8"))
+                pager_process.stdin.close()
+            except IOError as e:
+                if e.errno != errno.EPIPE:
+                    raise
+            finally:
+                pager_process.wait()
+            return
+    for line in lines:
+        line += "\n"
+        file.write(line.encode("utf-8") if USING_PYTHON2 else line)
+    file.flush()
+
+class NullProgressBar(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def update(self, n_steps):
+        pass
+
+def get_progressbar(hidden=False, **kwargs):
+    if hidden:
+        return NullProgressBar()
     bar = click.progressbar(**kwargs)
     if not thread_is_main():
-        bar.is_hidden = True
+        bar.is_hidden = bar.hidden = True
     return bar
+
+class TransferProgress(object):
+    """
+    A one-line summary of the progress of a multi-object transfer (objects and bytes transferred, transfer rate and
+    failures), redrawn on a terminal at most every *interval* seconds.
+    """
+    def __init__(self, verb="Copied", file=None, interval=0.5):
+        self.verb, self.file, self.interval = verb, file or sys.stderr, interval
+        self.count, self.nbytes, self.failed = 0, 0, 0
+        self.started_at = self._rendered_at = time.time()
+        self.enabled = self.file.isatty() and thread_is_main()
+
+    def update(self, nbytes=0, failed=False):
+        if failed:
+            self.failed += 1
+        else:
+            self.count += 1
+            self.nbytes += nbytes
+        if self.enabled and time.time() - self._rendered_at >= self.interval:
+            self.render()
+
+    def format(self):
+        rate = self.nbytes / max(time.time() - self.started_at, 1e-3)
+        msg = "{} {} objects ({}, {}/s)".format(self.verb, self.count, format_number(self.nbytes),
+                                                format_number(int(rate)))
+        return msg + (", {} failed".format(self.failed) if self.failed else "")
+
+    def render(self):
+        self.file.write("\r" + self.format() + "\033[K")
+        self.file.flush()
+        self._rendered_at = time.time()
+
+    def close(self):
+        if self.enabled and self.count + self.failed > 0:
+            self.render()
+            self.file.write("\n")
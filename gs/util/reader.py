@@ -0,0 +1,137 @@
+"""
+Zero-copy upload bodies.
+
+MappedFileReader presents a byte range of a file as a read-only file-like object backed by mmap. Its read() method
+returns memoryview slices of the mapping, which requests, urllib3 and http.client pass to socket.sendall() without
+copying (on Python 2, where mmap does not support memoryview, it returns copied slices). The data is hashed by a
+HashWorker thread, so that hashing (which releases the GIL for large buffers) overlaps with sending.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os, mmap, threading
+
+from .compat import Queue, USING_PYTHON2
+
+class HashWorker(threading.Thread):
+    """
+    Feeds buffers to one or more hashers (objects with an update() method) on a separate thread. The buffers of the
+    iterable *first* are hashed before any passed to update(), without being queued. At most *max_pending* buffers are
+    queued, so the producer waits when hashing falls behind.
+    """
+    def __init__(self, hashers, max_pending=4, first=()):
+        super(HashWorker, self).__init__()
+        self.daemon = True
+        self.hashers = hashers
+        self.error = None
+        self._first = first
+        self._queue = Queue(maxsize=max_pending)
+        self.start()
+
+    def _hash(self, data):
+        if self.error is None:
+            try:
+                for hasher in self.hashers:
+                    hasher.update(data)
+            except Exception as e:
+                self.error = e
+
+    def run(self):
+        for data in self._first:
+            self._hash(data)
+        self._first = None
+        while True:
+            data = self._queue.get()
+            if data is None:
+                break
+            self._hash(data)
+
+    def update(self, data):
+        self._queue.put(data)
+
+    def finish(self):
+        """Wait for all queued buffers to be hashed. Re-raises any exception raised by a hasher."""
+        if self.is_alive():
+            self._queue.put(None)
+            self.join()
+        if self.error is not None:
+            raise self.error
+
+class MappedFileReader(object):
+    """
+    A file-like object for the *length* bytes of *filename* starting at *start* (by default, the rest of the file).
+
+    read() returns memoryviews of up to *block_size* bytes, regardless of the size requested: HTTP clients read bodies
+    in small blocks that they pass unchanged to sendall(), and larger blocks mean fewer system calls. Each byte is
+    passed to *hasher* once, in order, even if the body is rewound and sent again (as urllib3 does when it retries a
+    request). If *hash_from* is less than *start*, the bytes from *hash_from* to *start* are hashed first, by the
+    hashing thread while the body is being sent, so that a resumed upload can verify the checksum of the whole file.
+    Call close() (or use the reader as a context manager) once the body has been sent, to wait for hashing to complete.
+    """
+    def __init__(self, filename, hasher, start=0, length=None, hash_from=None, block_size=16 * 1024 * 1024,
+                 on_progress=None):
+        self.name, self.block_size, self.on_progress = filename, block_size, on_progress
+        with open(filename, "rb") as fh:
+            file_size = os.fstat(fh.fileno()).st_size
+            if length is None:
+                length = file_size - start
+            if start + length > file_size:
+                raise Exception("Unexpected end of file in {} at {}".format(filename, file_size))
+            self._mmap = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) if file_size > 0 else None
+        if self._mmap is None:
+            self._view = b""
+        elif USING_PYTHON2:
+            self._view = self._mmap  # mmap has no buffer interface on Python 2; slices are copies
+        else:
+            self._view = memoryview(self._mmap)
+        self._start, self._length, self._pos = start, length, 0
+        hash_from = start if hash_from is None else hash_from
+        prefix = (self._view[offset:min(offset + block_size, start)] for offset in range(hash_from, start, block_size))
+        self._hash_worker = HashWorker([hasher], first=prefix)
+        self._hashed_to = start
+
+    def __len__(self):
+        return self._length
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._pos
+        elif whence == os.SEEK_END:
+            offset += self._length
+        self._pos = max(0, min(offset, self._length))
+        return self._pos
+
+    def read(self, size=-1):
+        end = min(self._pos + max(size, self.block_size), self._length)
+        if end <= self._pos:
+            return b""
+        data = self._view[self._start + self._pos:self._start + end]
+        if self._start + end > self._hashed_to:
+            self._hash_worker.update(self._view[self._hashed_to:self._start + end])
+            if self.on_progress is not None:
+                self.on_progress(self._start + end - self._hashed_to)
+            self._hashed_to = self._start + end
+        self._pos = end
+        return data
+
+    def close(self):
+        """Wait for hashing to complete and release the mapping."""
+        try:
+            self._hash_worker.finish()
+        finally:
+            if hasattr(self._view, "release"):
+                self._view.release()
+            if self._mmap is not None:
+                try:
+                    self._mmap.close()
+                except BufferError:
+                    pass  # A slice is still referenced by the HTTP client; the mapping is closed when it is freed
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -18,7 +18,8 @@ setup(
     install_requires=install_requires,
     tests_require=tests_require,
     extras_require={
-        ':python_version == "2.7"': ['futures']
+        ':python_version == "2.7"': ['futures'],
+        'async': ['aiohttp >= 3.6, < 4']
     },
     packages=find_packages(exclude=['test']),
     entry_points={
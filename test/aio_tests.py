@@ -0,0 +1,62 @@
+# coding: utf-8
+"""
+Tests of AsyncGSClient, which use syntax that needs Python 3.6+. They are loaded by test_aio.
+"""
+
+import os, sys, unittest, tempfile, asyncio
+
+import tweak
+
+from gs.credentials import GSCredentials
+from .gcs_server import GCSServer
+
+try:
+    from gs.aio import AsyncGSClient
+    import aiohttp
+except (ImportError, SyntaxError):
+    AsyncGSClient = None
+
+@unittest.skipIf(AsyncGSClient is None, "aiohttp is not installed")
+class TestAsyncGSClient(unittest.TestCase):
+    def setUp(self):
+        self.server = GCSServer().start()
+        self.server.state.page_size = 7
+        self.config = tweak.Config("gs", save_on_exit=False)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def run_async(self, coro):
+        return asyncio.new_event_loop().run_until_complete(coro)
+
+    def get_client(self, **kwargs):
+        credentials = GSCredentials(self.config, anonymous=True)
+        return self.server.configure(AsyncGSClient(config=self.config, credentials=credentials, **kwargs))
+
+    def test_upload_list_download(self):
+        payload = os.urandom(600 * 1024 + 1)
+
+        async def main():
+            async with self.get_client(max_concurrency=8) as client:
+                with tempfile.NamedTemporaryFile() as tf, tempfile.TemporaryDirectory() as td:
+                    tf.write(payload)
+                    tf.flush()
+                    resource = await client.upload(tf.name, "test", "big", chunk_size=256 * 1024)
+                    self.assertEqual(int(resource["size"]), len(payload))
+                    await asyncio.gather(*[client.upload(tf.name, "test", "d/{}".format(i)) for i in range(20)])
+                    names = [i["name"] async for i in client.list("b/test/o", params=dict(prefix="d/"))]
+                    self.assertEqual(sorted(names), sorted("d/{}".format(i) for i in range(20)))
+                    items = [i async for i in client.list("b/test/o", params=dict(delimiter="/"))]
+                    self.assertEqual([i["name"] for i in items], ["d/", "big"])
+                    metadata = await asyncio.gather(*[client.get("b/test/o/d%2F{}".format(i)) for i in range(20)])
+                    self.assertEqual({m["md5Hash"] for m in metadata}, {resource["md5Hash"]})
+                    await client.download("test", "big", os.path.join(td, "big"))
+                    with open(os.path.join(td, "big"), "rb") as fh:
+                        self.assertEqual(fh.read(), payload)
+                    chunks = [c async for c in client.stream_media("test", "big", chunk_size=4096)]
+                    self.assertEqual(b"".join(chunks), payload)
+                    await client.delete("b/test/o/big")
+                    with self.assertRaises(aiohttp.ClientResponseError):
+                        await client.get("b/test/o/big")
+
+        self.run_async(main())
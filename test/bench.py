@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Benchmarks of gs commands against the in-process GCS stand-in (test/gcs_server.py):
+
+- ls: paging through a large listing
+- cp_large: uploading and downloading a large (1G at --scale 1) file in parallel parts and slices
+- cp_small: uploading and downloading many small files
+- sync: diffing a tree of files against a listing of the same size, with nothing to transfer
+- rm: deleting a large prefix with batch requests
+
+Results (elapsed time, throughput, request count and p50/p99 request latency) are appended to the output file, one
+line per benchmark. The simulated network latency and bandwidth apply to every request, and --scale shrinks or grows
+the workloads (the default is sized for a developer machine; sync at --scale 1 diffs 1M entries).
+
+    python -m test.bench --output bench_output.txt --latency 0.005 ls sync
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os, sys, time, shutil, tempfile, argparse, logging, itertools, platform, datetime
+
+from .gcs_server import GCSServer
+
+bucket = "gs-bench"
+
+class Benchmark(object):
+    def __init__(self, server, scale):
+        from gs import cli
+        self.server, self.scale, self.cli = server, scale, cli
+        self.stats = None
+        self.workdir = tempfile.mkdtemp()
+
+    def scaled(self, n):
+        return max(1, int(n * self.scale))
+
+    def run_cli(self, *args):
+        stdout, sys.stdout = sys.stdout, open(os.devnull, "w")
+        try:
+            self.cli.cli.main(list(args), standalone_mode=False)
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+
+    def measure(self, name, items, nbytes, fn, *args):
+        """Run fn(*args) and return a result line for *items* objects or files and *nbytes* bytes transferred."""
+        from gs.instrumentation import RequestStats
+        hooks = self.cli.client.transport.hooks
+        if self.stats in hooks:
+            hooks.remove(self.stats)
+        self.stats = stats = RequestStats()
+        hooks.append(stats)
+        started_at = time.time()
+        fn(*args)
+        elapsed = time.time() - started_at
+        summary = stats.summary()
+        latencies = sorted(latency for e in stats.endpoints.values() for latency in e["latencies"])
+        return ("{name:<18} {elapsed:8.2f}s {items:>9} items {item_rate:10.1f} items/s {byte_rate:8.1f} MB/s "
+                "{requests:>7} requests p50 {p50:6.1f}ms p99 {p99:6.1f}ms").format(
+                    name=name, elapsed=elapsed, items=items, item_rate=items / elapsed,
+                    byte_rate=nbytes / elapsed / 1e6, requests=summary["requests"],
+                    p50=stats.percentile(latencies, 0.5) * 1000, p99=stats.percentile(latencies, 0.99) * 1000)
+
+    def make_files(self, dirname, count, size, per_dir=1000):
+        names = []
+        data = os.urandom(size)
+        for i in range(count):
+            subdir = os.path.join(dirname, "d{:04d}".format(i // per_dir))
+            if i % per_dir == 0:
+                os.makedirs(subdir)
+            names.append(os.path.join(subdir, "f{:06d}".format(i)))
+            with open(names[-1], "wb") as fh:
+                fh.write(data)
+        return names
+
+    def bench_ls(self):
+        count = self.scaled(200000)
+        self.server.state.populate(bucket, ["ls/{:08d}".format(i) for i in range(count)])
+        yield self.measure("ls", count, 0, self.run_cli, "ls", "gs://{}/ls/".format(bucket))
+        yield self.measure("ls --jsonl", count, 0, self.run_cli, "ls", "--jsonl", "gs://{}/ls/".format(bucket))
+
+    def bench_cp_large(self):
+        # Files of 64M or more are uploaded in parts and downloaded in slices
+        size = max(self.scaled(1024 * 1024 * 1024), 64 * 1024 * 1024)
+        filename = os.path.join(self.workdir, "large")
+        with open(filename, "wb") as fh:
+            for _ in range(0, size, 1024 * 1024):
+                fh.write(os.urandom(min(1024 * 1024, size - fh.tell())))
+        url = "gs://{}/large/large".format(bucket)
+        yield self.measure("cp_large upload", 1, size, self.run_cli, "cp", "--upload-parts", "8", filename, url)
+        os.unlink(filename)
+        yield self.measure("cp_large download", 1, size, self.run_cli, "cp", "--download-slices", "8", url, filename)
+
+    def bench_cp_small(self):
+        count, size = self.scaled(2000), 4096
+        dirname = os.path.join(self.workdir, "small")
+        filenames = self.make_files(dirname, count, size)
+        prefix = "gs://{}/small/".format(bucket)
+        yield self.measure("cp_small upload", count, count * size, self.run_cli, "cp", *(filenames + [prefix]))
+        shutil.rmtree(dirname)
+        os.makedirs(dirname)
+        yield self.measure("cp_small download", count, count * size, self.run_cli, "cp", prefix + "*", dirname)
+
+    def bench_sync(self):
+        count = self.scaled(1000000)
+        dirname = os.path.join(self.workdir, "sync")
+        filenames = self.make_files(dirname, count, 0)
+        # Remote objects must be newer than the local files for sync to skip them
+        time.sleep(1.1)
+        self.server.state.populate(bucket, ["sync/" + os.path.relpath(f, dirname) for f in filenames])
+        yield self.measure("sync (no changes)", count, 0, self.run_cli, "sync", dirname, "gs://{}/sync/".format(bucket))
+
+    def bench_rm(self):
+        count = self.scaled(100000)
+        self.server.state.populate(bucket, ["rm/{:08d}".format(i) for i in range(count)])
+        yield self.measure("rm --recursive", count, 0, self.run_cli, "rm", "--recursive", "gs://{}/rm/".format(bucket))
+
+    def close(self):
+        shutil.rmtree(self.workdir)
+
+benchmarks = ["ls", "cp_large", "cp_small", "sync", "rm"]
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("benchmarks", nargs="*", metavar="BENCHMARK",
+                        help="Run only these benchmarks ({})".format(", ".join(benchmarks)))
+    parser.add_argument("--output", default="bench_output.txt", help="Append results to this file")
+    parser.add_argument("--latency", type=float, default=0, help="Simulated latency of each request, in seconds")
+    parser.add_argument("--bandwidth", type=float, help="Simulated bandwidth of each connection, in bytes per second")
+    parser.add_argument("--scale", type=float, default=0.1, help="Scale the number and size of objects by this factor")
+    args = parser.parse_args(args)
+    for name in args.benchmarks:
+        if name not in benchmarks:
+            parser.error("Unknown benchmark {}".format(name))
+
+    # Keep manifests and upload state out of the user's configuration directory
+    config_dir = tempfile.mkdtemp()
+    os.environ["XDG_CONFIG_HOME"] = config_dir
+    logging.basicConfig(level=logging.WARNING)
+    from gs import cli
+
+    with GCSServer() as server:
+        server.state.latency, server.state.bandwidth = args.latency, args.bandwidth
+        for client in cli.client, cli.upload_client, cli.batch_client:
+            server.configure(client)
+        cli.client.credentials.anonymous = True
+        benchmark = Benchmark(server, args.scale)
+        header = "# {} python {} scale={} latency={}s bandwidth={}".format(
+            datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"), platform.python_version(), args.scale,
+            args.latency, args.bandwidth or "unlimited")
+        with open(args.output, "a") as fh:
+            results = (getattr(benchmark, "bench_" + name)() for name in args.benchmarks or benchmarks)
+            for line in itertools.chain([header], *results):
+                print(line)
+                fh.write(line + "\n")
+                fh.flush()
+        benchmark.close()
+    shutil.rmtree(config_dir)
+
+if __name__ == "__main__":
+    main()
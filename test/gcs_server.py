@@ -0,0 +1,425 @@
+# coding: utf-8
+"""
+In-process stand-in for the parts of the Google Cloud Storage JSON API used by gs: object listing, metadata, media
+download (with Range, and decompressive transcoding of gzip-encoded objects), media and resumable upload, patch,
+compose, copy, rewrite, delete and batch requests, with partial responses (fields=). Objects are kept in memory.
+
+Network conditions can be simulated by setting attributes of the server state: *latency* (seconds added to each
+request), *bandwidth* (bytes per second at which each request and response body is transferred), and
+*max_concurrent_requests* (beyond which requests are throttled with HTTP 429).
+
+    with GCSServer() as server:
+        client = server.configure(GSClient(config=...))
+"""
+
+import os, sys, json, base64, hashlib, threading, itertools, datetime, re, zlib, time, bisect
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlsplit, parse_qsl, unquote, quote
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlsplit, parse_qsl
+    from urllib import unquote, quote
+
+from gs.util import CRC32C
+
+class HTTPError(Exception):
+    def __init__(self, status, message=""):
+        super(HTTPError, self).__init__(message)
+        self.status, self.message = status, message
+
+def parse_fields(spec):
+    """Parse a partial response projection such as "nextPageToken,items(name,size)" into a tree of dicts."""
+    tree, stack, name = {}, [], ""
+    for c in spec + ",":
+        if c in ",()" and name:
+            tree[name.strip()] = None
+        if c == "(":
+            stack.append(tree)
+            tree[name.strip()] = tree = {}
+        elif c == ")":
+            tree = stack.pop()
+        if c in ",()":
+            name = ""
+        else:
+            name += c
+    return tree
+
+def project(value, tree):
+    if tree is None:
+        return value
+    if isinstance(value, list):
+        return [project(v, tree) for v in value]
+    return {k: project(value[k], tree[k]) for k in tree if k in value}
+
+class Bucket(object):
+    def __init__(self, name):
+        self.name, self.objects, self.lock = name, {}, threading.Lock()
+        self._sorted_names = None
+
+    def sorted_names(self):
+        """Return the sorted object names, which are cached until an object is added or deleted. Call with lock held."""
+        if self._sorted_names is None:
+            self._sorted_names = sorted(self.objects)
+        return self._sorted_names
+
+    def put(self, name, resource, data):
+        with self.lock:
+            if name not in self.objects:
+                self._sorted_names = None
+            self.objects[name] = (resource, data)
+
+    def delete(self, name):
+        with self.lock:
+            del self.objects[name]
+            self._sorted_names = None
+
+class GCSState(object):
+    page_size = 1000
+    max_concurrent_requests = None
+    latency = 0
+    bandwidth = None
+
+    def __init__(self):
+        self.buckets, self.uploads = {}, {}
+        self.active_requests, self.throttled_requests = 0, 0
+        self.lock = threading.Lock()
+        self._generation = itertools.count(int(1.5e15))
+
+    def bucket(self, name):
+        with self.lock:
+            if name not in self.buckets:
+                self.buckets[name] = Bucket(name)
+            return self.buckets[name]
+
+    def put_object(self, bucket, name, data, **metadata):
+        now = datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%fZ")[:-4] + "Z"
+        resource = dict(kind="storage#object", bucket=bucket, name=name, size=str(len(data)),
+                        generation=str(next(self._generation)), metageneration="1", timeCreated=now, updated=now,
+                        contentType=metadata.pop("contentType", "application/octet-stream"), storageClass="STANDARD",
+                        md5Hash=base64.b64encode(hashlib.md5(data).digest()).decode(),
+                        crc32c=base64.b64encode(CRC32C(data).digest()).decode())
+        resource.update({k: v for k, v in metadata.items() if v is not None})
+        self.bucket(bucket).put(name, resource, data)
+        return resource
+
+    def populate(self, bucket, names, data=b""):
+        """Quickly add many objects with the same contents, for tests and benchmarks of large listings."""
+        template = self.put_object(bucket, next(iter(names)), data)
+        b = self.bucket(bucket)
+        with b.lock:
+            for name in names:
+                b.objects[name] = (dict(template, name=name, generation=str(next(self._generation))), data)
+            b._sorted_names = None
+
+    def get_object(self, bucket, name):
+        try:
+            return self.bucket(bucket).objects[name]
+        except KeyError:
+            raise HTTPError(404, "No such object: {}/{}".format(bucket, name))
+
+class GCSRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    subresponses = None  # Responses to the subrequests of a batch request are collected here instead of being sent
+
+    def log_message(self, *args):
+        pass
+
+    @property
+    def state(self):
+        return self.server.state
+
+    def read_body(self):
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            body = b""
+            while True:
+                size = int(self.rfile.readline().strip().split(b";")[0], 16)
+                if size == 0:
+                    self.rfile.readline()
+                    return body
+                body += self.rfile.read(size)
+                self.rfile.readline()
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def send(self, status, body=None, headers=None):
+        if isinstance(body, (dict, list)):
+            if getattr(self, "fields", None) and status < 300:
+                body = project(body, parse_fields(self.fields))
+            body = json.dumps(body).encode()
+            headers = dict(headers or {}, **{"Content-Type": "application/json; charset=UTF-8"})
+        body = body or b""
+        if self.subresponses is not None:
+            return self.subresponses.append((status, body, headers or {}))
+        self.send_response(status)
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.state.bandwidth:
+            chunk_size = max(int(self.state.bandwidth / 100), 1)
+            for i in range(0, len(body), chunk_size):
+                self.wfile.write(body[i:i + chunk_size])
+                time.sleep(len(body[i:i + chunk_size]) / float(self.state.bandwidth))
+        else:
+            self.wfile.write(body)
+
+    def dispatch(self, method):
+        url = urlsplit(self.path)
+        params = dict(parse_qsl(url.query, keep_blank_values=True))
+        self.fields = params.get("fields")
+        body = self.read_body()
+        time.sleep(self.state.latency + (len(body) / float(self.state.bandwidth) if self.state.bandwidth else 0))
+        with self.state.lock:
+            self.state.active_requests += 1
+            throttled = self.state.active_requests > (self.state.max_concurrent_requests or float("inf"))
+            self.state.throttled_requests += throttled
+        try:
+            if throttled:
+                raise HTTPError(429, "Rate limit exceeded")
+            handlers = (("/upload/storage/v1/", self.handle_upload), ("/batch/storage/v1/", self.handle_batch),
+                        ("/storage/v1/", self.handle_json))
+            for prefix, handler in handlers:
+                if url.path.startswith(prefix):
+                    parts = [unquote(p) for p in url.path[len(prefix):].split("/")]
+                    return handler(method, parts, params, body)
+            raise HTTPError(404, "Not found: " + url.path)
+        except HTTPError as e:
+            self.send(e.status, dict(error=dict(code=e.status, message=e.message)))
+        finally:
+            with self.state.lock:
+                self.state.active_requests -= 1
+
+    def do_GET(self):
+        self.dispatch("GET")
+
+    def do_POST(self):
+        self.dispatch("POST")
+
+    def do_PUT(self):
+        self.dispatch("PUT")
+
+    def do_PATCH(self):
+        self.dispatch("PATCH")
+
+    def do_DELETE(self):
+        self.dispatch("DELETE")
+
+    def handle_json(self, method, parts, params, body):
+        if parts == ["b"] and method == "GET":
+            return self.send(200, dict(items=[dict(name=b) for b in sorted(self.state.buckets)]))
+        if len(parts) == 3 and parts[0] == "b" and parts[2] == "o" and method == "GET":
+            return self.send(200, self.list_objects(parts[1], params))
+        if len(parts) == 4 and parts[0] == "b" and parts[2] == "o":
+            bucket, key = parts[1], parts[3]
+            if method == "GET":
+                return self.get_object(bucket, key, params)
+            if method == "DELETE":
+                resource, data = self.state.get_object(bucket, key)
+                if params.get("ifGenerationMatch", resource["generation"]) != resource["generation"]:
+                    raise HTTPError(412, "Precondition failed")
+                self.state.bucket(bucket).delete(key)
+                return self.send(204)
+            if method == "PATCH":
+                resource, data = self.state.get_object(bucket, key)
+                for k, v in json.loads(body.decode()).items():
+                    if k == "metadata" and v is not None:
+                        resource.setdefault("metadata", {}).update(v)
+                    elif v is not None:
+                        resource[k] = v
+                resource["metageneration"] = str(int(resource["metageneration"]) + 1)
+                return self.send(200, resource)
+        if len(parts) == 5 and parts[0] == "b" and parts[4] == "compose" and method == "POST":
+            request = json.loads(body.decode())
+            data = b"".join(self.state.get_object(parts[1], i["name"])[1] for i in request["sourceObjects"])
+            return self.send(200, self.state.put_object(parts[1], parts[3], data, **request.get("destination", {})))
+        if len(parts) == 9 and parts[0] == "b" and parts[4] == "copyTo" and method == "POST":
+            resource, data = self.state.get_object(parts[1], parts[3])
+            return self.send(200, self.state.put_object(parts[6], parts[8], data, **self.copy_metadata(resource)))
+        if len(parts) == 9 and parts[0] == "b" and parts[4] == "rewriteTo" and method == "POST":
+            return self.send(200, self.rewrite_object(parts[1], parts[3], parts[6], parts[8], params))
+        raise HTTPError(404, "Unsupported request: {} {}".format(method, "/".join(parts)))
+
+    @staticmethod
+    def copy_metadata(resource):
+        return {k: resource.get(k) for k in ("contentType", "contentEncoding", "contentDisposition", "contentLanguage",
+                                             "cacheControl", "metadata")}
+
+    def rewrite_object(self, source_bucket, source_key, dest_bucket, dest_key, params):
+        resource, data = self.state.get_object(source_bucket, source_key)
+        offset = 0
+        if "rewriteToken" in params:
+            generation, offset = params["rewriteToken"].split(":")
+            if generation != resource["generation"]:
+                raise HTTPError(412, "Source object changed during rewrite")
+            offset = int(offset)
+        offset = min(offset + int(params.get("maxBytesRewrittenPerCall", len(data) or 1)), len(data))
+        result = dict(kind="storage#rewriteResponse", totalBytesRewritten=str(offset), objectSize=str(len(data)),
+                      done=offset == len(data))
+        if result["done"]:
+            result["resource"] = self.state.put_object(dest_bucket, dest_key, data, **self.copy_metadata(resource))
+        else:
+            result["rewriteToken"] = "{}:{}".format(resource["generation"], offset)
+        return result
+
+    def list_objects(self, bucket, params):
+        # Pages are found by bisecting the sorted names, and page tokens are the name to resume from
+        prefix, delimiter = params.get("prefix", ""), params.get("delimiter")
+        start, end = params.get("startOffset"), params.get("endOffset")
+        page_size = min(int(params.get("maxResults", self.state.page_size)), self.state.page_size)
+        b = self.state.bucket(bucket)
+        page = []
+        with b.lock:
+            names = b.sorted_names()
+            pos = bisect.bisect_left(names, max(prefix, start or "", params.get("pageToken", "")))
+            while pos < len(names) and len(page) < page_size:
+                name = names[pos]
+                if not name.startswith(prefix) or (end is not None and name >= end):
+                    pos = len(names)
+                elif delimiter and delimiter in name[len(prefix):]:
+                    page.append((prefix + name[len(prefix):].split(delimiter, 1)[0] + delimiter, None))
+                    pos = bisect.bisect_left(names, page[-1][0] + "\U0010ffff", pos)
+                else:
+                    page.append((name, b.objects[name][0]))
+                    pos += 1
+            next_name = names[pos] if pos < len(names) else None
+        result = dict(kind="storage#objects")
+        if any(r is not None for n, r in page):
+            result["items"] = [r for n, r in page if r is not None]
+        if any(r is None for n, r in page):
+            result["prefixes"] = [n for n, r in page if r is None]
+        if next_name is not None and next_name.startswith(prefix) and (end is None or next_name < end):
+            result["nextPageToken"] = next_name
+        return result
+
+    def get_object(self, bucket, key, params):
+        resource, data = self.state.get_object(bucket, key)
+        if "generation" in params and params["generation"] != resource["generation"]:
+            raise HTTPError(404, "No such object generation")
+        if params.get("alt") != "media":
+            return self.send(200, resource)
+        headers = {"X-Goog-Hash": "crc32c={},md5={}".format(resource["crc32c"], resource["md5Hash"]),
+                   "X-Goog-Generation": resource["generation"], "Content-Type": resource["contentType"]}
+        if resource.get("contentEncoding") == "gzip":
+            headers["X-Goog-Stored-Content-Encoding"] = "gzip"
+            if "gzip" in self.headers.get("Accept-Encoding", ""):
+                headers["Content-Encoding"] = "gzip"
+            else:  # Decompressive transcoding, which ignores Range
+                return self.send(200, zlib.decompress(data, 16 + zlib.MAX_WBITS), headers=headers)
+        match = re.match(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        if match:
+            start = int(match.group(1))
+            end = min(int(match.group(2)) if match.group(2) else len(data) - 1, len(data) - 1)
+            headers["Content-Range"] = "bytes {}-{}/{}".format(start, end, len(data))
+            return self.send(206, data[start:end + 1], headers=headers)
+        return self.send(200, data, headers=headers)
+
+    def handle_batch(self, method, parts, params, body):
+        match = re.search(r'boundary="?([^";]+)"?', self.headers.get("Content-Type", ""))
+        if method != "POST" or not match:
+            raise HTTPError(400, "Expected a multipart/mixed batch request")
+        response_boundary, lines = "batch_" + base64.urlsafe_b64encode(os.urandom(9)).decode(), []
+        self.subresponses = []
+        try:
+            for part in body.decode("utf-8").replace("\r\n", "\n").split("--" + match.group(1))[1:]:
+                if part.strip() in ("", "--"):
+                    continue
+                part_headers, _, http_request = part.strip("\n").partition("\n\n")
+                content_id = re.search(r"Content-ID: <([^>]*)>", part_headers, re.IGNORECASE).group(1)
+                request_head, _, request_body = http_request.partition("\n\n")
+                sub_method, sub_path = request_head.split("\n", 1)[0].split(" ")[:2]
+                url = urlsplit(sub_path)
+                sub_params = dict(parse_qsl(url.query, keep_blank_values=True))
+                self.fields = sub_params.get("fields")
+                try:
+                    self.handle_json(sub_method, [unquote(p) for p in url.path[len("/storage/v1/"):].split("/")],
+                                     sub_params, request_body.strip().encode())
+                except HTTPError as e:
+                    self.send(e.status, dict(error=dict(code=e.status, message=e.message)))
+                status, sub_body, sub_headers = self.subresponses.pop()
+                lines.extend(["--" + response_boundary, "Content-Type: application/http",
+                              "Content-ID: <response-{}>".format(content_id), "",
+                              "HTTP/1.1 {} {}".format(status, self.responses.get(status, ("",))[0])])
+                lines.extend("{}: {}".format(k, v) for k, v in sub_headers.items())
+                lines.extend(["", sub_body.decode("utf-8")])
+            lines.append("--" + response_boundary + "--")
+        finally:
+            self.subresponses, self.fields = None, None
+        content_type = 'multipart/mixed; boundary="{}"'.format(response_boundary)
+        return self.send(200, "\r\n".join(lines).encode("utf-8"), headers={"Content-Type": content_type})
+
+    def handle_upload(self, method, parts, params, body):
+        if len(parts) != 3 or parts[0] != "b" or parts[2] != "o":
+            raise HTTPError(404, "Unsupported upload request")
+        bucket = parts[1]
+        if params.get("uploadType") == "media":
+            content_type = self.headers.get("Content-Type", "application/octet-stream")
+            return self.send(200, self.state.put_object(bucket, params["name"], body, contentType=content_type,
+                                                        contentEncoding=params.get("contentEncoding")))
+        if params.get("uploadType") != "resumable":
+            raise HTTPError(400, "Unsupported uploadType")
+        if "upload_id" not in params:
+            upload_id = base64.urlsafe_b64encode(os.urandom(12)).decode()
+            metadata = json.loads(body.decode()) if body else {}
+            self.state.uploads[upload_id] = dict(bucket=bucket, metadata=metadata, data=b"")
+            location = "http://{}:{}{}&upload_id={}".format(self.server.server_address[0],
+                                                            self.server.server_address[1], self.path, upload_id)
+            return self.send(200, headers={"X-GUploader-UploadID": upload_id, "Location": location})
+        try:
+            upload = self.state.uploads[params["upload_id"]]
+        except KeyError:
+            raise HTTPError(404, "No such upload")
+        total = None
+        content_range = self.headers.get("Content-Range")
+        if content_range:
+            match = re.match(r"bytes (\*|(\d+)-(\d+))/(\*|\d+)", content_range)
+            if match.group(2) is not None:
+                if int(match.group(2)) != len(upload["data"]):
+                    raise HTTPError(400, "Upload offset mismatch")
+                upload["data"] += body
+            total = None if match.group(4) == "*" else int(match.group(4))
+        else:
+            upload["data"] += body
+            total = len(upload["data"])
+        if total is not None and len(upload["data"]) == total:
+            del self.state.uploads[params["upload_id"]]
+            metadata = dict(upload["metadata"])
+            name = metadata.pop("name")
+            return self.send(200, self.state.put_object(upload["bucket"], name, upload["data"], **metadata))
+        headers = {"Range": "bytes=0-{}".format(len(upload["data"]) - 1)} if upload["data"] else {}
+        return self.send(308, headers=headers)
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024  # Clients open many connections at once
+
+class GCSServer(object):
+    def __init__(self, host="127.0.0.1", port=0):
+        self.httpd = ThreadingHTTPServer((host, port), GCSRequestHandler)
+        self.httpd.state = self.state = GCSState()
+        self.url = "http://{}:{}".format(*self.httpd.server_address)
+
+    def configure(self, client):
+        """Point a GSClient, GSUploadClient, GSBatchClient or AsyncGSClient at this server."""
+        client.base_url = self.url + client.base_url[len("https://www.googleapis.com"):]
+        if hasattr(client, "upload_url"):
+            client.upload_url = self.url + client.upload_url[len("https://www.googleapis.com"):]
+        return client
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
@@ -1,13 +1,17 @@
 #!/usr/bin/env python
 # coding: utf-8
 
-import os, sys, unittest, uuid, tempfile, time, logging
+import os, sys, unittest, uuid, tempfile, time, logging, io, hashlib, zlib, itertools, threading, json
 
 from gs.util.compat import TemporaryDirectory
 
-import gs, tweak
+import gs, tweak, requests
 from gs import cli
 
+from gs.util import CRC32C
+from gs.upload_state import UploadStateStore
+from gs.util.reader import MappedFileReader
+from gs.compression import GzipSelector, gzip_file_chunks
 from gs.util.compat import USING_PYTHON2
 
 logging.basicConfig(level=logging.DEBUG)
@@ -34,6 +38,7 @@ class TestGS(unittest.TestCase):
             furl2 = os.path.join(test_prefix, os.path.basename(tf2.name))
             cli.cp.main([tf1.name, tf2.name, test_prefix], standalone_mode=False)
             cli.ls.main([test_prefix], standalone_mode=False)
+            cli.ls.main([test_prefix + "/", "--parallel-list"], standalone_mode=False)
             # cli.presign.main([furl1], standalone_mode=False)
             with TemporaryDirectory() as td:
                 cli.cp.main([furl1, furl2, td], standalone_mode=False)
@@ -47,10 +52,343 @@ class TestGS(unittest.TestCase):
                 cli.cp.main([furl1 + ".*", furl1 + "-dir"], standalone_mode=False)
                 cli.cp.main([furl1 + ".3", furl1 + ".4"], standalone_mode=False)
                 cli.rm.main([furl1 + ".2", furl1 + ".3"], standalone_mode=False)
+                cli.setmeta.main([test_prefix, "--recursive", "--cache-control", "no-cache"], standalone_mode=False)
+                cli.setmeta.main([furl1 + ".*", "--metadata", "k=v"], standalone_mode=False)
                 cli.sync.main([test_prefix, td], standalone_mode=False)
                 cli.sync.main([td, test_prefix], standalone_mode=False)
+                cli.sync.main([test_prefix, td, "--parallel-list"], standalone_mode=False)
+                cli.sync.main([td, test_prefix, "--manifest"], standalone_mode=False)
+                cli.sync.main([td, test_prefix, "--manifest"], standalone_mode=False)
+                cli.sync.main([td, test_prefix, "--checksum"], standalone_mode=False)
+                cli.sync.main([test_prefix, td, "--checksum"], standalone_mode=False)
+                cli.sync.main([td, test_prefix + "/mirror", "--delete"], standalone_mode=False)
+                cli.sync.main([test_prefix + "/mirror/", td, "--delete"], standalone_mode=False)
+                usage = cli.get_prefix_usage(self.test_bucket, "{}/".format(self.test_id), depth=1)
+                self.assertEqual(usage["{}/".format(self.test_id)][1], sum(
+                    int(i["size"]) for i in cli.client.list("b/{}/o".format(self.test_bucket),
+                                                            params=dict(prefix="{}/".format(self.test_id)))))
+                cli.du.main([test_prefix, "--depth", "1", "--json"], standalone_mode=False)
                 cli.rm.main([test_prefix, "--dryrun", "--recursive"], standalone_mode=False)
                 cli.rm.main([test_prefix, "--recursive"], standalone_mode=False)
 
+    def test_crc32c_combine(self):
+        payload = os.urandom(1024 * 1024 + 1)
+        for split in 0, 1, 4096, len(payload):
+            crc = CRC32C(payload[:split])
+            crc.combine(CRC32C(payload[split:]), len(payload) - split)
+            self.assertEqual(crc.digest(), CRC32C(payload).digest())
+
+    def test_batch_response_parser(self):
+        parts, error_body = [], '{\n "error": {"code": 404}\n}'
+        for content_id, status, body in (1, "204 No Content", ""), (0, "404 Not Found", error_body):
+            lines = ["--batch_x", "Content-Type: application/http", "Content-ID: <response-{}>".format(content_id), "",
+                     "HTTP/1.1 " + status, "Content-Type: application/json; charset=UTF-8", "", body, ""]
+            parts.append("\r\n".join(lines))
+        res = requests.Response()
+        res.headers["Content-Type"] = "multipart/mixed; boundary=batch_x"
+        res.raw = io.BytesIO(("".join(parts) + "--batch_x--\r\n").encode())
+        responses = list(gs.GSBatchClient(config=tweak.Config("gs", save_on_exit=False)).parse_multipart_response(res))
+        self.assertEqual([r.content_id for r in responses], [1, 0])
+        self.assertEqual([r.status_code for r in responses], [204, 404])
+        self.assertIsNone(responses[0].body)
+        self.assertEqual(responses[1].body, {"error": {"code": 404}})
+        self.assertEqual(responses[1].headers["content-type"], "application/json; charset=UTF-8")
+        # Parts without a Content-ID are matched to subrequests by position; parts without a status are an error
+        res.raw = io.BytesIO(b"--batch_x\r\nContent-Type: application/http\r\n\r\nHTTP/1.1 204 No Content\r\n\r\n"
+                             b"--batch_x\r\nContent-Type: application/http\r\n\r\nHTTP/1.1 200 OK\r\n\r\n"
+                             b"--batch_x--\r\n")
+        responses = list(gs.GSBatchClient(config=tweak.Config("gs", save_on_exit=False)).parse_multipart_response(res))
+        self.assertEqual([(r.content_id, r.status_code) for r in responses], [(0, 204), (1, 200)])
+        res.raw = io.BytesIO(b"--batch_x\r\nContent-ID: <response-0>\r\n\r\n--batch_x--\r\n")
+        with self.assertRaises(gs.util.exceptions.GSBatchError):
+            list(gs.GSBatchClient(config=tweak.Config("gs", save_on_exit=False)).parse_multipart_response(res))
+
+    def test_upload_state_store(self):
+        with TemporaryDirectory() as td:
+            store = UploadStateStore(os.path.join(td, "uploads.db"), max_entries=2)
+            store.put("a", "upload-a")
+            store.put("b", "upload-b")
+            self.assertEqual(store.get("a"), "upload-a")
+            store.put("c", "upload-c")
+            self.assertIsNone(store.get("b"))
+            self.assertEqual(store.get("c"), "upload-c")
+            store.remove("c")
+            self.assertEqual(len(store), 1)
+            store.ttl = -1
+            self.assertIsNone(store.get("a"))
+            store.close()
+
+    def test_mapped_file_reader(self):
+        payload = os.urandom(1024 * 1024 + 1)
+        with tempfile.NamedTemporaryFile() as tf:
+            tf.write(payload)
+            tf.flush()
+            hasher = hashlib.md5()
+            with MappedFileReader(tf.name, hasher, start=4096, hash_from=0, block_size=65536) as reader:
+                self.assertEqual(len(reader), len(payload) - 4096)
+                self.assertEqual(bytes(reader.read(1024)), payload[4096:4096 + 65536])
+                reader.seek(0)
+                body = b"".join(bytes(chunk) for chunk in iter(lambda: reader.read(1024), b""))
+                self.assertEqual(body, payload[4096:])
+            self.assertEqual(hasher.digest(), hashlib.md5(payload).digest())
+
+            # Hashing the part of the file before start must not hold up sending the rest
+            class BlockedHasher(object):
+                def __init__(self):
+                    self.released, self.md5 = threading.Event(), hashlib.md5()
+
+                def update(self, data):
+                    self.released.wait(5)
+                    self.md5.update(data)
+
+            hasher = BlockedHasher()
+            started_at = time.time()
+            with MappedFileReader(tf.name, hasher, start=len(payload) - 4096, hash_from=0, block_size=4096) as reader:
+                self.assertLess(time.time() - started_at, 1)
+                self.assertEqual(bytes(reader.read()), payload[-4096:])
+                hasher.released.set()
+            self.assertEqual(hasher.md5.digest(), hashlib.md5(payload).digest())
+
+    def test_download_checkpoint(self):
+        payload = os.urandom(1024 * 1024 + 1)
+        object_meta = dict(generation="1", size=str(len(payload)))
+        with TemporaryDirectory() as td:
+            staging_filename, checkpoint_filename = os.path.join(td, "f.gsdownload"), os.path.join(td, "f.checkpoint")
+            with open(staging_filename, "wb") as fh:
+                fh.write(payload[:4096])
+            cli.save_download_checkpoint(checkpoint_filename, "1", 1024, CRC32C(payload[:1024]))
+            resume_pos, hasher = cli.resume_partial_download(staging_filename, checkpoint_filename, object_meta)
+            self.assertEqual(resume_pos, 4096)
+            self.assertEqual(hasher.digest(), CRC32C(payload[:4096]).digest())
+            object_meta.update(generation="2")
+            resume_pos, hasher = cli.resume_partial_download(staging_filename, checkpoint_filename, object_meta)
+            self.assertEqual(resume_pos, 0)
+
+    def test_gzip_transfer_compression(self):
+        selector = GzipSelector(["csv,.json", "logs/*"])
+        self.assertTrue(selector.matches("a/b.csv") and selector.matches("c.json") and selector.matches("logs/x.txt"))
+        self.assertFalse(selector.matches("a/b.csv.gz") or GzipSelector(()).matches("a.csv"))
+        payload = b"".join(b"chr1\t%d\tA\tG\n" % i for i in range(100000))
+        with tempfile.NamedTemporaryFile() as tf:
+            tf.write(payload)
+            tf.flush()
+            hasher, uncompressed_hasher = hashlib.md5(), CRC32C()
+            compressed = b"".join(gzip_file_chunks(tf.name, hasher, uncompressed_hasher, chunk_size=65536))
+        self.assertEqual(zlib.decompress(compressed, 16 + zlib.MAX_WBITS), payload)
+        self.assertEqual(hasher.digest(), hashlib.md5(compressed).digest())
+        self.assertEqual(uncompressed_hasher.digest(), CRC32C(payload).digest())
+
+    def test_run_transfers(self):
+        def transfer(path, dest_bucket, dest_key):
+            if int(path) % 3 == 0:
+                raise ValueError(path)
+            return int(path)
+        for max_workers in 1, 4:
+            succeeded = []
+            transfers = (dict(path=str(n), dest_bucket="b", dest_key="k") for n in range(10))
+            with self.assertRaises(gs.util.exceptions.GSTransferError) as cm:
+                cli.run_transfers(transfer, transfers, max_workers, on_success=lambda t, res: succeeded.append(res))
+            self.assertEqual(sorted(succeeded), [1, 2, 4, 5, 7, 8])
+            self.assertEqual(sorted(int(t["path"]) for t, e in cm.exception.errors), [0, 3, 6, 9])
+        with self.assertRaises(ValueError):
+            cli.run_transfers(transfer, [dict(path="3", dest_bucket="b", dest_key="k")], 4)
+        succeeded = []
+        cli.run_transfers(lambda path: cli.transfer_skipped if int(path) % 2 else int(path),
+                          (dict(path=str(n)) for n in range(6)), 4, on_success=lambda t, res: succeeded.append(res))
+        self.assertEqual(sorted(succeeded), [0, 2, 4])
+
+    def test_streaming_table(self):
+        from argparse import Namespace
+        from gs.util.printing import format_table_rows, format_jsonl, strip_ansi_codes
+        consumed = []
+
+        def items():
+            for i in range(10):
+                consumed.append(i)
+                yield dict(name="x" * (i + 1), size=i)
+        args = Namespace(columns=["name", "size"], max_col_width=8)
+        lines = format_table_rows(items(), args=args, sample_size=3)
+        self.assertEqual(len(list(itertools.islice(lines, 4))), 4)
+        self.assertEqual(len(consumed), 3)
+        lines = [strip_ansi_codes(line) for line in lines]
+        self.assertEqual(len(set(len(line) for line in lines)), 1)
+        self.assertIn(u"│xxx…│9   │", lines)
+        self.assertEqual(len(list(format_jsonl(items(), args=args))), 10)
+
+    def test_flow_control(self):
+        from gs.throttle import AdaptiveConcurrency, RetryBudget, TokenBucket
+        limiter = AdaptiveConcurrency(initial=4, max_limit=8)
+        for i in range(100):
+            limiter.release(limiter.acquire())
+        self.assertEqual(limiter.limit, 8)
+        limiter.latency = 1
+        started_at = limiter.acquire()
+        limiter.release(started_at, throttled=True)
+        limiter.back_off()  # Within one latency of the first cut, so ignored
+        self.assertEqual((limiter.limit, limiter.throttled, limiter.in_flight), (4, 1, 0))
+        budget = RetryBudget(ratio=0.5, min_per_second=0, max_balance=2)
+        self.assertTrue(budget.withdraw(2))
+        self.assertFalse(budget.withdraw())
+        budget.deposit()
+        budget.deposit()
+        self.assertTrue(budget.withdraw())
+        bucket, started_at = TokenBucket(rate=100, burst=1), time.time()
+        for i in range(6):
+            bucket.acquire()
+        self.assertGreaterEqual(time.time() - started_at, 0.04)
+
+    def test_connection_limit(self):
+        from gs.transport import GSTransport
+        from .gcs_server import GCSServer
+        transport = GSTransport(max_connections=3)
+        held, peak, lock = [0], [0], threading.Lock()
+
+        def download(server):
+            client = server.configure(gs.GSClient(transport=transport))
+            client.credentials.anonymous = True
+            res = client.get("b/bk/o/obj", params=dict(alt="media"), stream=True)
+            with lock:
+                held[0] += 1
+                peak[0] = max(peak[0], held[0])
+            time.sleep(0.05)
+            with lock:
+                held[0] -= 1
+            self.assertEqual(res.raw.read(), b"data")
+
+        # The limit is on connections in use across all hosts, and lasts until a streamed response has been read
+        with GCSServer() as server1, GCSServer() as server2:
+            for server in server1, server2:
+                server.state.put_object("bk", "obj", b"data")
+            threads = [threading.Thread(target=download, args=(s,)) for s in [server1, server2] * 6]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(peak[0], 3)
+
+    def test_transfer_scheduler(self):
+        import threading
+        from gs.scheduler import TransferScheduler
+        from gs.util import ByteSize
+        self.assertEqual(ByteSize("1.5K"), 1536)
+        self.assertEqual(ByteSize("100M"), 100 * 1024 * 1024)
+        for order, expected in [("fifo", [1, 5, 3, 2]), ("largest-first", [5, 3, 2, 1]),
+                                ("smallest-first", [1, 2, 3, 5])]:
+            started, ran = threading.Event(), []
+            with TransferScheduler(max_workers=1, order=order) as scheduler:
+                blocker = scheduler.submit(started.wait)
+                futures = [scheduler.schedule(ran.append, (size,), size=size) for size in (1, 5, 3, 2)]
+                urgent = scheduler.schedule(ran.append, ("urgent",), size=0, priority=1)
+                started.set()
+            self.assertTrue(all(f.done() for f in futures + [blocker, urgent]))
+            self.assertEqual(ran, ["urgent"] + expected)
+
+    def test_sync_diff(self):
+        from gs.diff import walk_sorted, diff, SortOrderError
+        with TemporaryDirectory() as td:
+            for name in "a-b", "a.c", "a/x", "a/y/z", "b":
+                if not os.path.exists(os.path.dirname(os.path.join(td, name))):
+                    os.makedirs(os.path.dirname(os.path.join(td, name)))
+                with open(os.path.join(td, name), "w") as fh:
+                    fh.write(name)
+            local_files = list(walk_sorted(td, prefix="p/"))
+            self.assertEqual([f.name for f in local_files], ["p/a-b", "p/a.c", "p/a/x", "p/a/y/z", "p/b"])
+            self.assertEqual([f.name for f in walk_sorted(td, subset="a/y")], ["a/y/z"])
+            remote_objects = [dict(name=n) for n in ("p/a-b", "p/a/w", "p/a/x", "p/c")]
+            changes = diff(local_files, remote_objects, upload=True, is_current=lambda f, o: f.name != "p/a/x")
+            actions = [(action, local_file.name if local_file else remote_object["name"])
+                       for action, local_file, remote_object in changes]
+            self.assertEqual(actions, [("skip", "p/a-b"), ("copy", "p/a.c"), ("delete", "p/a/w"), ("copy", "p/a/x"),
+                                       ("copy", "p/a/y/z"), ("copy", "p/b"), ("delete", "p/c")])
+            with self.assertRaises(SortOrderError):
+                list(diff(local_files, reversed(remote_objects), upload=True, is_current=lambda f, o: True))
+
+    def test_object_index(self):
+        from gs.index import parse_rfc3339, ObjectRecord, ObjectIndex
+        from gs.compression import uncompressed_size, uncompressed_crc32c, is_gzip_encoded
+        self.assertEqual(parse_rfc3339("1970-01-01T00:00:00Z"), 0)
+        self.assertEqual(parse_rfc3339("2020-02-29T12:34:56.789Z"), 1582979696789000000)
+        self.assertEqual(parse_rfc3339("2020-02-29T14:34:56.789+02:00"), 1582979696789000000)
+        self.assertEqual(parse_rfc3339("1969-12-31T23:59:59.5Z"), -500000000)
+        self.assertEqual(parse_rfc3339("2020-02-29 12:34:56.789 UTC"), 1582979696789000000)
+        resource = dict(name="a", size="10", updated="2020-02-29T12:34:56.789Z", generation="1582979696789000",
+                        contentEncoding="gzip", metadata={"gs-uncompressed-size": "100"})
+        record = ObjectRecord.from_resource(resource)
+        self.assertEqual((record.size, record.generation, record.mtime_ns), (10, 1582979696789000, 1582979696789000000))
+        self.assertEqual(uncompressed_size(record), 100)
+        self.assertTrue(is_gzip_encoded(record))
+        self.assertIsNone(uncompressed_size(dict(resource, metadata=None)))
+        self.assertIsNone(uncompressed_crc32c(dict(resource, metadata=None, crc32c="AAAAAA==")))
+        self.assertEqual(uncompressed_size(dict(resource, contentEncoding=None, metadata=None)), 10)
+        self.assertIsNone(record.get("md5Hash"))
+        with self.assertRaises(KeyError):
+            record["md5Hash"]
+        index = ObjectIndex([dict(resource, name="c"), resource, ObjectRecord("b", size=1)])
+        self.assertEqual([r.name for r in index], ["a", "b", "c"])
+        self.assertEqual(index.get("b").size, 1)
+        self.assertIn("c", index)
+        self.assertIsNone(index.get("d"))
+
+    def test_request_stats(self):
+        from gs.instrumentation import RequestStats, RequestRecord, PrometheusTextfileExporter, classify_endpoint
+        base = "https://www.googleapis.com/storage/v1/b/bk/o"
+        self.assertEqual(classify_endpoint("GET", base + "?prefix=x"), "list")
+        self.assertEqual(classify_endpoint("GET", base + "/a%2Fb?alt=media"), "download")
+        self.assertEqual(classify_endpoint("GET", base + "/a%2Fb"), "metadata")
+        self.assertEqual(classify_endpoint("POST", base + "/a/rewriteTo/b/bk2/o/a"), "rewrite")
+        stats = RequestStats()
+        for i in range(100):
+            stats(RequestRecord(started_at=time.time(), method="GET", endpoint="download", url=base, status=200,
+                                latency=i / 1000.0, bytes_sent=0, bytes_received=10, retries=0, error=None))
+        stats(RequestRecord(started_at=time.time(), method="GET", endpoint="download", url=base, status=None,
+                            latency=1, bytes_sent=0, bytes_received=0, retries=2, error=IOError()))
+        summary = stats.summary()
+        self.assertEqual((summary["requests"], summary["errors"], summary["retries"]), (101, 1, 2))
+        self.assertEqual(summary["endpoints"]["download"]["p50"], 0.05)
+        self.assertIn("101 requests", stats.format_report())
+        with TemporaryDirectory() as td:
+            exporter = PrometheusTextfileExporter(os.path.join(td, "gs.prom"), stats)
+            exporter.close()
+            with open(os.path.join(td, "gs.prom")) as fh:
+                metrics = fh.read()
+        self.assertIn('gs_requests_total{endpoint="download",status="error"} 1', metrics)
+        self.assertIn('gs_request_duration_seconds_count{endpoint="download"} 101', metrics)
+
+    def test_unauthorized_retry(self):
+        from gs.credentials import GSCredentials, BearerAuth
+
+        class Credentials(GSCredentials):
+            tokens = iter(["t1", "t2"])
+
+            def _get_identity(self):
+                return "test"
+
+            def _fetch_token(self):
+                return next(self.tokens), time.time() + 3600
+
+        class Adapter(requests.adapters.HTTPAdapter):
+            def send(self, request, **kwargs):
+                res = requests.Response()
+                res.status_code = 200 if request.headers["Authorization"] == "Bearer t2" else 401
+                res.request, res.connection, res.raw = request, self, io.BytesIO(request.body or b"")
+                return res
+
+        with TemporaryDirectory() as td:
+            credentials = Credentials({}, cache_file=os.path.join(td, "credentials_cache.json"))
+            session = requests.Session()
+            session.auth = BearerAuth(credentials)
+            session.mount("https://", Adapter())
+            self.assertEqual(credentials.get_token(), "t1")
+            res = session.post("https://storage.googleapis.com/", data=b"x")
+            self.assertEqual((res.status_code, res.content, len(res.history)), (200, b"x", 1))
+            self.assertEqual(credentials.get_token(), "t2")
+            with open(credentials.cache_file) as fh:
+                self.assertEqual(json.load(fh)["token:test"]["access_token"], "t2")
+            credentials.invalidate("t1")
+            self.assertEqual(credentials.get_token(), "t2")
+            credentials.invalidate()
+            with self.assertRaises(StopIteration):
+                session.get("https://storage.googleapis.com/")
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,15 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import unittest
+
+try:
+    from .aio_tests import TestAsyncGSClient  # noqa
+except SyntaxError:  # Python < 3.6
+    @unittest.skip("AsyncGSClient requires Python 3.6+")
+    class TestAsyncGSClient(unittest.TestCase):
+        def test_upload_list_download(self):
+            pass
+
+if __name__ == "__main__":
+    unittest.main()